@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+"""In-memory stand-in for the awlofar query layer and stager_access.
+
+Only the parts of the query DSL that flocs-lta uses are implemented. Every query
+that is executed, and every lazily loaded relation, costs one round trip with a
+configurable latency, like a query to the LTA database would. Staged files come
+online one after another, like tape recalls.
+"""
+
+import hashlib
+import random
+import sys
+import threading
+import time
+import types
+import zlib
+from datetime import datetime, timedelta
+from itertools import count
+from typing import Callable, Optional
+
+_ids = count(1)
+
+
+class FakeDatabase:
+    def __init__(
+        self,
+        n_observations: int = 200,
+        saps_per_observation: int = 3,
+        subbands: int = 60,
+        calibrators_per_observation: int = 4,
+        latency: float = 0.005,
+        project: str = "LC0_000",
+        seed: int = 0,
+    ):
+        """Initialise a FakeDatabase object.
+
+        Generates target observations spread over the sky and over time, with
+        short calibrator observations around each of them.
+
+        Args:
+            n_observations (int): number of target observations.
+            saps_per_observation (int): SubArrayPointings per target observation.
+            subbands (int): CorrelatedDataProducts per SubArrayPointing.
+            calibrators_per_observation (int): calibrator observations per target.
+            latency (float): time in seconds every round trip takes.
+            project (str): project all observations belong to.
+            seed (int): seed for the random pointings.
+        """
+        self.latency = latency
+        self.project = project
+        self.round_trips = 0
+        self._lock = threading.Lock()
+        self.tables: dict[str, list] = {
+            name: []
+            for name in (
+                "Observation",
+                "AveragingPipeline",
+                "SubArrayPointing",
+                "CorrelatedDataProduct",
+                "FileObject",
+            )
+        }
+        rng = random.Random(seed)
+        start = datetime(2020, 1, 1)
+        for i in range(n_observations):
+            obs_start = start + timedelta(days=i, hours=rng.uniform(0, 12))
+            obs = self._observation(obs_start, 8 * 3600, target=True)
+            for s in range(saps_per_observation):
+                ra, dec = rng.uniform(0, 360), rng.uniform(0, 90)
+                if i and s == 0:
+                    # Pointings near the previous target, as in a survey.
+                    previous = self.tables["SubArrayPointing"][-saps_per_observation]
+                    ra = previous.pointing.rightAscension + rng.uniform(-1, 1)
+                    dec = previous.pointing.declination + rng.uniform(-1, 1)
+                self._sap(obs, s, ra % 360, dec, subbands)
+            for c in range(calibrators_per_observation):
+                offset = timedelta(hours=rng.uniform(-20, 30))
+                cal = self._observation(obs_start + offset, 600, target=False)
+                self._sap(cal, 0, rng.uniform(0, 360), rng.uniform(0, 90), subbands)
+
+    def _add(self, table: str, obj: "FakeObject") -> "FakeObject":
+        self.tables[table].append(obj)
+        return obj
+
+    def _observation(self, start: datetime, duration: float, target: bool):
+        obsid = str(next(_ids) + 100000)
+        return self._add(
+            "Observation",
+            FakeObject(
+                self,
+                project=self.project,
+                observationId=obsid,
+                startTime=start,
+                endTime=start + timedelta(seconds=duration),
+                duration=duration,
+                processIdentifierName=("Target" if target else "Calibrator") + obsid,
+                isValid=1,
+                nrStationsCore=24,
+                nrStationsRemote=14,
+                nrStationsInternational=13 if target else 0,
+                antennaSet="HBA Dual Inner",
+                _relations={"subArrayPointings": []},
+            ),
+        )
+
+    def _sap(self, obs, index: int, ra: float, dec: float, subbands: int):
+        sap = self._add(
+            "SubArrayPointing",
+            FakeObject(
+                self,
+                project=self.project,
+                subArrayPointingIdentifier=f"{obs.observationId}_{index}",
+                pointing=types.SimpleNamespace(rightAscension=ra, declination=dec),
+                numberOfCorrelatedDataProducts=subbands,
+            ),
+        )
+        obs._relations["subArrayPointings"].append(sap)
+        for sb in range(subbands):
+            freq = 120e6 + sb * 195312.5
+            dp = self._add(
+                "CorrelatedDataProduct",
+                FakeObject(
+                    self,
+                    project=self.project,
+                    minimumFrequency=freq / 1e6,
+                    maximumFrequency=(freq + 195312.5) / 1e6,
+                    isValid=1,
+                    _relations={"subArrayPointing": sap, "observation": obs},
+                ),
+            )
+            name = f"L{obs.observationId}_SAP{index:03d}_SB{sb:03d}_uv.MS"
+            # An older, superseded copy and the current one.
+            for version in range(2):
+                data = f"{name}{version}".encode()
+                self._add(
+                    "FileObject",
+                    FakeObject(
+                        self,
+                        project=self.project,
+                        URI=(
+                            "srm://srm.grid.sara.nl:8443/pnfs/grid.sara.nl/data/lofar/"
+                            f"ops/projects/{self.project.lower()}/{obs.observationId}/"
+                            f"{name}_{version}abc.tar"
+                        ),
+                        isValid=1,
+                        creation_date=obs.endTime + timedelta(days=version),
+                        filesize=len(data),
+                        hash_adler32=f"{zlib.adler32(data):08x}",
+                        hash_md5=hashlib.md5(data).hexdigest(),
+                        data_object_id=dp.object_id,
+                        _relations={"data_object": dp},
+                    ),
+                )
+
+    def round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeObject:
+    def __init__(self, db: FakeDatabase, _relations: Optional[dict] = None, **fields):
+        self.__dict__.update(fields)
+        self.object_id = next(_ids)
+        self._db = db
+        self._relations = _relations or {}
+
+    def __getattr__(self, name: str):
+        # Relations are loaded lazily, costing a round trip each.
+        relations = self.__dict__.get("_relations", {})
+        if name in relations:
+            self._db.round_trip()
+            return relations[name]
+        raise AttributeError(name)
+
+    def get_project(self) -> str:
+        return self.project
+
+
+def _resolve(obj, path: tuple):
+    """Follow an attribute path on the database side, without round trips."""
+    for name in path:
+        relations = getattr(obj, "_relations", {})
+        obj = relations[name] if name in relations else getattr(obj, name)
+    return obj
+
+
+def _key(value):
+    return id(value) if isinstance(value, FakeObject) else value
+
+
+def _same(a, b) -> bool:
+    return _key(a) == _key(b)
+
+
+class Query:
+    def __init__(
+        self,
+        table: str,
+        predicate: Callable = lambda obj: True,
+        matches: Optional[tuple] = None,
+    ):
+        self.table = table
+        self.predicate = predicate
+        # (path, values) for queries that test a path for equality with any of
+        # the values, so that long OR chains are evaluated as a set lookup.
+        self.matches = matches
+
+    @classmethod
+    def matching(cls, table: str, path: tuple, values: list) -> "Query":
+        keys = {_key(value) for value in values}
+        return cls(
+            table,
+            lambda obj: _key(_resolve(obj, path)) in keys,
+            matches=(path, values),
+        )
+
+    def __and__(self, other: "Query") -> "Query":
+        return Query(
+            self.table, lambda obj: self.predicate(obj) and other.predicate(obj)
+        )
+
+    def __or__(self, other: "Query") -> "Query":
+        if self.matches and other.matches and self.matches[0] == other.matches[0]:
+            return Query.matching(
+                self.table, self.matches[0], self.matches[1] + other.matches[1]
+            )
+        return Query(
+            self.table, lambda obj: self.predicate(obj) or other.predicate(obj)
+        )
+
+    def project_only(self, project: str) -> "Query":
+        return self & Query(self.table, lambda obj: obj.project == project)
+
+    def _execute(self) -> list:
+        db = _database()
+        db.round_trip()
+        return [obj for obj in db.tables[self.table] if self.predicate(obj)]
+
+    def max(self, attribute: str):
+        return max(
+            self._execute(), key=lambda obj: getattr(obj, attribute), default=None
+        )
+
+    def __iter__(self):
+        return iter(self._execute())
+
+    def __len__(self) -> int:
+        return len(self._execute())
+
+
+class Path:
+    def __init__(self, table: str, path: tuple = ()):
+        self.table = table
+        self.path = path
+
+    def __getattr__(self, name: str) -> "Path":
+        return Path(self.table, self.path + (name,))
+
+    def _compare(self, test: Callable) -> Query:
+        return Query(self.table, lambda obj: test(_resolve(obj, self.path)))
+
+    def __eq__(self, other):
+        return Query.matching(self.table, self.path, [other])
+
+    def __ne__(self, other):
+        return self._compare(lambda value: not _same(value, other))
+
+    def __lt__(self, other):
+        return self._compare(lambda value: value < other)
+
+    def __le__(self, other):
+        return self._compare(lambda value: value <= other)
+
+    def __gt__(self, other):
+        return self._compare(lambda value: value > other)
+
+    def __ge__(self, other):
+        return self._compare(lambda value: value >= other)
+
+    def contains(self, item) -> Query:
+        return self._compare(lambda values: any(_same(v, item) for v in values))
+
+    __hash__ = object.__hash__
+
+
+class Table:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __getattr__(self, name: str) -> Path:
+        return Path(self.name, (name,))
+
+    def select_all(self) -> Query:
+        return Query(self.name)
+
+
+class FakeStager:
+    def __init__(
+        self,
+        webdav_url: Callable[[str], str] = lambda surl: surl,
+        recall_time: float = 0.0,
+        macaroons: Optional[dict] = None,
+    ):
+        """Initialise a FakeStager object.
+
+        Stands in for the stager_access functions. The files of a staging request
+        come online one after another, each `recall_time` seconds after the
+        previous one.
+
+        Args:
+            webdav_url (Callable): gives the WebDAV URL of a SURL.
+            recall_time (float): time in seconds the recall of each file takes.
+            macaroons (dict): macaroons per LTA site name to hand out.
+        """
+        self.webdav_url = webdav_url
+        self.recall_time = recall_time
+        self.macaroons = macaroons or {"SURF": "macaroon"}
+        self.requests: dict[int, tuple[float, list[str]]] = {}
+
+    def stage(self, surls: list[str]) -> int:
+        stage_id = len(self.requests) + 1
+        self.requests[stage_id] = (time.monotonic(), list(surls))
+        return stage_id
+
+    def get_surls_online(self, stage_id: int) -> list[str]:
+        start, surls = self.requests[stage_id]
+        if not self.recall_time:
+            return surls
+        recalled = int((time.monotonic() - start) / self.recall_time)
+        return surls[:recalled]
+
+    def get_status(self, stage_id: int) -> str:
+        online = self.get_surls_online(stage_id)
+        return (
+            "success"
+            if len(online) == len(self.requests[stage_id][1])
+            else "in progress"
+        )
+
+    def get_webdav_urls_requested(self, stage_id: int) -> list[str]:
+        return [
+            self.webdav_url(surl) for surl in self.requests.get(stage_id, (0, []))[1]
+        ]
+
+    def get_macaroons(self, stage_id: int) -> dict:
+        return self.macaroons
+
+    def module(self) -> types.ModuleType:
+        """A module with the stager_access functions of this stager."""
+        module = types.ModuleType("stager_access")
+        for name in (
+            "stage",
+            "get_status",
+            "get_surls_online",
+            "get_webdav_urls_requested",
+            "get_macaroons",
+        ):
+            setattr(module, name, getattr(self, name))
+        return module
+
+
+_state: dict = {}
+
+
+def _database() -> FakeDatabase:
+    return _state["db"]
+
+
+def install(db: FakeDatabase, stager: Optional[FakeStager] = None):
+    """Make `import awlofar...` and `import stager_access` use the fakes.
+
+    Must be called before flocs_lta.lta_search is imported. Call `install_stager`
+    to replace the stager later on.
+    """
+    _state["db"] = db
+    _state["project"] = db.project
+    aweimports = types.ModuleType("awlofar.main.aweimports")
+    for name in db.tables:
+        setattr(aweimports, name, Table(name))
+    context_module = types.ModuleType("awlofar.database.Context")
+
+    class Context:
+        def set_project(self, project: str):
+            db.round_trip()
+            _state["project"] = project
+
+        def get_current_project(self):
+            return types.SimpleNamespace(name=_state["project"])
+
+    context_module.context = Context()
+    for name in ("awlofar", "awlofar.database", "awlofar.main"):
+        sys.modules[name] = types.ModuleType(name)
+    sys.modules["awlofar.database.Context"] = context_module
+    sys.modules["awlofar.main.aweimports"] = aweimports
+    install_stager(stager or FakeStager())
+
+
+def install_stager(stager: FakeStager):
+    """Make `import stager_access` use a FakeStager.
+
+    flocs-lta imports stager_access inside the functions that use it, so this takes
+    effect for any call made afterwards.
+    """
+    sys.modules["stager_access"] = stager.module()
@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+"""Benchmarks for the search and download hot paths of flocs-lta.
+
+Searches run against an in-memory fake of the LTA database with a configurable
+latency per round trip; downloads run against a local HTTP server with synthetic
+MeasurementSet tarballs. Results are written as JSON, so runs on different commits
+can be compared.
+
+Usage:
+    python -m benchmarks.run --output results.json
+"""
+
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from typing import Optional
+
+import cyclopts
+import structlog
+from cyclopts import Parameter
+from typing_extensions import Annotated
+
+from .fake_awlofar import FakeDatabase, FakeStager, install, install_stager
+from .server import TarballServer, make_ms_tarball
+
+app = cyclopts.App()
+
+# Download worker sharing a Ledger; run in a separate process like on another node.
+_WORKER = """
+import contextlib, io, json, logging, sys
+import structlog
+from flocs_lta.ledger import Ledger
+from flocs_lta.lta_download import Downloader
+structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.ERROR))
+args = json.loads(sys.argv[1])
+with contextlib.redirect_stdout(io.StringIO()):
+    results = Downloader(args["urls"], {"SURF": "macaroon"}).download_all(
+        args["parallel"],
+        extract=False,
+        outdir=args["outdir"],
+        bandwidth=args["bandwidth"],
+        min_free_space=None,
+        ledger=Ledger(args["outdir"], lease=args["lease"], poll=args["lease"] / 4),
+    )
+print(json.dumps([result.url for result in results if result.status == "downloaded"]))
+"""
+
+
+def peak_rss() -> dict[str, int]:
+    """Peak resident set size in bytes of this process and of its children."""
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_surl_resolution(db: FakeDatabase, dataproducts: int) -> dict:
+    from awlofar.main.aweimports import FileObject
+
+    from flocs_lta.lta_search import SURLResolver
+
+    selected = db.tables["CorrelatedDataProduct"][:dataproducts]
+    db.round_trips = 0
+    start = time.perf_counter()
+    fileobjects = SURLResolver().resolve(selected)
+    seconds = time.perf_counter() - start
+    round_trips = db.round_trips
+    # The baseline made one query per dataproduct.
+    db.round_trips = 0
+    start = time.perf_counter()
+    for dp in selected:
+        ((FileObject.data_object == dp) & (FileObject.isValid > 0)).max("creation_date")
+    return {
+        "seconds": seconds,
+        "dataproducts": len(selected),
+        "resolved": len(fileobjects),
+        "round_trips": round_trips,
+        "baseline_seconds": time.perf_counter() - start,
+        "baseline_round_trips": db.round_trips,
+    }
+
+
+def bench_cone_search(db: FakeDatabase, radius: float) -> dict:
+    from flocs_lta.cache import MetadataCache
+    from flocs_lta.lta_search import ObservationStager
+
+    sap = db.tables["SubArrayPointing"][0]
+    stager = ObservationStager(cache=MetadataCache(":memory:"))
+    db.round_trips = 0
+    start = time.perf_counter()
+    matches = stager._cone_search(
+        db.project,
+        sap.pointing.rightAscension,
+        sap.pointing.declination,
+        radius,
+        0.0,
+    )
+    stager.close()
+    return {
+        "seconds": time.perf_counter() - start,
+        "matches": len(matches),
+        "round_trips": db.round_trips,
+    }
+
+
+def bench_calibrator_lookup(db: FakeDatabase, n_calibrators: int) -> dict:
+    from flocs_lta.cache import MetadataCache
+    from flocs_lta.lta_search import ObservationStager
+
+    target = db.tables["Observation"][len(db.tables["Observation"]) // 2]
+    stager = ObservationStager(cache=MetadataCache(":memory:"))
+    db.round_trips = 0
+    start = time.perf_counter()
+    stager.find_observation_by_sasid(db.project, target.observationId)
+    lookup = time.perf_counter()
+    lookup_trips = db.round_trips
+    stager.find_nearest_calibrators(n_calibrators)
+    end = time.perf_counter()
+    stager.close()
+    return {
+        "seconds": end - start,
+        "sasid_seconds": lookup - start,
+        "calibrator_seconds": end - lookup,
+        "round_trips": db.round_trips,
+        "sasid_round_trips": lookup_trips,
+    }
+
+
+def bench_frequency_slices(db: FakeDatabase, slices: int) -> dict:
+    """Select `slices` frequency chunks of every SubArrayPointing of an observation.
+
+    Compares the database round trips of the whole search, and the time taken by
+    the selection alone with a linear scan and with the FrequencyIndex.
+    """
+    from flocs_lta.cache import MetadataCache
+    from flocs_lta.lta_search import ObservationStager, select_frequency
+
+    target = db.tables["Observation"][0]
+    frequencies = [dp.minimumFrequency for dp in db.tables["CorrelatedDataProduct"]]
+    low, high = min(frequencies), max(frequencies) + 0.2
+    edges = [low + (high - low) * i / slices for i in range(slices + 1)]
+    stager = ObservationStager(cache=MetadataCache(":memory:"))
+    db.round_trips = 0
+    start = time.perf_counter()
+    for minfreq, maxfreq in zip(edges, edges[1:]):
+        matches = stager.search_sasid(
+            db.project, target.observationId, minfreq=minfreq, maxfreq=maxfreq
+        )
+    seconds = time.perf_counter() - start
+    indexes = stager.frequency_index(db.project, [match.sapid for match in matches])
+    stager.close()
+    selection = {}
+    for label, select in (
+        (
+            "scan",
+            lambda sapid, minfreq, maxfreq: select_frequency(
+                indexes[sapid].entries, minfreq, maxfreq
+            ),
+        ),
+        (
+            "index",
+            lambda sapid, minfreq, maxfreq: indexes[sapid].select(minfreq, maxfreq),
+        ),
+    ):
+        start = time.perf_counter()
+        for _ in range(100):
+            for sapid in indexes:
+                for minfreq, maxfreq in zip(edges, edges[1:]):
+                    select(sapid, minfreq, maxfreq)
+        selection[label] = (time.perf_counter() - start) / 100
+    return {
+        "slices": slices,
+        "seconds": seconds,
+        "round_trips": db.round_trips,
+        "selection_seconds": selection,
+    }
+
+
+def bench_download(
+    server: TarballServer, names: list[str], total: int, parallel: int, workdir: str
+) -> dict:
+    from flocs_lta.lta_download import Downloader
+
+    outdir = tempfile.mkdtemp(dir=workdir)
+    urls = [server.url(name) for name in names]
+    start = time.perf_counter()
+    results = Downloader(urls, {"SURF": "macaroon"}).download_all(
+        parallel, extract=False, outdir=outdir
+    )
+    seconds = time.perf_counter() - start
+    shutil.rmtree(outdir)
+    return {
+        "parallel_downloads": parallel,
+        "seconds": seconds,
+        "files": len(urls),
+        "failed": sum(not result.ok for result in results),
+        "bytes": total,
+        "throughput_mb_s": total / seconds / 1e6,
+    }
+
+
+def bench_stage_and_fetch(
+    server: TarballServer,
+    names: list[str],
+    total: int,
+    recall_time: float,
+    parallel: int,
+    workdir: str,
+) -> dict:
+    """Staging followed by downloading, against downloading files as they come online.
+
+    The bandwidth is capped so that transferring a file takes about as long as
+    recalling it from tape.
+    """
+    from flocs_lta.lta_download import Downloader
+    from flocs_lta.staging import StagingPoller
+
+    surls = [f"srm://srm.grid.sara.nl:8443/pnfs/grid.sara.nl/{name}" for name in names]
+    stager = FakeStager(
+        webdav_url=lambda surl: server.url(surl.split("/")[-1]),
+        recall_time=recall_time,
+    )
+    install_stager(stager)
+    bandwidth = total / len(names) / recall_time
+    seconds = {}
+
+    outdir = tempfile.mkdtemp(dir=workdir)
+    start = time.perf_counter()
+    stage_id = stager.stage(surls)
+    while stager.get_status(stage_id) != "success":
+        time.sleep(recall_time / 10)
+    Downloader(
+        stager.get_webdav_urls_requested(stage_id), stager.macaroons
+    ).download_all(parallel, extract=False, outdir=outdir, bandwidth=bandwidth)
+    seconds["sequential"] = time.perf_counter() - start
+    shutil.rmtree(outdir)
+
+    outdir = tempfile.mkdtemp(dir=workdir)
+    start = time.perf_counter()
+    stage_id = stager.stage(surls)
+    downloader = Downloader([], {})
+    poller = StagingPoller(
+        stage_id,
+        downloader,
+        min_interval=recall_time / 10,
+        max_interval=recall_time,
+    )
+    results = downloader.download_all(
+        parallel,
+        extract=False,
+        outdir=outdir,
+        bandwidth=bandwidth,
+        online=poller.online_urls(),
+    )
+    seconds["pipelined"] = time.perf_counter() - start
+    shutil.rmtree(outdir)
+    return {
+        "recall_time": recall_time,
+        "parallel_downloads": parallel,
+        "files": len(names),
+        "failed": sum(not result.ok for result in results),
+        "bytes": total,
+        "seconds": seconds,
+    }
+
+
+def bench_workers(
+    server: TarballServer,
+    names: list[str],
+    total: int,
+    workers: int,
+    parallel: int,
+    workdir: str,
+    lease: float = 2.0,
+) -> dict:
+    """Downloads shared through a Ledger by 1 and by `workers` processes.
+
+    Every worker is capped at the bandwidth a single worker needs to transfer all
+    files in about two seconds, like the network link of a node. In the crash run,
+    one of the workers is killed after a second, and the others have to pick up its
+    claims once their lease expires.
+    """
+    urls = [server.url(name) for name in names]
+    bandwidth = total / 2.0
+    results = {}
+    for label, n, crash in (
+        ("single", 1, False),
+        ("shared", workers, False),
+        ("crash", workers, True),
+    ):
+        outdir = tempfile.mkdtemp(dir=workdir)
+        args = json.dumps(
+            {
+                "urls": urls,
+                "parallel": parallel,
+                "outdir": outdir,
+                "bandwidth": bandwidth / (4 if crash else 1),
+                "lease": lease,
+            }
+        )
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        start = time.perf_counter()
+        processes = [
+            subprocess.Popen(
+                [sys.executable, "-c", _WORKER, args],
+                cwd=cwd,
+                stdout=subprocess.PIPE,
+                text=True,
+            )
+            for _ in range(n)
+        ]
+        if crash:
+            time.sleep(1.0)
+            processes[0].kill()
+        downloaded = []
+        for process in processes:
+            output = process.communicate()[0]
+            if process.returncode == 0:
+                downloaded += json.loads(output.splitlines()[-1])
+        results[label] = {
+            "workers": n,
+            "seconds": time.perf_counter() - start,
+            "files": len(urls),
+            # Files downloaded by workers that finished; each should appear once.
+            "downloaded": len(downloaded),
+            "unique": len(set(downloaded)),
+            "done": len(os.listdir(os.path.join(outdir, ".ledger", "done"))),
+        }
+        shutil.rmtree(outdir)
+    return results
+
+
+def bench_extraction(archive: str, threads: int, workdir: str) -> dict:
+    from flocs_lta.extract import extract_tarball
+
+    def extract_tarfile(outdir: str):
+        with tarfile.open(archive) as tarball:
+            tarball.extractall(outdir)
+
+    results = {}
+    for label, extract in (
+        ("tarfile", extract_tarfile),
+        ("threads_1", lambda outdir: extract_tarball(archive, outdir, threads=1)),
+        (
+            f"threads_{threads}",
+            lambda outdir: extract_tarball(archive, outdir, threads=threads),
+        ),
+    ):
+        outdir = tempfile.mkdtemp(dir=workdir)
+        start = time.perf_counter()
+        extract(outdir)
+        results[label] = time.perf_counter() - start
+        shutil.rmtree(outdir)
+    size = os.path.getsize(archive)
+    return {
+        "bytes": size,
+        "seconds": results,
+        "throughput_mb_s": {
+            label: size / seconds / 1e6 for label, seconds in results.items()
+        },
+    }
+
+
+@app.default
+def main(
+    output: Annotated[
+        Optional[str],
+        Parameter(help="File to write the JSON results to, instead of stdout."),
+    ] = None,
+    latency: Annotated[
+        float, Parameter(help="Latency of a database round trip in seconds.")
+    ] = 0.005,
+    observations: Annotated[
+        int, Parameter(help="Number of target observations in the fake database.")
+    ] = 100,
+    subbands: Annotated[
+        int, Parameter(help="Number of dataproducts per SubArrayPointing.")
+    ] = 60,
+    dataproducts: Annotated[
+        int, Parameter(help="Number of dataproducts to resolve SURLs for.")
+    ] = 480,
+    files: Annotated[int, Parameter(help="Number of tarballs to download.")] = 8,
+    file_size: Annotated[float, Parameter(help="Size of each tarball in MB.")] = 64,
+    parallel: Annotated[
+        Optional[list[int]],
+        Parameter(help="Values of parallel_downloads to measure."),
+    ] = None,
+    extract_threads: Annotated[
+        int, Parameter(help="Number of threads for the parallel extraction run.")
+    ] = 4,
+    recall_time: Annotated[
+        float,
+        Parameter(help="Time in seconds the fake tape recall of each file takes."),
+    ] = 0.5,
+    workers: Annotated[
+        int,
+        Parameter(help="Number of worker processes sharing a download ledger."),
+    ] = 4,
+    slices: Annotated[
+        int,
+        Parameter(help="Number of frequency chunks to select per observation."),
+    ] = 8,
+    only: Annotated[
+        Optional[list[str]],
+        Parameter(
+            help="Benchmarks to run, out of surl_resolution, cone_search, calibrator_lookup, frequency_slices, download, stage_and_fetch, workers and extraction."
+        ),
+    ] = None,
+):
+    """Run the benchmarks and report the results as JSON."""
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING)
+    )
+    selected = set(
+        only
+        or [
+            "surl_resolution",
+            "cone_search",
+            "calibrator_lookup",
+            "frequency_slices",
+            "download",
+            "stage_and_fetch",
+            "workers",
+            "extraction",
+        ]
+    )
+    db = FakeDatabase(n_observations=observations, subbands=subbands, latency=latency)
+    install(db)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "config": {
+            "latency": latency,
+            "observations": observations,
+            "subbands": subbands,
+            "dataproducts": dataproducts,
+            "files": files,
+            "file_size_mb": file_size,
+            "extract_threads": extract_threads,
+            "recall_time": recall_time,
+            "workers": workers,
+            "slices": slices,
+        },
+        "results": {},
+    }
+    results = report["results"]
+    # Keep progress messages of the package out of the JSON on stdout.
+    with contextlib.redirect_stdout(io.StringIO()):
+        if "surl_resolution" in selected:
+            results["surl_resolution"] = bench_surl_resolution(db, dataproducts)
+        if "cone_search" in selected:
+            results["cone_search"] = bench_cone_search(db, radius=1.3)
+        if "calibrator_lookup" in selected:
+            results["calibrator_lookup"] = bench_calibrator_lookup(db, 2)
+        if "frequency_slices" in selected:
+            results["frequency_slices"] = bench_frequency_slices(db, slices)
+        if selected & {"download", "stage_and_fetch", "workers", "extraction"}:
+            with tempfile.TemporaryDirectory() as workdir:
+                served = os.path.join(workdir, "served")
+                os.makedirs(served)
+                size = int(file_size * 1e6)
+                archives = [
+                    make_ms_tarball(served, f"L{100 + i}_SB000_uv.MS", size)
+                    for i in range(files)
+                ]
+                for archive in archives:
+                    shutil.rmtree(archive.split("MS")[0] + "MS")
+                total = sum(os.path.getsize(archive) for archive in archives)
+                if "download" in selected:
+                    with TarballServer(served) as server:
+                        results["download"] = [
+                            bench_download(
+                                server,
+                                [os.path.basename(archive) for archive in archives],
+                                total,
+                                n,
+                                workdir,
+                            )
+                            for n in parallel or [1, 2, 4]
+                        ]
+                if "stage_and_fetch" in selected:
+                    with TarballServer(served) as server:
+                        results["stage_and_fetch"] = bench_stage_and_fetch(
+                            server,
+                            [os.path.basename(archive) for archive in archives],
+                            total,
+                            recall_time,
+                            max(parallel or [2]),
+                            workdir,
+                        )
+                if "workers" in selected:
+                    with TarballServer(served) as server:
+                        results["workers"] = bench_workers(
+                            server,
+                            [os.path.basename(archive) for archive in archives],
+                            total,
+                            workers,
+                            max(parallel or [2]),
+                            workdir,
+                        )
+                if "extraction" in selected:
+                    results["extraction"] = bench_extraction(
+                        archives[0], extract_threads, workdir
+                    )
+    report["peak_rss"] = peak_rss()
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Local HTTP server with synthetic MeasurementSet tarballs, standing in for an LTA
+WebDAV door."""
+
+import http.server
+import os
+import tarfile
+import threading
+
+
+def make_ms_tarball(
+    directory: str,
+    name: str,
+    size: int,
+    small_files: int = 40,
+    column_files: int = 3,
+) -> str:
+    """Write an uncompressed tarball shaped like an LTA MeasurementSet.
+
+    A few large column files hold most of the data, next to many small table files.
+
+    Args:
+        directory (str): directory to write the tarball in.
+        name (str): name of the MS, e.g. L123456_SB000_uv.MS.
+        size (int): approximate size of the tarball in bytes.
+        small_files (int): number of small table files.
+        column_files (int): number of large column files.
+
+    Returns:
+        path (str): path of the tarball.
+    """
+    ms = os.path.join(directory, name)
+    os.makedirs(os.path.join(ms, "ANTENNA"), exist_ok=True)
+    block = os.urandom(1 << 20)
+    for i in range(column_files):
+        with open(os.path.join(ms, f"table.f{i}"), "wb") as f:
+            remaining = size // column_files
+            while remaining > 0:
+                f.write(block[: min(len(block), remaining)])
+                remaining -= len(block)
+    for i in range(small_files):
+        with open(os.path.join(ms, "ANTENNA", f"table.f{i}"), "wb") as f:
+            f.write(block[: 512 * (i + 1)])
+    path = os.path.join(directory, f"{name}_abc.tar")
+    with tarfile.open(path, "w") as tarball:
+        tarball.add(ms, arcname=name)
+    return path
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    root = "."
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = os.path.join(self.root, os.path.basename(self.path.split("?")[0]))
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        total = os.path.getsize(path)
+        first, last = 0, total - 1
+        byte_range = self.headers.get("Range")
+        if byte_range:
+            start, _, end = byte_range.split("=", 1)[1].partition("-")
+            first, last = int(start), int(end) if end else total - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {first}-{last}/{total}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(last + 1 - first))
+        self.end_headers()
+        with open(path, "rb") as f:
+            offset, remaining = first, last + 1 - first
+            while remaining > 0:
+                sent = os.sendfile(self.wfile.fileno(), f.fileno(), offset, remaining)
+                if not sent:
+                    break
+                offset += sent
+                remaining -= sent
+
+
+class TarballServer:
+    def __init__(self, root: str):
+        """Initialise a TarballServer object.
+
+        Serves the files in `root` over HTTP with Range support, on a free local port.
+
+        Args:
+            root (str): directory with the files to serve.
+        """
+        handler = type("Handler", (_Handler,), {"root": root})
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+
+    def url(self, name: str) -> str:
+        """URL of a file, with "surf" in its path so it maps to an LTA site."""
+        return f"http://127.0.0.1:{self.server.server_address[1]}/surf/{name}"
+
+    def __enter__(self) -> "TarballServer":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
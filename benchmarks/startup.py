@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Guard against slow CLI startup.
+
+Checks, each in a fresh interpreter, that the CLI and the download path do not import
+the heavy search dependencies, and that `flocs-lta --help` starts quickly. Exits
+with status 1 if either regresses, so it can run in CI.
+
+Usage:
+    python -m benchmarks.startup
+"""
+
+import json
+import statistics
+import subprocess
+import sys
+import time
+from typing import Optional
+
+import cyclopts
+from cyclopts import Parameter
+from typing_extensions import Annotated
+
+app = cyclopts.App()
+
+# Modules that only the search commands or post-processing may load.
+HEAVY_MODULES = ["astropy", "awlofar", "casacore", "numpy", "stager_access"]
+
+_IMPORTED = """
+import json, sys
+import flocs_lta.flocs_lta
+from flocs_lta import engine, lta_download
+flocs_lta.flocs_lta.app.parse_args(["download", "123", "--stream"])
+print(json.dumps(sorted({name.split(".")[0] for name in sys.modules})))
+"""
+
+_HELP = """
+import contextlib, io, sys
+from flocs_lta.flocs_lta import main
+sys.argv = ["flocs-lta", "--help"]
+with contextlib.redirect_stdout(io.StringIO()), contextlib.suppress(SystemExit):
+    main()
+"""
+
+
+def heavy_imports() -> list[str]:
+    """Heavy modules loaded by importing the CLI and parsing a download command."""
+    output = subprocess.run(
+        [sys.executable, "-c", _IMPORTED], capture_output=True, text=True, check=True
+    ).stdout
+    loaded = set(json.loads(output.splitlines()[-1]))
+    return [name for name in HEAVY_MODULES if name in loaded]
+
+
+def help_time(repeat: int = 5) -> float:
+    """Median wall time in seconds of `flocs-lta --help`, including interpreter start."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", _HELP], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def baseline_time(repeat: int = 5) -> float:
+    """Median wall time in seconds of starting an interpreter that imports cyclopts."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import cyclopts"], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+@app.default
+def main(
+    max_overhead: Annotated[
+        float,
+        Parameter(
+            help="Maximum time in seconds `flocs-lta --help` may take on top of starting Python with cyclopts."
+        ),
+    ] = 0.5,
+    repeat: Annotated[int, Parameter(help="Number of runs to take the median of.")] = 5,
+    output: Annotated[
+        Optional[str],
+        Parameter(help="File to write the JSON results to, instead of stdout."),
+    ] = None,
+):
+    """Check that the CLI starts without loading heavy dependencies."""
+    heavy = heavy_imports()
+    help_seconds = help_time(repeat)
+    baseline = baseline_time(repeat)
+    report = {
+        "heavy_imports": heavy,
+        "help_seconds": help_seconds,
+        "baseline_seconds": baseline,
+        "overhead_seconds": help_seconds - baseline,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    failed = False
+    if heavy:
+        print(f"Startup imports {', '.join(heavy)}.", file=sys.stderr)
+        failed = True
+    if help_seconds - baseline > max_overhead:
+        print(
+            f"flocs-lta --help takes {help_seconds - baseline:.2f} s longer than starting"
+            f" Python, more than {max_overhead:.2f} s.",
+            file=sys.stderr,
+        )
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    app()
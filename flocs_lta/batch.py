@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional
+
+import structlog
+
+from .cache import MetadataCache
+from .lta_search import CalibratorPool, ObservationStager
+
+logger = structlog.getLogger()
+
+
+def read_targets(path: str, columns: list[str]) -> list[dict]:
+    """Read targets from a CSV or whitespace-separated text file.
+
+    Lines that are empty or start with # are ignored. If the first line contains
+    the first column name, it is used as header; otherwise the fields are taken to
+    be in the order of `columns`, where trailing columns may be omitted.
+
+    Args:
+        path (str): file to read.
+        columns (list): names of the fields in order, e.g. ["sasid", "sapi"].
+
+    Returns:
+        targets (list): a dictionary per target.
+    """
+    with open(path) as f:
+        lines = [
+            line.strip()
+            for line in f
+            if line.strip() and not line.lstrip().startswith("#")
+        ]
+    rows = [next(csv.reader([line])) if "," in line else line.split() for line in lines]
+    rows = [[field.strip() for field in row] for row in rows]
+    header = columns
+    if rows and columns[0] in [field.lower() for field in rows[0]]:
+        header = [field.lower() for field in rows[0]]
+        rows = rows[1:]
+    return [dict(zip(header, row)) for row in rows]
+
+
+class BatchSearch:
+    def __init__(
+        self,
+        project: str = "ALL",
+        get_surls: bool = False,
+        n_calibrators: int = 2,
+        freq_start: Optional[float] = None,
+        freq_end: Optional[float] = None,
+        max_workers: int = 4,
+        cache: Optional[MetadataCache] = None,
+    ):
+        """Initialise a BatchSearch object.
+
+        Resolves many targets in one run. All lookups share one database session and
+        metadata cache, run concurrently on a bounded thread pool, and calibrators of
+        targets that are close in time are found with a single query. The queries
+        within a lookup, e.g. for the dataproducts of each SubArrayPointing, share a
+        second bounded pool.
+
+        Args:
+            project (str): LTA project to limit searches to.
+            get_surls (bool): write srms_*.txt files for every target.
+            n_calibrators (int): number of nearest calibrators to search for.
+            freq_start (float): lower limit of the frequency subbands to select.
+            freq_end (float): upper limit of the frequency subbands to select.
+            max_workers (int): maximum number of concurrent lookups, and of
+                concurrent queries within them.
+            cache (MetadataCache): cache for catalogue metadata.
+        """
+        self.project = project
+        self.get_surls = get_surls
+        self.n_calibrators = n_calibrators
+        self.freq_start = freq_start
+        self.freq_end = freq_end
+        self.max_workers = max_workers
+        self.cache = cache or MetadataCache(":memory:")
+        self.calibrator_pool = CalibratorPool()
+        self.query_pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def close(self):
+        """Shut down the thread pool shared by the stagers."""
+        self.query_pool.shutdown()
+
+    def __enter__(self) -> "BatchSearch":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _stager(self) -> ObservationStager:
+        return ObservationStager(
+            get_surls=self.get_surls,
+            cache=self.cache,
+            calibrator_pool=self.calibrator_pool,
+            executor=self.query_pool,
+        )
+
+    def search_ids(self, targets: list[dict]) -> list[dict]:
+        """Search for targets given by SAS ID and optionally SAP identifier."""
+        return self._run(
+            targets,
+            lambda stager, target: stager.find_observation_by_sasid(
+                self.project,
+                target["sasid"],
+                target.get("sapi", ""),
+                self.freq_start,
+                self.freq_end,
+            ),
+        )
+
+    def search_positions(
+        self, targets: list[dict], max_radius: float = 1.3, min_duration: float = 0.0
+    ) -> list[dict]:
+        """Search for targets given by right ascension and declination in degrees."""
+        return self._run(
+            targets,
+            lambda stager, target: stager.find_observation_by_position(
+                self.project,
+                float(target["ra"]),
+                float(target["dec"]),
+                max_radius,
+                min_duration,
+                self.freq_start,
+                self.freq_end,
+            ),
+        )
+
+    def _run(self, targets: list[dict], find) -> list[dict]:
+        stagers = [self._stager() for _ in targets]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as tex:
+            errors = list(
+                tex.map(
+                    lambda stager, target: self._attempt(find, stager, target),
+                    stagers,
+                    targets,
+                )
+            )
+            found = [
+                stager
+                for stager, error in zip(stagers, errors)
+                if error is None and hasattr(stager, "target")
+            ]
+            self._prefetch_calibrators(
+                [
+                    stager
+                    for stager in found
+                    if stager.needs_calibrator_query(self.n_calibrators)
+                ],
+                tex,
+            )
+            calibrator_errors = dict(
+                zip(
+                    map(id, found),
+                    tex.map(
+                        lambda stager: self._attempt(
+                            self._find_calibrators, stager, None
+                        ),
+                        found,
+                    ),
+                )
+            )
+        entries = []
+        for target, stager, error in zip(targets, stagers, errors):
+            if error is None and not hasattr(stager, "target"):
+                error = "No matching observation found."
+            error = error or calibrator_errors.get(id(stager))
+            entries.append(self._manifest_entry(target, stager, error))
+        found_count = sum(entry["status"] == "ok" for entry in entries)
+        logger.info(f"Resolved {found_count} of {len(entries)} targets.")
+        return entries
+
+    def _find_calibrators(self, stager: ObservationStager, _target: Optional[dict]):
+        stager.find_nearest_calibrators(
+            self.n_calibrators, self.freq_start, self.freq_end
+        )
+
+    @staticmethod
+    def _attempt(
+        find, stager: ObservationStager, target: Optional[dict]
+    ) -> Optional[str]:
+        """Run one lookup, returning an error message instead of raising or exiting."""
+        try:
+            find(stager, target)
+        except SystemExit:
+            return "Search stopped without a unique result."
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+        return None
+
+    def _prefetch_calibrators(self, stagers: list[ObservationStager], tex):
+        """Fetch calibrator candidates once for every group of overlapping time windows."""
+        if not stagers:
+            return
+        windows: dict[str, list[list[datetime]]] = {}
+        for stager in sorted(stagers, key=lambda stager: stager.calibrator_window()):
+            start, end = stager.calibrator_window()
+            merged = windows.setdefault(stager.project, [])
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        windows_flat = [
+            (project, start, end)
+            for project, merged in windows.items()
+            for start, end in merged
+        ]
+        logger.info(
+            f"Fetching calibrator candidates for {len(stagers)} targets in "
+            f"{len(windows_flat)} time windows."
+        )
+        list(
+            tex.map(
+                lambda window: stagers[0].calibrator_candidates(*window), windows_flat
+            )
+        )
+
+    @staticmethod
+    def _manifest_entry(
+        target: dict, stager: ObservationStager, error: Optional[str]
+    ) -> dict:
+        entry = {
+            "target": target,
+            "status": "failed" if error else "ok",
+            "error": error,
+        }
+        if hasattr(stager, "target"):
+            entry.update(
+                {
+                    "project": stager.project,
+                    "obsid": stager.target.obsid,
+                    "start_time": stager.target.start_time.isoformat(),
+                    "duration": stager.target.duration,
+                    "target_uris": sorted(getattr(stager, "target_uris", [])),
+                    "calibrator_uris": sorted(getattr(stager, "calibrator_uris", [])),
+                }
+            )
+        return entry
+
+
+def write_manifest(entries: list[dict], path: str):
+    """Write the results of a batch search as JSON or, for .parquet paths, Parquet.
+
+    Args:
+        entries (list): manifest entry per target.
+        path (str): file to write.
+    """
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Writing Parquet manifests requires pyarrow.")
+        rows = [{**entry, "target": json.dumps(entry["target"])} for entry in entries]
+        pq.write_table(pa.Table.from_pylist(rows), path)
+    else:
+        with open(path, "w") as f:
+            json.dump(entries, f, indent=2)
+    logger.info(f"Wrote manifest for {len(entries)} targets to {path}.")
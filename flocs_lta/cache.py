@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+import structlog
+
+logger = structlog.getLogger()
+
+
+def default_cache_dir() -> str:
+    """Directory for flocs-lta caches, following the XDG base directory spec."""
+    base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(base, "flocs-lta")
+
+
+def least_recently_used(
+    db: sqlite3.Connection, table: str, key: str, used: str, max_size: int
+) -> list:
+    """Select the least recently used rows to evict from a store over its budget.
+
+    Evicts down to 90% of the budget so that not every addition has to evict.
+
+    Args:
+        db (sqlite3.Connection): index of the store.
+        table (str): table with a row per stored item and its size in `size`.
+        key (str): column identifying the items.
+        used (str): column with the time an item was last used.
+        max_size (int): total size in bytes the store may take.
+
+    Returns:
+        keys (list): keys of the items to evict, least recently used first.
+    """
+    total = db.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+    if total <= max_size:
+        return []
+    excess = total - int(0.9 * max_size)
+    evicted = []
+    for item, size in db.execute(
+        f"SELECT {key}, size FROM {table} ORDER BY {used}"
+    ).fetchall():
+        if excess <= 0:
+            break
+        evicted.append(item)
+        excess -= size
+    return evicted
+
+
+class CacheMiss(LookupError):
+    pass
+
+
+class MetadataCache:
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        ttl: float = 30 * 86400,
+        max_size: int = 512 << 20,
+        refresh: bool = False,
+        offline: bool = False,
+    ):
+        """Initialise a MetadataCache object.
+
+        A persistent key-value store for LTA catalogue metadata, backed by SQLite.
+        Values are stored as JSON.
+
+        Args:
+            path (str): SQLite database to use, ":memory:" for a cache that only lives
+                as long as this object. Defaults to metadata.sqlite in the cache directory.
+            ttl (float): time in seconds after which an entry is considered stale.
+            max_size (int): size in bytes above which least recently used entries
+                are evicted.
+            refresh (bool): ignore cached entries, but still store new ones.
+            offline (bool): only answer from the cache, also with stale entries.
+        """
+        if path is None:
+            os.makedirs(default_cache_dir(), exist_ok=True)
+            path = os.path.join(default_cache_dir(), "metadata.sqlite")
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.refresh = refresh
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL, size INTEGER)"
+            )
+
+    def get(self, key: str) -> Any:
+        """Look up an entry.
+
+        Args:
+            key (str): key of the entry, e.g. "observation/<project>/<observationId>".
+
+        Returns:
+            value: the cached value, or None if it is missing, stale or refreshed.
+
+        Raises:
+            CacheMiss: when offline and the entry is not in the cache.
+        """
+        if self.refresh and not self.offline:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, created FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                with self._db:
+                    self._db.execute(
+                        "UPDATE entries SET accessed = ? WHERE key = ?", (now, key)
+                    )
+        if row is None:
+            if self.offline:
+                raise CacheMiss(f"{key} is not in the metadata cache.")
+            return None
+        value, created = row
+        if now - created > self.ttl and not self.offline:
+            return None
+        return json.loads(value)
+
+    def put(self, key: str, value: Any):
+        """Store an entry, evicting least recently used entries if the cache is full.
+
+        Args:
+            key (str): key of the entry.
+            value: JSON-serialisable value.
+        """
+        if self.offline:
+            return
+        data = json.dumps(value)
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, data, now, now, len(data)),
+            )
+            self._evict()
+
+    def _evict(self):
+        evicted = least_recently_used(
+            self._db, "entries", "key", "accessed", self.max_size
+        )
+        if not evicted:
+            return
+        self._db.executemany(
+            "DELETE FROM entries WHERE key = ?", [(key,) for key in evicted]
+        )
+        logger.info(f"Evicted {len(evicted)} entries from the metadata cache.")
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM entries")
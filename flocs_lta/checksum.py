@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+import base64
+import binascii
+import hashlib
+import json
+import zlib
+from typing import Optional
+
+ADLER_MOD = 65521
+
+
+class Checksum:
+    def __init__(self, md5: bool = True):
+        """Initialise a Checksum object.
+
+        Computes the Adler-32 and optionally MD5 checksum of data fed to it in pieces.
+
+        Args:
+            md5 (bool): also compute the MD5 checksum.
+        """
+        self.with_md5 = md5
+        self.reset()
+
+    def reset(self):
+        """Start over, e.g. when a download has to restart from the first byte."""
+        self.adler32 = 1
+        self.md5 = hashlib.md5() if self.with_md5 else None
+        self.nbytes = 0
+
+    def update(self, data: bytes):
+        self.adler32 = zlib.adler32(data, self.adler32)
+        if self.md5 is not None:
+            self.md5.update(data)
+        self.nbytes += len(data)
+
+    def hexdigests(self) -> dict[str, str]:
+        """Checksums computed so far, as lowercase hexadecimal strings."""
+        digests = {"adler32": f"{self.adler32:08x}"}
+        if self.md5 is not None:
+            digests["md5"] = self.md5.hexdigest()
+        return digests
+
+
+def adler32_combine(adler1: int, adler2: int, len2: int) -> int:
+    """Combine the Adler-32 checksums of two consecutive blocks of data.
+
+    Equivalent to zlib's adler32_combine, which Python does not expose.
+
+    Args:
+        adler1 (int): checksum of the first block.
+        adler2 (int): checksum of the second block.
+        len2 (int): length of the second block in bytes.
+
+    Returns:
+        adler32 (int): checksum of both blocks concatenated.
+    """
+    rem = len2 % ADLER_MOD
+    a1, b1 = adler1 & 0xFFFF, adler1 >> 16
+    a2, b2 = adler2 & 0xFFFF, adler2 >> 16
+    a = (a1 + a2 - 1) % ADLER_MOD
+    b = (b1 + b2 + rem * a1 - rem) % ADLER_MOD
+    return (b << 16) | a
+
+
+def parse_digest(header: Optional[str]) -> dict[str, str]:
+    """Parse an RFC 3230 Digest header, e.g. "adler32=03da0195,md5=HUXZLQLMuI/KZ5KDcJPcOA==".
+
+    Args:
+        header (str): value of the Digest header.
+
+    Returns:
+        digests (dict): lowercase hexadecimal checksum per lowercase algorithm name.
+    """
+    digests = {}
+    for item in (header or "").split(","):
+        algorithm, _, value = item.strip().partition("=")
+        algorithm = algorithm.lower()
+        if not value:
+            continue
+        if algorithm == "md5" and not _is_hex(value, 32):
+            try:
+                value = base64.b64decode(value, validate=True).hex()
+            except binascii.Error:
+                pass
+        digests[algorithm] = (
+            value.lower().zfill(8) if algorithm == "adler32" else value.lower()
+        )
+    return digests
+
+
+def compare(expected: dict[str, str], actual: dict[str, str]) -> Optional[bool]:
+    """Compare checksums for the algorithms both sides have.
+
+    Returns:
+        match (bool): whether all shared checksums match, or None if there are none.
+    """
+    shared = [algorithm for algorithm in actual if expected.get(algorithm)]
+    if not shared:
+        return None
+    return all(
+        expected[algorithm].lower().zfill(len(actual[algorithm])) == actual[algorithm]
+        for algorithm in shared
+    )
+
+
+def load_checksums(paths: list[str]) -> dict[str, dict]:
+    """Read catalogue checksums per file name from srms_*_checksums.json files.
+
+    Args:
+        paths (list): JSON files to read.
+
+    Returns:
+        checksums (dict): size and checksums per file name, from all files combined.
+    """
+    checksums = {}
+    for path in paths:
+        with open(path) as f:
+            checksums.update(json.load(f))
+    return checksums
+
+
+def _is_hex(value: str, length: int) -> bool:
+    return len(value) == length and all(c in "0123456789abcdefABCDEF" for c in value)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+import os
+import shutil
+import subprocess
+from typing import Optional
+
+import structlog
+
+logger = structlog.getLogger()
+
+
+def has_dysco(ms: str) -> bool:
+    """Check whether the DATA column of a MeasurementSet is Dysco compressed.
+
+    Args:
+        ms (str): path to the MeasurementSet.
+
+    Returns:
+        compressed (bool): True if DATA uses the Dysco storage manager.
+    """
+    import casacore.tables as ct
+
+    with ct.table(ms, ack=False) as tab:
+        desc = tab.getdesc()["DATA"]
+    return (desc["dataManagerGroup"] == "DyscoData") | (
+        desc["dataManagerType"] == "DyscoStMan"
+    )
+
+
+class DyscoCompressor:
+    def __init__(
+        self,
+        threads: int = 2,
+        dp3: Optional[str] = None,
+        container: Optional[str] = None,
+    ):
+        """Initialise a DyscoCompressor object.
+
+        Compresses MeasurementSets with DP3, either installed locally or inside the
+        LINC container from CWL_SINGULARITY_CACHE.
+
+        Args:
+            threads (int): number of threads DP3 may use per MeasurementSet.
+            dp3 (str): DP3 executable to use, e.g. a stub for testing. Defaults to
+                DP3 from the container or from PATH.
+            container (str): Apptainer image to run DP3 in. Defaults to the LINC
+                image in CWL_SINGULARITY_CACHE, if that is set and `dp3` is not given.
+        """
+        self.threads = threads
+        if container is None and dp3 is None and "CWL_SINGULARITY_CACHE" in os.environ:
+            container = os.path.join(
+                os.environ["CWL_SINGULARITY_CACHE"], "astronrd_linc_latest.sif"
+            )
+        self.container = container
+        self.dp3 = dp3 or "DP3"
+
+    @property
+    def available(self) -> bool:
+        """Whether DP3 can be run at all."""
+        if self.container:
+            return shutil.which("apptainer") is not None
+        return shutil.which(self.dp3) is not None
+
+    def command(self, msin: str, msout: str) -> list[str]:
+        """Build the DP3 command that copies `msin` to a Dysco compressed `msout`."""
+        command = [
+            self.dp3,
+            f"numthreads={self.threads}",
+            f"msin={msin}",
+            f"msout={msout}",
+            "msout.storagemanager=dysco",
+            "steps=[]",
+        ]
+        if self.container:
+            command = ["apptainer", "exec", self.container] + command
+        return command
+
+    def compress(self, ms: str, archive: Optional[str] = None):
+        """Compress a MeasurementSet in place.
+
+        The original is kept as `ms`.nodysco while DP3 runs and restored if DP3 fails.
+
+        Args:
+            ms (str): path to the MeasurementSet.
+            archive (str): tarball the MS came from, removed after compressing.
+
+        Raises:
+            RuntimeError: when DP3 is not available or fails.
+        """
+        if not self.available:
+            raise RuntimeError("DP3 is not available to compress with Dysco.")
+        logger.info(f"{ms} is not dysco compressed, compressing with DP3.")
+        original = ms + ".nodysco"
+        os.rename(ms, original)
+        process = subprocess.run(
+            self.command(original, ms),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        if process.returncode:
+            shutil.rmtree(ms, ignore_errors=True)
+            os.rename(original, ms)
+            raise RuntimeError(
+                f"DP3 failed with exit code {process.returncode}: "
+                f"{process.stderr.decode(errors='replace').strip()[-500:]}"
+            )
+        shutil.rmtree(original)
+        if archive and os.path.exists(archive):
+            os.remove(archive)
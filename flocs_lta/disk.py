@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+import asyncio
+import os
+from typing import Optional
+
+import structlog
+
+logger = structlog.getLogger()
+
+
+def free_space(path: str) -> int:
+    """Bytes available to unprivileged users on the filesystem holding `path`."""
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def footprint(
+    size: int, extract: bool = True, stream: bool = False, keep_archive: bool = False
+) -> int:
+    """Peak disk space a file is expected to need while it is processed.
+
+    Extracting needs the tarball and the MeasurementSet side by side, and Dysco
+    compression the original MeasurementSet next to the compressed one, so up to
+    three times the size of the tarball.
+
+    Args:
+        size (int): size of the tarball in bytes.
+        extract (bool): whether the tarball is extracted.
+        stream (bool): whether the tarball is extracted while downloading, without
+            writing it to disk.
+        keep_archive (bool): whether the tarball is kept when streaming.
+
+    Returns:
+        footprint (int): expected peak disk use in bytes.
+    """
+    if not extract:
+        return size
+    if stream and not keep_archive:
+        return 2 * size
+    return 3 * size
+
+
+class DiskBudget:
+    def __init__(self, path: str, min_free: int = 0, poll: float = 30.0):
+        """Initialise a DiskBudget object.
+
+        Admits files for processing only while the filesystem has room for what all
+        files in flight are still expected to write. Space already written by files
+        in flight is counted by statvfs as well as in their reservation until they
+        update it, so the budget errs on the safe side.
+
+        Must be created and used in the event loop that runs the downloads.
+
+        Args:
+            path (str): directory the files are written to.
+            min_free (int): bytes to always leave free.
+            poll (float): seconds between checks of the free space while waiting,
+                as other processes may free space too.
+        """
+        self.path = path
+        self.min_free = min_free
+        self.poll = poll
+        self.pending: dict[str, int] = {}
+        self.largest = 0
+        self._condition = asyncio.Condition()
+
+    def available(self) -> int:
+        """Bytes that can still be reserved."""
+        return free_space(self.path) - self.min_free - sum(self.pending.values())
+
+    def estimate(self, size: Optional[int]) -> int:
+        """Size to plan with for a file, the largest seen so far if it is unknown."""
+        if size is None:
+            return self.largest
+        self.largest = max(self.largest, size)
+        return size
+
+    async def admit(self, url: str, need: int) -> bool:
+        """Wait until there is room for a file and reserve it.
+
+        Args:
+            url (str): URL of the file.
+            need (int): bytes the file is expected to write.
+
+        Returns:
+            admitted (bool): False if there is no room even though no other file is
+                in flight, so that waiting will not help.
+        """
+        async with self._condition:
+            waiting = False
+            while need > self.available():
+                if not self.pending:
+                    logger.error(
+                        f"Not enough disk space in {self.path} for {url}: need "
+                        f"{need / 1e9:.2f} GB, {self.available() / 1e9:.2f} GB available."
+                    )
+                    return False
+                if not waiting:
+                    logger.info(
+                        f"Waiting for disk space in {self.path} for {url} "
+                        f"({need / 1e9:.2f} GB)."
+                    )
+                    waiting = True
+                try:
+                    await asyncio.wait_for(self._condition.wait(), self.poll)
+                except asyncio.TimeoutError:
+                    pass
+            self.pending[url] = need
+            return True
+
+    async def update(self, url: str, need: int):
+        """Change the bytes a file in flight is still expected to write."""
+        async with self._condition:
+            self.pending[url] = max(0, need)
+            self._condition.notify_all()
+
+    async def release(self, url: str):
+        """Drop the reservation of a file that is done."""
+        async with self._condition:
+            self.pending.pop(url, None)
+            self._condition.notify_all()
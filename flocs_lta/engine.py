@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+import asyncio
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import AsyncIterable, Callable, Iterable, Optional, Union
+
+import structlog
+
+from .compress import DyscoCompressor
+from .disk import DiskBudget, footprint
+from .lta_download import (
+    Downloader,
+    LTASite,
+    VerificationLevel,
+    ms_path,
+    process_download,
+    record_timings,
+    site_from_url,
+)
+from .metrics import metrics
+from .state import DownloadStage, DownloadState
+from .webdav import DownloadResult, RateLimiter
+
+logger = structlog.getLogger()
+
+
+class DownloadEngine:
+    def __init__(
+        self,
+        downloader: Downloader,
+        max_per_site: int = 1,
+        site_limits: Optional[dict] = None,
+        bandwidth: Optional[float] = None,
+        post_workers: int = 1,
+        compressor: Optional[DyscoCompressor] = None,
+        compress_workers: int = 1,
+        min_free_space: Optional[int] = 0,
+    ):
+        """Initialise a DownloadEngine object.
+
+        Schedules transfers with asyncio in a single process. Each LTA site has its
+        own concurrency limit. Extraction and verification run in a separate bounded
+        pool of worker processes, and Dysco compression in a third stage with its own
+        queue, so neither holds up network transfers. Progress is recorded in a
+        DownloadState, by default in the output directory, so a restarted run skips
+        the stages that already completed.
+
+        New transfers are only started while the output directory has room for
+        what the files in flight are still expected to write, see `DiskBudget`.
+        Tarballs are removed as soon as they are extracted.
+
+        Args:
+            downloader (Downloader): downloader providing the per-site sessions.
+            max_per_site (int): default maximum number of concurrent transfers per site.
+            site_limits (dict): maximum number of concurrent transfers for specific
+                LTASites, overriding `max_per_site`.
+            bandwidth (float): total bandwidth cap in bytes per second.
+            post_workers (int): number of processes extracting and verifying tarballs.
+            compressor (DyscoCompressor): compresses MeasurementSets that are not
+                Dysco compressed yet.
+            compress_workers (int): number of MeasurementSets compressed at once.
+            min_free_space (int): bytes to leave free in the output directory, on
+                top of the space files in flight are expected to need. None disables
+                the disk space checks.
+        """
+        self.downloader = downloader
+        self.limits = {site: max_per_site for site in LTASite}
+        self.limits.update(site_limits or {})
+        self.post_workers = post_workers
+        self.compressor = compressor or DyscoCompressor()
+        self.compress_workers = compress_workers
+        self.min_free_space = min_free_space
+        if bandwidth:
+            downloader.rate_limiter = RateLimiter(bandwidth)
+
+    def run(
+        self,
+        urls: Union[Iterable, AsyncIterable],
+        on_result: Optional[Callable[[DownloadResult], None]] = None,
+        **options,
+    ) -> list[DownloadResult]:
+        """Download the given URLs.
+
+        Args:
+            urls (Iterable or AsyncIterable): URLs to download. URLs from an
+                asynchronous iterable, e.g. `StagingPoller.online_urls`, start
+                downloading as soon as they arrive.
+            on_result (Callable): called in the event loop with the result of every
+                URL as soon as it is done, e.g. `Ledger.complete`.
+            **options: options passed on to `Downloader.fetch` and `process_download`,
+                and `state_path`, a DownloadState database to use instead of the one
+                in `outdir`.
+
+        Returns:
+            results (list): a DownloadResult for every URL.
+        """
+        if not isinstance(urls, AsyncIterable):
+            urls = list(urls)
+        results = asyncio.run(self._run(urls, on_result=on_result, **options))
+        self.summarise(results)
+        return results
+
+    async def _run(
+        self,
+        urls: Union[list[str], AsyncIterable],
+        extract: bool = True,
+        verification: str = "basic",
+        outdir: str = os.getcwd(),
+        stream: bool = False,
+        keep_archive: bool = False,
+        segments: int = 1,
+        extract_threads: int = 4,
+        on_result: Optional[Callable[[DownloadResult], None]] = None,
+        state_path: Optional[str] = None,
+    ) -> list[DownloadResult]:
+        semaphores = {
+            site: asyncio.Semaphore(limit) for site, limit in self.limits.items()
+        }
+        fetch = partial(
+            self.downloader.fetch,
+            extract=extract,
+            outdir=outdir,
+            stream=stream,
+            keep_archive=keep_archive,
+            segments=segments,
+            checksum=verification == VerificationLevel.CHECKSUM.value,
+        )
+        postprocess = partial(
+            process_download,
+            extract=extract,
+            verification=verification,
+            threads=extract_threads,
+            keep_archive=stream and keep_archive,
+        )
+        io_pool = ThreadPoolExecutor(max_workers=sum(self.limits.values()))
+        # Forked workers would inherit locks held by the I/O threads, such as the
+        # one of the log output, and could block on them forever.
+        post_pool = ProcessPoolExecutor(
+            max_workers=self.post_workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+        # DP3 runs as a subprocess, so threads are enough to drive it.
+        compress_pool = ThreadPoolExecutor(max_workers=self.compress_workers)
+        state = (
+            DownloadState(*os.path.split(state_path))
+            if state_path
+            else DownloadState(outdir)
+        )
+        if isinstance(urls, list):
+            state.queue(urls)
+        budget = (
+            DiskBudget(outdir, self.min_free_space)
+            if self.min_free_space is not None
+            else None
+        )
+        download = partial(
+            self._download,
+            semaphores=semaphores,
+            fetch=fetch,
+            postprocess=postprocess,
+            io_pool=io_pool,
+            post_pool=post_pool,
+            compress_pool=compress_pool,
+            state=state,
+            outdir=outdir,
+            extract=extract,
+            stream=stream,
+            keep_archive=keep_archive,
+            budget=budget,
+            on_result=on_result,
+        )
+        with io_pool, post_pool, compress_pool:
+            if isinstance(urls, list):
+                results = await asyncio.gather(*[download(url) for url in urls])
+            else:
+                # A URL is only skipped while it is in progress, so that one that
+                # failed can come again to be retried, e.g. from a Ledger.
+                in_progress = set()
+
+                def finished(result: DownloadResult):
+                    in_progress.discard(result.url)
+                    if on_result is not None:
+                        on_result(result)
+
+                tasks = []
+                async for url in urls:
+                    if url not in in_progress:
+                        in_progress.add(url)
+                        state.queue([url])
+                        tasks.append(
+                            asyncio.create_task(download(url, on_result=finished))
+                        )
+                # The last attempt of every URL.
+                results = list(
+                    {
+                        result.url: result for result in await asyncio.gather(*tasks)
+                    }.values()
+                )
+        logger.info(f"Download state in {state.path}: {state.summary()}")
+        state.close()
+        return results
+
+    async def _download(
+        self,
+        url: str,
+        semaphores: dict[LTASite, asyncio.Semaphore],
+        fetch: partial,
+        postprocess: partial,
+        io_pool: Executor,
+        post_pool: Executor,
+        compress_pool: Executor,
+        state: DownloadState,
+        outdir: str,
+        extract: bool,
+        stream: bool,
+        keep_archive: bool,
+        budget: Optional[DiskBudget],
+        on_result: Optional[Callable[[DownloadResult], None]],
+    ) -> DownloadResult:
+        try:
+            result = await self._process(
+                url,
+                semaphores,
+                fetch,
+                postprocess,
+                io_pool,
+                post_pool,
+                compress_pool,
+                state,
+                outdir,
+                extract,
+                stream,
+                keep_archive,
+                budget,
+            )
+        finally:
+            if budget is not None:
+                await budget.release(url)
+        if on_result is not None:
+            on_result(result)
+        return result
+
+    async def _process(
+        self,
+        url: str,
+        semaphores: dict[LTASite, asyncio.Semaphore],
+        fetch: partial,
+        postprocess: partial,
+        io_pool: Executor,
+        post_pool: Executor,
+        compress_pool: Executor,
+        state: DownloadState,
+        outdir: str,
+        extract: bool,
+        stream: bool,
+        keep_archive: bool,
+        budget: Optional[DiskBudget],
+    ) -> DownloadResult:
+        loop = asyncio.get_running_loop()
+        try:
+            site = site_from_url(url)
+        except RuntimeError as e:
+            return DownloadResult(url, "", "failed", error=str(e))
+        archive = self.downloader.output_path(url, outdir)
+        ms = ms_path(archive)
+        final = DownloadStage.VERIFIED if extract else DownloadStage.DOWNLOADED
+        stage = state.stage(url)
+        if stage.reached(final):
+            return DownloadResult(url, ms if extract else archive, "skipped")
+        if stage in (DownloadStage.DOWNLOADING, DownloadStage.DOWNLOADED):
+            # A previous run stopped while extracting; never trust a partial MS.
+            if os.path.isdir(ms):
+                logger.info(f"Removing partially extracted {ms}.")
+                await loop.run_in_executor(
+                    io_pool, partial(shutil.rmtree, ms, ignore_errors=True)
+                )
+        if stage.reached(DownloadStage.EXTRACTED) and os.path.isdir(ms):
+            logger.info(f"{url} was extracted in a previous run, continuing.")
+            result = DownloadResult(url, archive, "downloaded")
+            # Only compression may still need space, about the size of the tarball.
+            size = os.path.getsize(archive) if os.path.exists(archive) else None
+            if not await self._admit(url, budget, size, lambda size: size):
+                return self._no_space(url, state)
+        elif stage.reached(DownloadStage.DOWNLOADED) and os.path.exists(archive):
+            logger.info(f"{url} was downloaded in a previous run, continuing.")
+            result = DownloadResult(url, archive, "downloaded")
+            size = os.path.getsize(archive)
+            if not await self._admit(url, budget, size, lambda size: 2 * size):
+                return self._no_space(url, state)
+        elif os.path.isdir(ms):
+            # Not written by a run recorded in this state, e.g. extracted by hand;
+            # left alone, and not recorded, so that no later run removes it.
+            print(f"{ms} already exists.")
+            return DownloadResult(url, ms, "skipped")
+        else:
+            async with semaphores[site]:
+                size = None
+                if budget is not None:
+                    size = await loop.run_in_executor(
+                        io_pool, self.downloader.expected_size, url
+                    )
+                if not await self._admit(
+                    url,
+                    budget,
+                    size,
+                    partial(
+                        footprint,
+                        extract=extract,
+                        stream=stream,
+                        keep_archive=keep_archive,
+                    ),
+                ):
+                    return self._no_space(url, state)
+                part = archive + ".part"
+                state.update(
+                    url,
+                    DownloadStage.DOWNLOADING,
+                    path=archive,
+                    offset=os.path.getsize(part) if os.path.exists(part) else 0,
+                )
+                try:
+                    result = await loop.run_in_executor(io_pool, fetch, url)
+                except Exception as e:
+                    result = DownloadResult(
+                        url, "", "failed", error=f"{type(e).__name__}: {e}"
+                    )
+            if result.status != "downloaded":
+                if result.error:
+                    state.fail(url, result.error)
+                return result
+            state.update(
+                url,
+                DownloadStage.EXTRACTED
+                if extract and stream
+                else DownloadStage.DOWNLOADED,
+                nbytes=result.nbytes,
+            )
+            if not extract:
+                return result
+            size = result.nbytes
+            if budget is not None:
+                # What was written is on disk now, counted by statvfs instead.
+                written = 2 * size if stream and keep_archive else size
+                await budget.update(url, budget.pending.get(url, 0) - written)
+        try:
+            result = await loop.run_in_executor(post_pool, postprocess, result)
+        except Exception as e:
+            result.status = "failed"
+            result.error = f"Post-processing failed: {type(e).__name__}: {e}"
+        record_timings(result)
+        self.downloader.report_ms(outdir, result)
+        if not result.ok:
+            state.fail(url, result.error)
+            return result
+        state.update(url, DownloadStage.EXTRACTED)
+        if result.dysco is not None and not stream:
+            # The MS checked out, so the tarball is not needed to resume anymore.
+            if os.path.exists(archive):
+                await loop.run_in_executor(io_pool, os.remove, archive)
+        if budget is not None:
+            await budget.update(
+                url, budget.estimate(size or None) if result.dysco is False else 0
+            )
+        if result.dysco is False:
+            if not self.compressor.available:
+                logger.warning(
+                    f"DP3 not available, leaving {result.path} uncompressed."
+                )
+                state.fail(url, "DP3 not available to compress with Dysco.")
+                return result
+            try:
+                await loop.run_in_executor(
+                    compress_pool,
+                    self._compress,
+                    url,
+                    result.path,
+                    stream and keep_archive,
+                )
+                result.dysco = True
+            except Exception as e:
+                result.status = "failed"
+                result.error = f"Compression failed: {type(e).__name__}: {e}"
+                state.fail(url, result.error)
+                return result
+        if result.dysco is None:
+            # The MeasurementSet could not be checked; try again on the next run.
+            state.fail(url, "Verification of the MeasurementSet failed.")
+            return result
+        state.update(url, DownloadStage.COMPRESSED)
+        state.update(url, DownloadStage.VERIFIED)
+        return result
+
+    async def _admit(
+        self,
+        url: str,
+        budget: Optional[DiskBudget],
+        size: Optional[int],
+        need: Callable[[int], int],
+    ) -> bool:
+        """Reserve the space a file needs, given the size of its tarball."""
+        if budget is None:
+            return True
+        return await budget.admit(url, need(budget.estimate(size)))
+
+    @staticmethod
+    def _no_space(url: str, state: DownloadState) -> DownloadResult:
+        result = DownloadResult(url, "", "failed", error="Not enough disk space.")
+        state.fail(url, result.error)
+        return result
+
+    def _compress(self, url: str, archive: str, keep_archive: bool = False):
+        # Timed on the worker thread, so time spent waiting in the queue is excluded.
+        with metrics.stage("compress", url=url):
+            self.compressor.compress(
+                ms_path(archive), None if keep_archive else archive
+            )
+
+    @staticmethod
+    def summarise(results: list[DownloadResult]):
+        """Log a summary of download results per LTA site and list the failures."""
+        per_site: dict[str, dict] = {}
+        for result in results:
+            try:
+                site = site_from_url(result.url).value
+            except RuntimeError:
+                site = "unknown"
+            summary = per_site.setdefault(
+                site,
+                {"downloaded": 0, "skipped": 0, "failed": 0, "bytes": 0, "time": 0.0},
+            )
+            summary[result.status] += 1
+            if not result.mirrored:
+                summary["bytes"] += result.nbytes
+                summary["time"] += result.elapsed
+        for site, summary in sorted(per_site.items()):
+            rate = summary["bytes"] / summary["time"] / 1e6 if summary["time"] else 0.0
+            logger.info(
+                f"{site}: {summary['downloaded']} downloaded, {summary['skipped']} skipped, "
+                f"{summary['failed']} failed, {summary['bytes'] / 1e9:.2f} GB "
+                f"at {rate:.1f} MB/s per transfer."
+            )
+        mirrored = [result for result in results if result.mirrored]
+        if mirrored:
+            logger.info(
+                f"{len(mirrored)} files came from the local mirror, "
+                f"{sum(result.nbytes for result in mirrored) / 1e9:.2f} GB not transferred."
+            )
+        failed = [result for result in results if result.status == "failed"]
+        logger.info(
+            f"Downloaded {len(results) - len(failed)} of {len(results)} files, {len(failed)} failed."
+        )
+        for result in failed:
+            logger.error(f"{result.url}: {result.error}")
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+import errno
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+import structlog
+
+logger = structlog.getLogger()
+
+# Errors meaning a zero-copy system call cannot be used for this pair of files.
+_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP}
+
+
+def is_uncompressed(archive: str) -> bool:
+    """Check whether a tarball is a plain tar file, so members can be copied directly."""
+    try:
+        with tarfile.open(archive, "r:"):
+            return True
+    except tarfile.ReadError:
+        return False
+
+
+def extract_tarball(archive: str, outdir: str, threads: int = 4) -> int:
+    """Extract a tarball, writing its member files in parallel.
+
+    The tar index is read once, after which directories are created and regular
+    files are copied out of the archive concurrently, largest first. Output files
+    are preallocated and filled with copy_file_range or sendfile where the kernel
+    supports it, or with large buffered reads otherwise. Compressed tarballs and
+    tarballs with sparse members are extracted with tarfile instead.
+
+    Args:
+        archive (str): tarball to extract.
+        outdir (str): directory to extract the tarball in.
+        threads (int): number of files written at the same time.
+
+    Returns:
+        nbytes (int): number of bytes of file data extracted.
+
+    Raises:
+        tarfile.TarError: when the archive is invalid or a member would be
+            written outside `outdir`.
+    """
+    if not is_uncompressed(archive):
+        with tarfile.open(archive, "r") as tarball:
+            tarball.extractall(path=outdir)
+            return sum(
+                member.size for member in tarball.getmembers() if member.isfile()
+            )
+    with tarfile.open(archive, "r:") as tarball:
+        members = tarball.getmembers()
+        if any(member.issparse() for member in members):
+            tarball.extractall(path=outdir)
+            return sum(member.size for member in members if member.isfile())
+    root = os.path.realpath(outdir)
+    for member in members:
+        target = os.path.realpath(os.path.join(root, member.name))
+        if os.path.commonpath([root, target]) != root:
+            raise tarfile.TarError(f"{member.name} would be extracted outside {outdir}")
+    directories = [member for member in members if member.isdir()]
+    files = sorted(
+        (member for member in members if member.isfile()),
+        key=lambda member: member.size,
+        reverse=True,
+    )
+    for member in directories:
+        os.makedirs(os.path.join(outdir, member.name), exist_ok=True)
+    for member in files:
+        os.makedirs(os.path.dirname(os.path.join(outdir, member.name)), exist_ok=True)
+    src = os.open(archive, os.O_RDONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as tex:
+            nbytes = sum(
+                tex.map(lambda member: _extract_file(src, member, outdir), files)
+            )
+    finally:
+        os.close(src)
+    others = [
+        member for member in members if not member.isdir() and not member.isfile()
+    ]
+    if others:
+        # Links and special files are rare in MeasurementSets; tarfile handles them.
+        with tarfile.open(archive, "r:") as tarball:
+            tarball.extractall(path=outdir, members=others)
+    # Set directory times last, as writing their contents changes them.
+    for member in sorted(directories, key=lambda member: member.name, reverse=True):
+        path = os.path.join(outdir, member.name)
+        os.chmod(path, member.mode | 0o700)
+        os.utime(path, (member.mtime, member.mtime))
+    return nbytes
+
+
+def _extract_file(src: int, member: tarfile.TarInfo, outdir: str) -> int:
+    """Copy one regular file out of the archive into a preallocated output file."""
+    path = os.path.join(outdir, member.name)
+    dst = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        if member.size:
+            try:
+                os.posix_fallocate(dst, 0, member.size)
+            except (AttributeError, OSError):
+                pass
+        _copy_range(src, dst, member.offset_data, member.size)
+        os.fchmod(dst, member.mode)
+    finally:
+        os.close(dst)
+    os.utime(path, (member.mtime, member.mtime))
+    return member.size
+
+
+def _copy_range(src: int, dst: int, offset: int, size: int, bufsize: int = 8 << 20):
+    """Copy `size` bytes from `offset` in `src` to the start of `dst`."""
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                n = os.copy_file_range(src, dst, size - copied, offset + copied, copied)
+                if not n:
+                    break
+                copied += n
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    if copied < size and hasattr(os, "sendfile"):
+        try:
+            os.lseek(dst, copied, os.SEEK_SET)
+            while copied < size:
+                n = os.sendfile(dst, src, offset + copied, size - copied)
+                if not n:
+                    break
+                copied += n
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    while copied < size:
+        data = os.pread(src, min(bufsize, size - copied), offset + copied)
+        if not data:
+            break
+        copied += os.pwrite(dst, data, copied)
+    if copied != size:
+        raise tarfile.ReadError(f"Unexpected end of archive in {size}-byte member.")
@@ -1,43 +1,160 @@
 #!/usr/bin/env python
 import os
+import sys
+import time
 from typing import Optional
 
 import cyclopts
 import structlog
 from cyclopts import Parameter
-from stager_access import get_macaroons, get_webdav_urls_requested
 from typing import Iterable, Literal
 from typing_extensions import Annotated
 
-from .lta_download import Downloader
-from .lta_search import ObservationStager
+from .cache import CacheMiss, MetadataCache
+from .checksum import load_checksums
+from .ledger import Ledger
+from .lta_download import Downloader, LTASite, merge_macaroons
+from .metrics import metrics
+from .mirror import Mirror
+from .plan import ThroughputHistory
+
+# stager_access, awlofar and astropy take seconds to import, so the modules that need
+# them are imported by the commands that use them. Downloading never loads them,
+# except stager_access to look up the staging request.
 
 app = cyclopts.App()
 
 logger = structlog.getLogger()
 
 
+def parse_site_limits(limits: list[str]) -> dict[LTASite, int]:
+    """Parse per-site limits given as `Site=N`, with site names as in LTASite."""
+    sites = {site.value.lower(): site for site in LTASite}
+    parsed = {}
+    for limit in limits:
+        name, _, value = limit.partition("=")
+        if name.lower() not in sites or not value.isdigit():
+            raise ValueError(f"Invalid site limit {limit}, expected e.g. SURF=4.")
+        parsed[sites[name.lower()]] = int(value)
+    return parsed
+
+
 @app.command
 def download(
     stage_id: Annotated[str, Parameter(help="StageIt staging ID.")],
     parallel_downloads: Annotated[
-        Optional[int], Parameter(help="Maximum number of parallel downloads.")
+        Optional[int],
+        Parameter(help="Maximum number of parallel downloads per LTA site."),
     ] = 1,
     extract: Annotated[
         Optional[bool], Parameter(help="Extract the tarball after downloading.")
     ] = True,
     verification: Annotated[
-        Optional[str],
+        Literal["basic", "checksum", "deep"],
         Parameter(
-            help="Only used when `extract` is True. Sets the verification level to perform after extracting the tarball."
+            help="Only used when `extract` is True. Sets the verification level to perform after extracting the tarball: `basic` checks the MeasurementSet, `checksum` also verifies checksums while downloading, `deep` also reads samples of DATA, FLAG and UVW and checks all subtables, in about a tenth of the download time."
         ),
     ] = "basic",
     outdir: Annotated[
         Optional[str],
         Parameter(help="Directory to store downloaded dataproducts in."),
     ] = os.getcwd(),
+    stream: Annotated[
+        Optional[bool],
+        Parameter(
+            help="Only used when `extract` is True. Extract tarballs while they are downloading, without writing them to disk first."
+        ),
+    ] = False,
+    keep_archive: Annotated[
+        Optional[bool],
+        Parameter(help="Only used when `stream` is True. Keep a copy of the tarball."),
+    ] = False,
+    segments: Annotated[
+        Optional[int],
+        Parameter(
+            help="Split large files in up to this many byte ranges that are downloaded in parallel."
+        ),
+    ] = 1,
+    site_limit: Annotated[
+        Optional[list[str]],
+        Parameter(
+            help="Maximum number of parallel downloads for a specific site, e.g. `SURF=8`. Overrides `parallel_downloads` for that site."
+        ),
+    ] = None,
+    bandwidth: Annotated[
+        Optional[float],
+        Parameter(help="Total bandwidth cap in MB/s."),
+    ] = None,
+    post_workers: Annotated[
+        Optional[int],
+        Parameter(help="Number of processes extracting and verifying downloads."),
+    ] = 1,
+    compress_workers: Annotated[
+        Optional[int],
+        Parameter(
+            help="Number of MeasurementSets to compress with Dysco at the same time."
+        ),
+    ] = 1,
+    compress_threads: Annotated[
+        Optional[int],
+        Parameter(
+            help="Number of DP3 threads per compression. Defaults to the number of cores divided by `compress_workers`."
+        ),
+    ] = None,
+    dp3: Annotated[
+        Optional[str],
+        Parameter(help="DP3 executable to compress with instead of the default."),
+    ] = None,
+    extract_threads: Annotated[
+        Optional[int],
+        Parameter(
+            help="Number of files to write at the same time when extracting a tarball."
+        ),
+    ] = 4,
+    checksums: Annotated[
+        Optional[list[str]],
+        Parameter(
+            help="srms_*_checksums.json files written by the search commands, with the catalogue checksums to verify against. Without them, checksums reported by the server are used."
+        ),
+    ] = None,
+    min_free_space: Annotated[
+        Optional[float],
+        Parameter(
+            help="Free space in GB to leave in `outdir`, on top of the space downloads in progress are expected to need: about three times the tarball size when extracting. New downloads wait until there is room."
+        ),
+    ] = 10.0,
+    disk_check: Annotated[
+        bool,
+        Parameter(help="Check free disk space before starting downloads."),
+    ] = True,
+    mirror: Annotated[
+        Optional[str],
+        Parameter(
+            help="Directory of a local mirror shared between runs. Tarballs in it are linked into `outdir` instead of downloaded again, and downloaded tarballs are added to it."
+        ),
+    ] = None,
+    mirror_size: Annotated[
+        float,
+        Parameter(
+            help="Size in TB of the local mirror, beyond which least recently used tarballs are evicted."
+        ),
+    ] = 2.0,
+    worker: Annotated[
+        bool,
+        Parameter(
+            help="Share the downloads with other `flocs-lta download --worker` processes, e.g. on other nodes, using the same `outdir` on a shared filesystem. Every file is downloaded by one of them."
+        ),
+    ] = False,
+    lease: Annotated[
+        float,
+        Parameter(
+            help="Only used with `worker`. Minutes after which files claimed by a worker that stopped responding are downloaded by another."
+        ),
+    ] = 10.0,
 ):
     """Download data from the LTA that was staged via the StageIt service."""
+    from stager_access import get_macaroons, get_webdav_urls_requested
+
     urls: Optional[Iterable] = get_webdav_urls_requested(stage_id)
     if not urls:
         logger.info("No URLs to download.")
@@ -45,15 +162,177 @@ def download(
     macaroons: Optional[list[dict]] = get_macaroons(stage_id)
     if not macaroons:
         raise RuntimeError("No macaroons obtained.")
-    else:
-        for macaroon in macaroons:
-            dl = Downloader(urls, macaroon)
-            dl.download_all(
-                parallel_downloads,
-                extract=extract,
-                verification=verification,
-                outdir=outdir,
-            )
+    start = time.perf_counter()
+    dl = Downloader(
+        urls,
+        merge_macaroons(macaroons),
+        checksums=load_checksums(checksums or []),
+        mirror=Mirror(mirror, int(mirror_size * 1e12)) if mirror else None,
+    )
+    results = dl.download_all(
+        parallel_downloads,
+        extract=extract,
+        verification=verification,
+        outdir=outdir,
+        stream=stream,
+        keep_archive=keep_archive,
+        segments=segments,
+        site_limits=parse_site_limits(site_limit or []),
+        bandwidth=bandwidth * 1e6 if bandwidth else None,
+        post_workers=post_workers,
+        compress_workers=compress_workers,
+        compress_threads=compress_threads,
+        dp3=dp3,
+        extract_threads=extract_threads,
+        min_free_space=int((min_free_space or 0) * 1e9) if disk_check else None,
+        ledger=Ledger(outdir, lease=lease * 60) if worker else None,
+    )
+    # The throughput per site is used to estimate transfer times when planning.
+    ThroughputHistory().record_run(results, time.perf_counter() - start)
+
+
+@app.command
+def stage_and_fetch(
+    srm_list: Annotated[
+        str,
+        Parameter(
+            help="Text file with a SURL per line, e.g. srms_<obsid>.txt written by the search commands."
+        ),
+    ],
+    stage_id: Annotated[
+        Optional[int],
+        Parameter(
+            help="Follow this existing staging request instead of submitting a new one."
+        ),
+    ] = None,
+    parallel_downloads: Annotated[
+        int,
+        Parameter(help="Maximum number of parallel downloads per LTA site."),
+    ] = 1,
+    extract: Annotated[
+        bool, Parameter(help="Extract the tarball after downloading.")
+    ] = True,
+    verification: Annotated[
+        Literal["basic", "checksum", "deep"],
+        Parameter(
+            help="Only used when `extract` is True. Sets the verification level to perform after extracting the tarball: `basic` checks the MeasurementSet, `checksum` also verifies checksums while downloading, `deep` also reads samples of DATA, FLAG and UVW and checks all subtables, in about a tenth of the download time."
+        ),
+    ] = "basic",
+    outdir: Annotated[
+        str,
+        Parameter(help="Directory to store downloaded dataproducts in."),
+    ] = os.getcwd(),
+    stream: Annotated[
+        bool,
+        Parameter(
+            help="Only used when `extract` is True. Extract tarballs while they are downloading, without writing them to disk first."
+        ),
+    ] = False,
+    segments: Annotated[
+        int,
+        Parameter(
+            help="Split large files in up to this many byte ranges that are downloaded in parallel."
+        ),
+    ] = 1,
+    post_workers: Annotated[
+        int,
+        Parameter(help="Number of processes extracting and verifying downloads."),
+    ] = 1,
+    compress_workers: Annotated[
+        int,
+        Parameter(
+            help="Number of MeasurementSets to compress with Dysco at the same time."
+        ),
+    ] = 1,
+    min_free_space: Annotated[
+        Optional[float],
+        Parameter(
+            help="Free space in GB to leave in `outdir`, on top of the space downloads in progress are expected to need."
+        ),
+    ] = 10.0,
+    disk_check: Annotated[
+        bool,
+        Parameter(help="Check free disk space before starting downloads."),
+    ] = True,
+    mirror: Annotated[
+        Optional[str],
+        Parameter(
+            help="Directory of a local mirror shared between runs. Tarballs in it are linked into `outdir` instead of downloaded again, and downloaded tarballs are added to it."
+        ),
+    ] = None,
+    mirror_size: Annotated[
+        float,
+        Parameter(
+            help="Size in TB of the local mirror, beyond which least recently used tarballs are evicted."
+        ),
+    ] = 2.0,
+    poll_interval: Annotated[
+        float,
+        Parameter(
+            help="Shortest time in seconds between staging status checks, used while files keep coming online."
+        ),
+    ] = 30.0,
+    max_poll_interval: Annotated[
+        float,
+        Parameter(
+            help="Longest time in seconds between staging status checks, backed off to while nothing changes."
+        ),
+    ] = 600.0,
+    timeout: Annotated[
+        Optional[float],
+        Parameter(help="Stop waiting for files to come online after this many hours."),
+    ] = None,
+):
+    """Stage data and download every file as soon as it is online.
+
+    Tape recall and transfers overlap, instead of waiting for the whole staging
+    request to complete before downloading. Checksums are taken from the
+    _checksums.json file next to `srm_list`, if it exists.
+    """
+    from stager_access import stage
+
+    from .staging import StagingPoller
+
+    with open(srm_list) as f:
+        surls = [line.strip() for line in f if line.strip()]
+    if stage_id is None:
+        stage_id = stage(surls)
+        logger.info(f"Staging request submitted with staging ID {stage_id}")
+    checksum_file = os.path.splitext(srm_list)[0] + "_checksums.json"
+    dl = Downloader(
+        [],
+        {},
+        checksums=load_checksums(
+            [checksum_file] if os.path.exists(checksum_file) else []
+        ),
+        mirror=Mirror(mirror, int(mirror_size * 1e12)) if mirror else None,
+    )
+    poller = StagingPoller(
+        stage_id,
+        dl,
+        min_interval=poll_interval,
+        max_interval=max_poll_interval,
+        timeout=timeout * 3600 if timeout else None,
+    )
+    results = dl.download_all(
+        parallel_downloads,
+        extract=extract,
+        verification=verification,
+        outdir=outdir,
+        stream=stream,
+        segments=segments,
+        post_workers=post_workers,
+        compress_workers=compress_workers,
+        min_free_space=int((min_free_space or 0) * 1e9) if disk_check else None,
+        online=poller.online_urls(),
+    )
+    # Waiting for tape recalls is part of the run time, so the throughput is not
+    # recorded for planning.
+    failed = sum(result.status == "failed" for result in results)
+    logger.info(
+        f"Staging request {stage_id} ended with status {poller.status}: "
+        f"{len(results) - failed} of {len(surls)} files downloaded."
+    )
 
 
 @app.command
@@ -100,23 +379,58 @@ def search_id(
         int,
         Parameter(help="Number of nearest calibrators to search for."),
     ] = 2,
+    refresh: Annotated[
+        bool,
+        Parameter(help="Query the LTA again instead of using cached metadata."),
+    ] = False,
+    offline: Annotated[
+        bool,
+        Parameter(help="Only use cached metadata, without connecting to the LTA."),
+    ] = False,
+    dry_run: Annotated[
+        bool,
+        Parameter(
+            help="Only plan staging the products in `stage_products`, both if none are given: report the volume per site and the expected transfer time, without submitting staging requests."
+        ),
+    ] = False,
+    max_request_size: Annotated[
+        Optional[float],
+        Parameter(help="Split staging into StageIt requests of at most this many TB."),
+    ] = None,
+    max_stage_volume: Annotated[
+        Optional[float],
+        Parameter(
+            help="Stage at most this many TB in total. Files beyond it are listed as deferred in the staging plan."
+        ),
+    ] = None,
 ):
+    from .lta_search import ObservationStager
+
+    if dry_run and stage_products == "none":
+        stage_products = "both"
     if stage_products != "none":
         get_surls = True
-
-    stager = ObservationStager(get_surls=get_surls)
-    stager.find_observation_by_sasid(
-        project,
-        sasid,
-        sapi,
-        freq_start,
-        freq_end,
+    staging = dict(
+        max_request_size=max_request_size * 1e12 if max_request_size else None,
+        max_volume=max_stage_volume * 1e12 if max_stage_volume else None,
+        dry_run=dry_run,
     )
-    stager.find_nearest_calibrators(n_calibrators, freq_start, freq_end)
-    if (stage_products == "calibrator") or (stage_products == "both"):
-        stager.stage_calibrators()
-    if (stage_products == "target") or (stage_products == "both"):
-        stager.stage_target()
+
+    with ObservationStager(
+        get_surls=get_surls, cache=MetadataCache(refresh=refresh, offline=offline)
+    ) as stager:
+        stager.find_observation_by_sasid(
+            project,
+            sasid,
+            sapi,
+            freq_start,
+            freq_end,
+        )
+        stager.find_nearest_calibrators(n_calibrators, freq_start, freq_end)
+        if (stage_products == "calibrator") or (stage_products == "both"):
+            stager.stage_calibrators(**staging)
+        if (stage_products == "target") or (stage_products == "both"):
+            stager.stage_target(**staging)
 
 
 @app.command
@@ -165,29 +479,230 @@ def search_position(
         int,
         Parameter(help="Number of nearest calibrators to search for."),
     ] = 2,
+    refresh: Annotated[
+        bool,
+        Parameter(help="Query the LTA again instead of using cached metadata."),
+    ] = False,
+    offline: Annotated[
+        bool,
+        Parameter(help="Only use cached metadata, without connecting to the LTA."),
+    ] = False,
+    dry_run: Annotated[
+        bool,
+        Parameter(
+            help="Only plan staging the products in `stage_products`, both if none are given: report the volume per site and the expected transfer time, without submitting staging requests."
+        ),
+    ] = False,
+    max_request_size: Annotated[
+        Optional[float],
+        Parameter(help="Split staging into StageIt requests of at most this many TB."),
+    ] = None,
+    max_stage_volume: Annotated[
+        Optional[float],
+        Parameter(
+            help="Stage at most this many TB in total. Files beyond it are listed as deferred in the staging plan."
+        ),
+    ] = None,
 ):
+    from .lta_search import ObservationStager
+
+    if dry_run and stage_products == "none":
+        stage_products = "both"
     if stage_products != "none":
         get_surls = True
-
-    stager = ObservationStager(get_surls=get_surls)
-    stager.find_observation_by_position(
-        project,
-        ra,
-        dec,
-        max_radius,
-        min_duration,
-        freq_start,
-        freq_end,
+    staging = dict(
+        max_request_size=max_request_size * 1e12 if max_request_size else None,
+        max_volume=max_stage_volume * 1e12 if max_stage_volume else None,
+        dry_run=dry_run,
     )
-    stager.find_nearest_calibrators(n_calibrators, freq_start, freq_end)
-    if (stage_products == "calibrator") or (stage_products == "both"):
-        stager.stage_calibrators()
-    if (stage_products == "target") or (stage_products == "both"):
-        stager.stage_target()
+
+    with ObservationStager(
+        get_surls=get_surls, cache=MetadataCache(refresh=refresh, offline=offline)
+    ) as stager:
+        stager.find_observation_by_position(
+            project,
+            ra,
+            dec,
+            max_radius,
+            min_duration,
+            freq_start,
+            freq_end,
+        )
+        stager.find_nearest_calibrators(n_calibrators, freq_start, freq_end)
+        if (stage_products == "calibrator") or (stage_products == "both"):
+            stager.stage_calibrators(**staging)
+        if (stage_products == "target") or (stage_products == "both"):
+            stager.stage_target(**staging)
+
+
+@app.command
+def search_id_batch(
+    targets: Annotated[
+        str,
+        Parameter(
+            help="CSV or text file with a SAS ID and optionally a sub-array pointing identifier per line."
+        ),
+    ],
+    project: Annotated[
+        str,
+        Parameter(help="LTA project to limit searches to."),
+    ] = "ALL",
+    freq_start: Annotated[
+        Optional[float],
+        Parameter(help="Lower limit to which frequency subbands to select."),
+    ] = None,
+    freq_end: Annotated[
+        Optional[float],
+        Parameter(help="Upper limit to which frequency subbands to select."),
+    ] = None,
+    get_surls: Annotated[
+        bool,
+        Parameter(help="Dump a text file with SURLs for every target."),
+    ] = False,
+    n_calibrators: Annotated[
+        int,
+        Parameter(help="Number of nearest calibrators to search for."),
+    ] = 2,
+    manifest: Annotated[
+        str,
+        Parameter(help="File to write the combined results to, JSON or .parquet."),
+    ] = "manifest.json",
+    max_workers: Annotated[
+        int,
+        Parameter(help="Maximum number of concurrent lookups."),
+    ] = 4,
+    refresh: Annotated[
+        bool,
+        Parameter(help="Query the LTA again instead of using cached metadata."),
+    ] = False,
+    offline: Annotated[
+        bool,
+        Parameter(help="Only use cached metadata, without connecting to the LTA."),
+    ] = False,
+):
+    """Search for many SAS IDs in one run."""
+    from .batch import BatchSearch, read_targets, write_manifest
+
+    with BatchSearch(
+        project=project,
+        get_surls=get_surls,
+        n_calibrators=n_calibrators,
+        freq_start=freq_start,
+        freq_end=freq_end,
+        max_workers=max_workers,
+        cache=MetadataCache(refresh=refresh, offline=offline),
+    ) as batch:
+        entries = batch.search_ids(read_targets(targets, ["sasid", "sapi"]))
+    write_manifest(entries, manifest)
+
+
+@app.command
+def search_position_batch(
+    targets: Annotated[
+        str,
+        Parameter(
+            help="CSV or text file with a right ascension and declination in degrees per line."
+        ),
+    ],
+    max_radius: Annotated[
+        float,
+        Parameter(help="Maximum distance in degrees an observation is allowed to be."),
+    ] = 1.3,
+    min_duration: Annotated[
+        float,
+        Parameter(help="Minimum duration in hours an observation must be."),
+    ] = 0.0,
+    project: Annotated[
+        str,
+        Parameter(help="LTA project to limit searches to."),
+    ] = "ALL",
+    freq_start: Annotated[
+        Optional[float],
+        Parameter(help="Lower limit to which frequency subbands to select."),
+    ] = None,
+    freq_end: Annotated[
+        Optional[float],
+        Parameter(help="Upper limit to which frequency subbands to select."),
+    ] = None,
+    get_surls: Annotated[
+        bool,
+        Parameter(help="Dump a text file with SURLs for every target."),
+    ] = False,
+    n_calibrators: Annotated[
+        int,
+        Parameter(help="Number of nearest calibrators to search for."),
+    ] = 2,
+    manifest: Annotated[
+        str,
+        Parameter(help="File to write the combined results to, JSON or .parquet."),
+    ] = "manifest.json",
+    max_workers: Annotated[
+        int,
+        Parameter(help="Maximum number of concurrent lookups."),
+    ] = 4,
+    refresh: Annotated[
+        bool,
+        Parameter(help="Query the LTA again instead of using cached metadata."),
+    ] = False,
+    offline: Annotated[
+        bool,
+        Parameter(help="Only use cached metadata, without connecting to the LTA."),
+    ] = False,
+):
+    """Search for many positions in one run."""
+    from .batch import BatchSearch, read_targets, write_manifest
+
+    with BatchSearch(
+        project=project,
+        get_surls=get_surls,
+        n_calibrators=n_calibrators,
+        freq_start=freq_start,
+        freq_end=freq_end,
+        max_workers=max_workers,
+        cache=MetadataCache(refresh=refresh, offline=offline),
+    ) as batch:
+        entries = batch.search_positions(
+            read_targets(targets, ["ra", "dec", "name"]), max_radius, min_duration
+        )
+    write_manifest(entries, manifest)
+
+
+@app.meta.default
+def launcher(
+    *tokens: Annotated[str, Parameter(show=False, allow_leading_hyphen=True)],
+    profile: Annotated[
+        bool,
+        Parameter(
+            help="Log the time spent per stage at the end of the run and write it to flocs-lta-profile-<time>.json."
+        ),
+    ] = False,
+    metrics_file: Annotated[
+        Optional[str],
+        Parameter(
+            help="Write the time, bytes and database queries per stage to this file in the Prometheus text format."
+        ),
+    ] = None,
+):
+    command, bound, _ = app.parse_args(tokens)
+    try:
+        return command(*bound.args, **bound.kwargs)
+    except CacheMiss as e:
+        logger.critical(
+            f"Offline search failed: {e} Run the search once without --offline first."
+        )
+        sys.exit(1)
+    finally:
+        if profile:
+            metrics.log_summary()
+            metrics.write_summary(
+                f"flocs-lta-profile-{time.strftime('%Y%m%dT%H%M%S')}.json"
+            )
+        if metrics_file:
+            metrics.write_prometheus(metrics_file)
 
 
 def main():
-    app()
+    app.meta()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+import asyncio
+import hashlib
+import json
+import os
+import random
+import socket
+import uuid
+from typing import AsyncIterator, Iterable, Optional
+
+import structlog
+
+from .webdav import DownloadResult
+
+logger = structlog.getLogger()
+
+STATES = ("todo", "claimed", "done", "failed", "tmp")
+
+
+def _key(url: str) -> str:
+    return hashlib.sha1(url.encode()).hexdigest()
+
+
+class Ledger:
+    def __init__(
+        self,
+        outdir: str,
+        lease: float = 600.0,
+        max_attempts: int = 3,
+        poll: float = 30.0,
+        name: str = ".ledger",
+    ):
+        """Initialise a Ledger object.
+
+        A work queue of URLs shared by download workers on several nodes, kept as
+        files in the output directory on a shared filesystem. Every URL has one
+        file, which moves between the todo, claimed, done and failed directories by
+        atomic renames, so exactly one worker gets to claim it. Claims are leases:
+        workers touch the files they claimed while they work on them, and claims
+        not touched for `lease` seconds, e.g. of a crashed worker, go back to todo.
+
+        Lease ages are measured against the clock of the filesystem, not of the
+        node, so that clock skew between nodes does not expire leases.
+
+        Args:
+            outdir (str): shared output directory of the downloads.
+            lease (float): seconds after which an untouched claim expires.
+            max_attempts (int): number of times a URL is tried before it is
+                marked as failed.
+            poll (float): seconds between checks for URLs to claim while other
+                workers still hold claims that may expire.
+            name (str): name of the ledger directory in `outdir`.
+        """
+        self.path = os.path.join(os.path.abspath(outdir), name)
+        for state in STATES:
+            os.makedirs(os.path.join(self.path, state), exist_ok=True)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll = poll
+        self.worker = f"{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex[:8]}"
+        # Every node keeps its own DownloadState, as SQLite locking is unreliable
+        # on network filesystems, so that a restarted worker can resume from it.
+        self.state_path = os.path.join(
+            self.path, f"state.{socket.gethostname()}.sqlite"
+        )
+        # Claim file per URL claimed by this worker.
+        self.claims: dict[str, str] = {}
+        # Earlier attempts per claimed URL, by any worker.
+        self.attempts: dict[str, int] = {}
+
+    def _dir(self, state: str) -> str:
+        return os.path.join(self.path, state)
+
+    def _now(self) -> float:
+        """Current time according to the shared filesystem."""
+        clock = os.path.join(self._dir("tmp"), f"clock.{self.worker}")
+        with open(clock, "a"):
+            os.utime(clock)
+        return os.stat(clock).st_mtime
+
+    def _take(self, claim: str) -> Optional[str]:
+        """Move a claim out of the claimed directory, unless another worker did.
+
+        Returns:
+            owned (str): new path of the claim file, or None if it was gone.
+        """
+        owned = os.path.join(self._dir("tmp"), f"{os.path.basename(claim)}.taken")
+        try:
+            os.rename(claim, owned)
+        except FileNotFoundError:
+            return None
+        return owned
+
+    def _settle(self, owned: str, error: Optional[str] = None):
+        """Record an attempt on a taken claim and move it to done, todo or failed."""
+        with open(owned) as f:
+            entry = json.load(f)
+        entry["attempts"] += 1
+        state = "done"
+        if error is not None:
+            entry["errors"].append(error)
+            state = "failed" if entry["attempts"] >= self.max_attempts else "todo"
+        with open(owned, "w") as f:
+            json.dump(entry, f)
+        os.rename(owned, os.path.join(self._dir(state), _key(entry["url"])))
+
+    def seed(self, urls: Iterable[str]) -> int:
+        """Add URLs that are not in the ledger yet. Any worker may do this.
+
+        Returns:
+            added (int): number of URLs added.
+        """
+        known = {
+            name.split(".")[0]
+            for state in ("todo", "claimed", "done", "failed")
+            for name in os.listdir(self._dir(state))
+        }
+        added = 0
+        for url in urls:
+            key = _key(url)
+            if key in known:
+                continue
+            known.add(key)
+            tmp = os.path.join(self._dir("tmp"), f"{key}.{self.worker}")
+            with open(tmp, "w") as f:
+                json.dump({"url": url, "attempts": 0, "errors": []}, f)
+            try:
+                # Unlike a rename, a link does not replace a file another worker added.
+                os.link(tmp, os.path.join(self._dir("todo"), key))
+                added += 1
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp)
+        return added
+
+    def claim(self) -> Optional[str]:
+        """Claim a URL to download.
+
+        Returns:
+            url (str): the claimed URL, or None if there is nothing to claim.
+        """
+        keys = os.listdir(self._dir("todo"))
+        # Spread workers over the queue, so that they rarely race for the same URL.
+        random.shuffle(keys)
+        for key in keys:
+            todo = os.path.join(self._dir("todo"), key)
+            claim = os.path.join(self._dir("claimed"), f"{key}.{self.worker}")
+            try:
+                # The rename keeps the modification time, which starts the lease.
+                os.utime(todo)
+                os.rename(todo, claim)
+            except FileNotFoundError:
+                # Another worker claimed it first.
+                continue
+            with open(claim) as f:
+                entry = json.load(f)
+            url = entry["url"]
+            self.claims[url] = claim
+            self.attempts[url] = entry["attempts"]
+            return url
+        return None
+
+    def renew(self):
+        """Extend the leases of all URLs claimed by this worker."""
+        for url, claim in list(self.claims.items()):
+            try:
+                os.utime(claim)
+            except FileNotFoundError:
+                logger.warning(f"Lease on {url} expired, another worker may take it.")
+                self.claims.pop(url, None)
+
+    def reclaim_expired(self) -> int:
+        """Put claims whose lease expired back in the queue.
+
+        Returns:
+            reclaimed (int): number of URLs put back.
+        """
+        now = self._now()
+        reclaimed = 0
+        for name in os.listdir(self._dir("claimed")):
+            claim = os.path.join(self._dir("claimed"), name)
+            try:
+                if now - os.stat(claim).st_mtime < self.lease:
+                    continue
+            except FileNotFoundError:
+                continue
+            owned = self._take(claim)
+            if owned is None:
+                continue
+            worker = name.split(".", 1)[1]
+            logger.warning(f"Lease of worker {worker} on {name.split('.')[0]} expired.")
+            # Counts as an attempt, so that a file that crashes workers is given up.
+            self._settle(owned, f"Lease of worker {worker} expired.")
+            reclaimed += 1
+        return reclaimed
+
+    def complete(self, result: DownloadResult):
+        """Record the outcome of a claimed URL.
+
+        Failed URLs are queued again until they were tried `max_attempts` times.
+
+        Args:
+            result (DownloadResult): result of downloading the URL.
+        """
+        claim = self.claims.pop(result.url, None)
+        self.attempts.pop(result.url, None)
+        if claim is None:
+            return
+        owned = self._take(claim)
+        if owned is None:
+            logger.warning(f"Lease on {result.url} expired before it completed.")
+            return
+        self._settle(owned, None if result.ok else result.error or "Failed.")
+
+    def counts(self) -> dict[str, int]:
+        """Number of URLs per state, over all workers."""
+        return {
+            state: len(os.listdir(self._dir(state)))
+            for state in ("todo", "claimed", "done", "failed")
+        }
+
+    async def urls(self, capacity: int) -> AsyncIterator[str]:
+        """Claim URLs while this worker has fewer than `capacity` in progress.
+
+        Pass `complete` as `on_result` to the engine, so that finished URLs free
+        their place. Stops once no URLs are queued or claimed by any worker.
+
+        Args:
+            capacity (int): maximum number of URLs claimed at the same time.
+
+        Yields:
+            url (str): URL claimed by this worker.
+        """
+        loop = asyncio.get_running_loop()
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            while True:
+                if len(self.claims) >= capacity:
+                    await asyncio.sleep(1.0)
+                    continue
+                url = await loop.run_in_executor(None, self.claim)
+                if url is not None:
+                    yield url
+                    continue
+                await loop.run_in_executor(None, self.reclaim_expired)
+                counts = await loop.run_in_executor(None, self.counts)
+                if not counts["todo"] and not counts["claimed"]:
+                    break
+                if not counts["todo"]:
+                    await asyncio.sleep(self.poll if not self.claims else 1.0)
+        finally:
+            heartbeat.cancel()
+        logger.info(f"Ledger in {self.path}: {self.counts()}")
+
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            await loop.run_in_executor(None, self.renew)
@@ -1,10 +1,31 @@
 #!/usr/bin/env python
+import asyncio
+import json
 import os
 import shutil
+import tarfile
+import threading
+import time
 import structlog
-from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
-from typing import Iterable, Optional
+from itertools import chain, zip_longest
+from typing import AsyncIterable, AsyncIterator, BinaryIO, Iterable, Optional, Union
+
+from .checksum import Checksum, compare, parse_digest
+from .compress import DyscoCompressor, has_dysco
+from .extract import extract_tarball
+from .ledger import Ledger
+from .metrics import metrics
+from .mirror import Mirror, link_file
+from .state import DownloadStage, DownloadState
+from .verify import verify_ms
+from .webdav import (
+    WANT_DIGEST,
+    DownloadResult,
+    HTTPError,
+    RateLimiter,
+    WebDAVSession,
+)
 
 logger = structlog.getLogger()
 
@@ -17,104 +38,497 @@ class LTASite(Enum):
 
 class VerificationLevel(Enum):
     BASIC = "basic"
+    CHECKSUM = "checksum"
+    DEEP = "deep"
+
+
+def site_from_url(url: str) -> LTASite:
+    """Determine the LTA site a URL points to.
+
+    Args:
+        url (str): WebDAV URL or SURL of a file in the LTA.
+
+    Returns:
+        site (LTASite): the site hosting the URL.
+
+    Raises:
+        RuntimeError: when encountering an unknown LTA site.
+    """
+    if "juelich" in url:
+        return LTASite.JUELICH
+    elif "psnc" in url:
+        return LTASite.POZNAN
+    elif "surf" in url or "sara" in url:
+        return LTASite.SURF
+    raise RuntimeError("Unknown LTA site encountered.")
+
+
+def group_by_site(urls: Iterable) -> dict[Optional[LTASite], list[str]]:
+    """Group URLs by the LTA site hosting them, dropping duplicates.
+
+    Args:
+        urls (Iterable): WebDAV URLs of files in the LTA.
+
+    Returns:
+        groups (dict): URLs in their original order per LTASite, with URLs of
+            unknown sites under None.
+    """
+    groups: dict[Optional[LTASite], list[str]] = {}
+    for url in dict.fromkeys(urls):
+        try:
+            site = site_from_url(url)
+        except RuntimeError:
+            site = None
+        groups.setdefault(site, []).append(url)
+    return groups
+
+
+def merge_macaroons(macaroons: Union[dict, list[dict]]) -> dict[str, str]:
+    """Combine the macaroons of a staging request into one macaroon per LTA site.
+
+    Args:
+        macaroons (dict or list): macaroons per LTA site name, or a list of those
+            as returned for requests spanning several sites.
+
+    Returns:
+        macaroons (dict): the first macaroon found for every LTA site name.
+    """
+    if isinstance(macaroons, dict):
+        macaroons = [macaroons]
+    merged = {}
+    for macaroon_set in macaroons:
+        for site, macaroon in macaroon_set.items():
+            merged.setdefault(site, macaroon)
+    return merged
+
+
+class TeeReader:
+    def __init__(
+        self,
+        source: BinaryIO,
+        sink: Optional[BinaryIO] = None,
+        limiter: Optional[RateLimiter] = None,
+        checksum: Optional[Checksum] = None,
+    ):
+        """Initialise a TeeReader object.
+
+        Wraps a readable stream and copies everything read from it to a second stream.
+
+        Args:
+            source (BinaryIO): stream to read from.
+            sink (BinaryIO): stream to copy the data to, or None to only pass it on.
+            limiter (RateLimiter): limits the rate at which data is read.
+            checksum (Checksum): updated with all data read.
+        """
+        self.source = source
+        self.sink = sink
+        self.limiter = limiter
+        self.checksum = checksum
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.source.read(size)
+        self.bytes_read += len(data)
+        if self.limiter is not None:
+            self.limiter.consume(len(data))
+        if self.checksum is not None:
+            self.checksum.update(data)
+        if self.sink is not None:
+            self.sink.write(data)
+        return data
+
+    def drain(self, bufsize: int = 1 << 20):
+        """Read the remainder of the source, e.g. trailing tar padding."""
+        while self.read(bufsize):
+            pass
+
+
+def extract_stream(
+    stream: BinaryIO,
+    outdir: str,
+    archive: Optional[str] = None,
+    limiter: Optional[RateLimiter] = None,
+    checksum: Optional[Checksum] = None,
+) -> int:
+    """Extract a tar archive while it is being read from a stream.
+
+    Args:
+        stream (BinaryIO): stream providing the tarball, e.g. an HTTP response body.
+        outdir (str): directory to extract the archive in.
+        archive (str): if given, also write the tarball to this path.
+        limiter (RateLimiter): limits the rate at which the stream is read.
+        checksum (Checksum): updated with the whole tarball, including padding.
+
+    Returns:
+        nbytes (int): number of bytes read from the stream.
+    """
+    sink = open(archive, "wb") if archive else None
+    try:
+        reader = TeeReader(stream, sink, limiter, checksum)
+        with tarfile.open(fileobj=reader, mode="r|") as tarball:
+            tarball.extractall(path=outdir)
+        reader.drain()
+    finally:
+        if sink is not None:
+            sink.close()
+    return reader.bytes_read
 
 
 class Downloader:
-    def __init__(self, urls: Iterable, macaroons: dict):
+    def __init__(
+        self,
+        urls: Iterable,
+        macaroons: dict,
+        checksums: Optional[dict] = None,
+        checksum_retries: int = 2,
+        mirror: Optional[Mirror] = None,
+    ):
         """Initialise a Downloader object.
 
         Args:
             urls (list): a list (or other iterable) of URLs to download.
             macaroons (dict): dictionary with maracoons for the various LTA sites.
+            checksums (dict): checksums from the LTA catalogue per file name, as
+                written to srms_*_checksums.json by the search commands. Files
+                without catalogue checksums are checked against the checksums the
+                server reports, if any.
+            checksum_retries (int): number of times to download a file again when
+                its checksum does not match.
+            mirror (Mirror): local mirror to take tarballs from instead of the LTA
+                when it has them, and to add downloaded tarballs to.
         """
         self.macaroons = macaroons
         self.urls = urls
+        self.checksums = checksums or {}
+        self.checksum_retries = checksum_retries
+        self.mirror = mirror
+        self.sessions: dict[LTASite, WebDAVSession] = {}
+        self.rate_limiter: Optional[RateLimiter] = None
+        self._lock = threading.Lock()
 
-    def download_url(
+    def session(self, site: LTASite) -> WebDAVSession:
+        """Get the connection pool for an LTA site, creating it on first use."""
+        with self._lock:
+            if site not in self.sessions:
+                if site.value not in self.macaroons:
+                    raise RuntimeError(f"No macaroon for LTA site {site.value}.")
+                self.sessions[site] = WebDAVSession(
+                    self.macaroons[site.value], rate_limiter=self.rate_limiter
+                )
+            return self.sessions[site]
+
+    @staticmethod
+    def output_path(url: str, outdir: str) -> str:
+        """Local path of the tarball for a URL, in a directory per SAS ID."""
+        sasid = url.split("/")[-1].split("_")[0]
+        outdir_full = os.path.join(os.path.abspath(outdir), sasid)
+        try:
+            os.mkdir(outdir_full)
+        except FileExistsError:
+            pass
+        return os.path.join(outdir_full, url.split("/")[-1])
+
+    def expected_size(self, url: str) -> Optional[int]:
+        """Size of the file at a URL, from the catalogue or else from the server.
+
+        Args:
+            url (str): URL of the file.
+
+        Returns:
+            size (int): size in bytes, or None if it could not be determined.
+        """
+        size = self.checksums.get(url.split("/")[-1], {}).get("size")
+        if size is not None:
+            return int(size)
+        try:
+            return self.session(site_from_url(url)).content_length(url)
+        except (HTTPError, OSError, RuntimeError) as e:
+            logger.warning(f"Could not determine the size of {url}: {e}")
+            return None
+
+    def fetch(
         self,
-        arguments: tuple[str, bool, str, str],
-    ):
-        """Download the MS pointed to by the URL.
+        url: str,
+        extract: bool = True,
+        outdir: str = os.getcwd(),
+        stream: bool = False,
+        keep_archive: bool = False,
+        segments: int = 1,
+        checksum: bool = False,
+    ) -> DownloadResult:
+        """Transfer the file pointed to by the URL, without post-processing it.
+
+        When streaming, the tarball is extracted while it is being transferred.
+        Tarballs in the mirror, if any, are linked or extracted from there instead,
+        and transferred tarballs are added to it.
 
         Args:
             url (str): URL to download.
+            extract (bool): extract the tarball. Only used when `stream` is True.
             outdir (str): directory to put downloaded files in.
+            stream (bool): extract the tarball while it is downloading instead of
+                writing it to disk first. Only used when `extract` is True.
+            keep_archive (bool): keep a copy of the tarball when streaming.
+            segments (int): number of concurrent byte ranges to split large files in.
+                Not used when streaming.
+            checksum (bool): checksum the data while it arrives, download it again
+                if it does not match and record the outcome in
+                verification_report.jsonl in `outdir`.
+
+        Returns:
+            result (DownloadResult): outcome of the transfer.
 
         Raises:
             RuntimeError: when encountering an unknown LTA site.
         """
-        url, extract, verification, outdir = arguments
-        site = None
-        sasid = url.split("/")[-1].split("_")[0]
-        outdir_full = os.path.join(os.path.abspath(outdir), sasid)
-        try:
-            os.mkdir(outdir_full)
-        except FileExistsError:
-            pass
-        outname = os.path.join(outdir_full, url.split("/")[-1])
-        if "juelich" in url:
-            site = LTASite.JUELICH
-        elif "psnc" in url:
-            site = LTASite.POZNAN
-        elif "surf" in url:
-            site = LTASite.SURF
-        if not site:
-            raise RuntimeError("Unknown LTA site encountered.")
-        # strip the hash + tar extension
-        ms = outname.split("MS")[0] + "MS"
-        if not os.path.isdir(ms):
-            print(
-                f"wget --no-clobber --retry-on-http-error 401,500 --check-certificate=off {url}?authz={self.macaroons[site.value]} -O {outname}"
+        site = site_from_url(url)
+        outname = self.output_path(url, outdir)
+        ms = ms_path(outname)
+        if os.path.isdir(ms):
+            print(f"{ms} already exists.")
+            return DownloadResult(url, ms, "skipped")
+        if self.mirror is not None:
+            result = self._from_mirror(url, outname, extract, stream, keep_archive)
+            if result is not None:
+                metrics.record(
+                    "mirror",
+                    result.elapsed,
+                    nbytes=result.nbytes,
+                    site=site.value,
+                    url=url,
+                )
+                return result
+        archive = outname if keep_archive else None
+        incoming = self.mirror is not None and extract and stream and not keep_archive
+        if incoming:
+            # Write the streamed tarball to the mirror instead of the output directory.
+            archive = self.mirror.incoming_path(os.path.basename(outname))
+        session = self.session(site)
+        for attempt in range(1 + (self.checksum_retries if checksum else 0)):
+            result = self._transfer(
+                session, url, outname, extract, stream, archive, segments, checksum
             )
-            os.system(
-                f"wget --no-clobber --retry-on-http-error 401,500 --check-certificate=off {url}?authz={self.macaroons[site.value]} -O {outname}"
+            if not checksum or result.status != "downloaded":
+                break
+            source = "catalogue"
+            expected = self.checksums.get(os.path.basename(outname), {})
+            match = compare(expected, result.checksums)
+            if match is None:
+                source = "server"
+                expected = result.remote_checksums
+                match = compare(expected, result.checksums)
+            self._report(
+                outdir,
+                {
+                    "url": url,
+                    "attempt": attempt + 1,
+                    "verified": match,
+                    "source": source if match is not None else None,
+                    "expected": expected,
+                    "actual": result.checksums,
+                },
+            )
+            if match is None:
+                logger.warning(f"No checksum known for {url}, not verified.")
+                break
+            if match:
+                logger.info(f"Checksum of {url} matches the {source} value.")
+                break
+            logger.error(f"Checksum mismatch for {url} (attempt {attempt + 1}).")
+            _remove_if_exists(outname)
+            shutil.rmtree(ms, ignore_errors=True)
+            result.status = "failed"
+            result.error = (
+                f"Checksum mismatch: expected {expected}, got {result.checksums}"
+            )
+        metrics.record(
+            "stream_extract" if extract and stream else "download",
+            result.elapsed,
+            nbytes=result.nbytes,
+            site=site.value,
+            url=url,
+            status=result.status,
+        )
+        if self.mirror is not None:
+            self._to_mirror(
+                result, archive if extract and stream else outname, incoming
+            )
+        if not result.ok:
+            logger.error(f"Failed to download {url}: {result.error}")
+        return result
+
+    def _from_mirror(
+        self, url: str, outname: str, extract: bool, stream: bool, keep_archive: bool
+    ) -> Optional[DownloadResult]:
+        """Take a tarball from the mirror, or return None if it is not there."""
+        name = os.path.basename(outname)
+        path = self.mirror.lookup(name, self.checksums.get(name))
+        if path is None:
+            return None
+        start = time.perf_counter()
+        try:
+            if extract and stream and not keep_archive:
+                # As when streaming, the tarball does not end up in the output directory.
+                print(f"Extracting {name} from the mirror")
+                extract_tarball(path, os.path.dirname(outname))
+            elif not os.path.exists(outname):
+                method = link_file(path, outname)
+                logger.info(f"Took {name} from the mirror ({method}).")
+        except (OSError, tarfile.TarError) as e:
+            logger.warning(f"Could not use {name} from the mirror, downloading it: {e}")
+            shutil.rmtree(ms_path(outname), ignore_errors=True)
+            return None
+        return DownloadResult(
+            url,
+            outname,
+            "downloaded",
+            nbytes=os.path.getsize(path),
+            elapsed=time.perf_counter() - start,
+            mirrored=True,
+        )
+
+    def _to_mirror(
+        self, result: DownloadResult, archive: Optional[str], incoming: bool
+    ):
+        """Add a transferred tarball to the mirror, moving it if it was written there."""
+        try:
+            if result.status == "downloaded" and archive and os.path.exists(archive):
+                self.mirror.add(
+                    os.path.basename(result.path),
+                    archive,
+                    result.checksums,
+                    move=incoming,
+                )
+        except OSError as e:
+            logger.warning(f"Could not add {result.path} to the mirror: {e}")
+        finally:
+            if incoming:
+                _remove_if_exists(archive)
+
+    def _transfer(
+        self,
+        session: WebDAVSession,
+        url: str,
+        outname: str,
+        extract: bool,
+        stream: bool,
+        archive: Optional[str],
+        segments: int,
+        checksum: bool,
+    ) -> DownloadResult:
+        """Transfer a file once, either to disk or extracting it while streaming.
+
+        When streaming, the tarball is also written to `archive`, if given.
+        """
+        if extract and stream:
+            print(f"Streaming and extracting {url}")
+            start = time.perf_counter()
+            hasher = Checksum() if checksum else None
+            remote = {}
+            try:
+                with session.open(
+                    url, {"Want-Digest": WANT_DIGEST} if checksum else None
+                ) as response:
+                    remote = parse_digest(response.getheader("Digest"))
+                    nbytes = extract_stream(
+                        response,
+                        os.path.dirname(outname),
+                        archive=archive,
+                        limiter=session.rate_limiter,
+                        checksum=hasher,
+                    )
+            except (HTTPError, OSError, tarfile.TarError) as e:
+                result = DownloadResult(
+                    url,
+                    outname,
+                    "failed",
+                    http_status=getattr(e, "status", None),
+                    elapsed=time.perf_counter() - start,
+                    error=f"{type(e).__name__}: {e}",
+                )
+            else:
+                result = DownloadResult(
+                    url,
+                    outname,
+                    "downloaded",
+                    http_status=200,
+                    nbytes=nbytes,
+                    elapsed=time.perf_counter() - start,
+                    checksums=hasher.hexdigests() if hasher is not None else {},
+                    remote_checksums=remote,
+                )
+            return result
+        print(f"Downloading {url}")
+        return session.download(url, outname, segments=segments, checksum=checksum)
+
+    def _report(self, outdir: str, entry: dict):
+        """Append an entry to the verification report in `outdir`."""
+        with self._lock:
+            with open(os.path.join(outdir, "verification_report.jsonl"), "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def report_ms(self, outdir: str, result: DownloadResult):
+        """Add the MeasurementSet check of a result, if any, to the verification report."""
+        if result.verification:
+            self._report(
+                outdir,
+                {
+                    "url": result.url,
+                    "verified": result.verification["ok"],
+                    "source": "measurementset",
+                    "report": result.verification,
+                },
             )
-            if extract:
-                import tarfile
-
-                print(f"Extracting {outname}")
-                with tarfile.open(outname, "r") as tarball:
-                    tarball.extractall(path=outdir_full)
-
-                if verification == "basic":
-                    import casacore.tables as ct
-
-                    try:
-                        with ct.table(ms) as tab:
-                            has_dysco = (
-                                tab.getdesc()["DATA"]["dataManagerGroup"] == "DyscoData"
-                            ) | (
-                                tab.getdesc()["DATA"]["dataManagerType"] == "DyscoStMan"
-                            )
-                        if has_dysco:
-                            logger.info(
-                                f"{ms} is already dysco compressed. Deleting archive."
-                            )
-                            os.remove(outname)
-                        else:
-                            logger.info(
-                                f"{ms} is not dysco compressed, compressing with DP3."
-                            )
-                            if "CWL_SINGULARITY_CACHE" in os.environ:
-                                os.rename(ms, ms + ".nodysco")
-                                os.system(
-                                    f"apptainer exec {os.path.join(os.environ['CWL_SINGULARITY_CACHE'], 'astronrd_linc_latest.sif')} DP3 numthreads=2 msin={ms+'.nodysco'} msout={ms} msout.storagemanager=dysco steps=[]"
-                                )
-                                os.remove(outname)
-                                shutil.rmtree(ms + ".nodysco")
-                            elif shutil.which("DP3"):
-                                os.rename(ms, ms + ".nodysco")
-                                os.system(
-                                    f"DP3 msin={ms+'.nodysco'} msout={ms} msout.storagemanager=dysco steps=[]"
-                                )
-                                os.remove(outname)
-                                shutil.rmtree(ms + ".nodysco")
-                    except:
-                        print(
-                            f"{ms} is not a valid MeasurementSet or something else went wrong."
-                        )
-        else:
-            print(f"{ms} already exists.")
+
+    def download_url(
+        self,
+        url: str,
+        extract: bool = True,
+        verification: str = "basic",
+        outdir: str = os.getcwd(),
+        stream: bool = False,
+        keep_archive: bool = False,
+        segments: int = 1,
+    ) -> DownloadResult:
+        """Download the MS pointed to by the URL.
+
+        Args:
+            url (str): URL to download.
+            extract (bool): extract the tarball after downloading.
+            verification (str): verification level to apply after extracting.
+            outdir (str): directory to put downloaded files in.
+            stream (bool): extract the tarball while it is downloading instead of
+                writing it to disk first. Only used when `extract` is True.
+            keep_archive (bool): keep a copy of the tarball when streaming.
+            segments (int): number of concurrent byte ranges to split large files in.
+                Not used when streaming.
+
+        Returns:
+            result (DownloadResult): outcome of the download.
+
+        Raises:
+            RuntimeError: when encountering an unknown LTA site.
+        """
+        result = self.fetch(
+            url,
+            extract,
+            outdir,
+            stream,
+            keep_archive,
+            segments,
+            checksum=verification == VerificationLevel.CHECKSUM.value,
+        )
+        if result.status == "downloaded":
+            result = process_download(result, extract, verification)
+            record_timings(result)
+            self.report_ms(outdir, result)
+        if result.dysco is False:
+            compressor = DyscoCompressor()
+            if compressor.available:
+                with metrics.stage("compress", url=url):
+                    compressor.compress(ms_path(result.path), result.path)
+                result.dysco = True
+        return result
 
     def download_all(
         self,
@@ -122,14 +536,276 @@ class Downloader:
         extract: Optional[bool] = False,
         verification: Optional[str] = "basic",
         outdir: Optional[str] = os.getcwd(),
-    ):
+        stream: Optional[bool] = False,
+        keep_archive: Optional[bool] = False,
+        segments: Optional[int] = 1,
+        site_limits: Optional[dict] = None,
+        bandwidth: Optional[float] = None,
+        post_workers: Optional[int] = 1,
+        compress_workers: Optional[int] = 1,
+        compress_threads: Optional[int] = None,
+        dp3: Optional[str] = None,
+        extract_threads: Optional[int] = 4,
+        min_free_space: Optional[int] = 0,
+        online: Optional[AsyncIterable[str]] = None,
+        ledger: Optional[Ledger] = None,
+    ) -> list[DownloadResult]:
         """Download all URLs belonging to the instance.
 
+        URLs are grouped by LTA site, each using that site's macaroon, and all sites
+        are downloaded from concurrently in a single pass. Duplicate URLs are
+        downloaded once.
+
         Args:
-            max_workers (int):
+            max_workers (int): maximum number of parallel downloads per LTA site.
+            extract (bool): extract the tarballs after downloading.
+            verification (str): verification level to apply after extracting.
+            outdir (str): directory to put downloaded files in.
+            stream (bool): extract tarballs while they are downloading.
+            keep_archive (bool): keep a copy of the tarball when streaming.
+            segments (int): number of concurrent byte ranges to split large files in.
+            site_limits (dict): maximum number of parallel downloads for specific
+                LTASites, overriding `max_workers`.
+            bandwidth (float): total bandwidth cap in bytes per second.
+            post_workers (int): number of processes extracting and verifying
+                downloaded tarballs.
+            compress_workers (int): number of MeasurementSets compressed with Dysco
+                at the same time, at least one.
+            compress_threads (int): number of threads per compression, by default
+                the cores of the node divided over `compress_workers`.
+            dp3 (str): DP3 executable to compress with, instead of the default one.
+            extract_threads (int): number of files each worker process writes at
+                the same time when extracting a tarball.
+            min_free_space (int): bytes to leave free in `outdir`, on top of the
+                space files in flight are expected to need. Transfers wait until
+                there is room. None disables the disk space checks.
+            online (AsyncIterable): URLs that come online while they are being
+                staged, e.g. from `StagingPoller.online_urls`, to download as they
+                arrive instead of the URLs of the instance.
+            ledger (Ledger): work queue shared with workers on other nodes. The
+                URLs of the instance are added to it, and URLs are downloaded as
+                this worker claims them.
+
+        Returns:
+            results (list): a DownloadResult for every URL.
+
+        Raises:
+            ValueError: for an unknown verification level.
         """
-        with ProcessPoolExecutor(max_workers=max_workers) as pex:
-            pex.map(
-                self.download_url,
-                [(url, extract, verification, outdir) for url in self.urls],
+        from .engine import DownloadEngine
+
+        levels = [level.value for level in VerificationLevel]
+        if verification not in levels:
+            raise ValueError(
+                f"Unknown verification level {verification}, expected one of {levels}."
             )
+        compress_workers = max(1, compress_workers or 1)
+        engine = DownloadEngine(
+            self,
+            max_per_site=max_workers,
+            site_limits=site_limits,
+            bandwidth=bandwidth,
+            post_workers=post_workers,
+            compressor=DyscoCompressor(
+                threads=compress_threads
+                or max(1, (os.cpu_count() or 1) // compress_workers),
+                dp3=dp3,
+            ),
+            compress_workers=compress_workers,
+            min_free_space=min_free_space,
+        )
+        options = dict(
+            extract=extract,
+            verification=verification,
+            outdir=outdir,
+            stream=stream,
+            keep_archive=keep_archive,
+            segments=segments,
+            extract_threads=extract_threads,
+        )
+        if online is not None:
+            return engine.run(online, **options)
+        groups = group_by_site(self.urls)
+        for site, urls in groups.items():
+            if site is not None and site.value not in self.macaroons:
+                logger.error(
+                    f"No macaroon for {site.value}, cannot get {len(urls)} files."
+                )
+        if ledger is not None:
+            added = ledger.seed(self.urls)
+            logger.info(f"Added {added} URLs to the ledger in {ledger.path}.")
+            # Claim enough to keep transfers going while others are post-processed.
+            capacity = 2 * sum(engine.limits[site] for site in groups if site)
+            return engine.run(
+                self._claim(ledger, max(1, capacity), outdir, extract),
+                on_result=ledger.complete,
+                state_path=ledger.state_path,
+                **options,
+            )
+        # Interleave the sites, so that every site's transfers start right away.
+        urls = [
+            url for url in chain.from_iterable(zip_longest(*groups.values())) if url
+        ]
+        return engine.run(urls, **options)
+
+    async def _claim(
+        self, ledger: Ledger, capacity: int, outdir: str, extract: bool
+    ) -> AsyncIterator[str]:
+        """Claim URLs from a ledger, removing what failed attempts left behind.
+
+        A worker that crashed on a URL did not record that in the DownloadState of
+        this node, so its partial output would otherwise be taken for a complete
+        download. Output of URLs this node's state records as complete is kept.
+
+        Args:
+            ledger (Ledger): work queue to claim URLs from.
+            capacity (int): maximum number of URLs claimed at the same time.
+            outdir (str): directory downloaded files are put in.
+            extract (bool): whether the tarballs are extracted.
+
+        Yields:
+            url (str): URL claimed by this worker.
+        """
+        loop = asyncio.get_running_loop()
+        final = DownloadStage.VERIFIED if extract else DownloadStage.DOWNLOADED
+        state = DownloadState(*os.path.split(ledger.state_path))
+        try:
+            async for url in ledger.urls(capacity):
+                stage = state.stage(url)
+                if ledger.attempts.get(url) and not (stage and stage.reached(final)):
+                    await loop.run_in_executor(None, self.discard_partial, url, outdir)
+                yield url
+        finally:
+            state.close()
+
+    def discard_partial(self, url: str, outdir: str):
+        """Remove the MS and partial tarball an interrupted download left behind."""
+        archive = self.output_path(url, outdir)
+        ms = ms_path(archive)
+        if os.path.isdir(ms):
+            logger.info(f"Removing {ms} left by an earlier attempt.")
+            shutil.rmtree(ms, ignore_errors=True)
+        for partial in (archive + ".part", archive + ".part.ranges"):
+            _remove_if_exists(partial)
+
+
+def ms_path(archive: str) -> str:
+    """Path of the MS extracted from an LTA tarball, i.e. without hash and extension."""
+    return archive.split("MS")[0] + "MS"
+
+
+def process_download(
+    result: DownloadResult,
+    extract: bool = True,
+    verification: str = "basic",
+    threads: int = 4,
+    verify_share: float = 0.1,
+    verify_workers: int = 4,
+    keep_archive: bool = False,
+) -> DownloadResult:
+    """Extract and verify a downloaded tarball.
+
+    This does not need the Downloader and its macaroons, so it can run in a separate
+    worker process. Compression of MeasurementSets that are not Dysco compressed
+    is left to a DyscoCompressor, see `result.dysco`.
+
+    Args:
+        result (DownloadResult): result of the transfer of the tarball.
+        extract (bool): extract the tarball, unless that happened while streaming.
+        verification (str): verification level to apply after extracting.
+        threads (int): number of files written at the same time when extracting.
+        verify_share (float): share of the download time to spend on reading the
+            data for `deep` verification, at least ten seconds.
+        verify_workers (int): number of processes reading the MeasurementSet for
+            `deep` verification.
+        keep_archive (bool): keep the tarball, e.g. one asked to be kept when
+            streaming, also when the MS is already Dysco compressed.
+
+    Returns:
+        result (DownloadResult): the result, marked as failed if extraction or
+            verification failed.
+    """
+    archive = result.path
+    ms = ms_path(archive)
+    if not extract:
+        return result
+    if not os.path.isdir(ms):
+        print(f"Extracting {archive}")
+        start = time.perf_counter()
+        try:
+            nbytes = extract_tarball(archive, os.path.dirname(archive), threads=threads)
+        except (OSError, tarfile.TarError) as e:
+            result.status = "failed"
+            result.error = f"Extracting failed: {type(e).__name__}: {e}"
+            return result
+        result.timings["extract"] = (time.perf_counter() - start, nbytes)
+    if verification in (
+        VerificationLevel.BASIC.value,
+        VerificationLevel.CHECKSUM.value,
+        VerificationLevel.DEEP.value,
+    ):
+        # Checksums were verified while transferring; the MS is checked as well.
+        start = time.perf_counter()
+        try:
+            result.dysco = has_dysco(ms)
+            if verification == VerificationLevel.DEEP.value:
+                report = verify_ms(
+                    ms,
+                    budget=max(10.0, verify_share * result.elapsed),
+                    workers=verify_workers,
+                )
+                result.verification = report.to_dict()
+                logger.info(
+                    f"{ms}: {report.rows} rows, "
+                    + ", ".join(
+                        f"{column} {stats['rows_read'] / stats['rows']:.1%} read"
+                        for column, stats in report.columns.items()
+                    )
+                    + f" in {report.seconds:.1f} s."
+                )
+                if not report.ok:
+                    problems = report.errors + [
+                        f"Subtable {name} is missing."
+                        for name in report.missing_subtables
+                    ]
+                    result.status = "failed"
+                    result.error = f"Verification failed: {' '.join(problems)}"
+        except ImportError as e:
+            # Without python-casacore the MS cannot be checked, which only deep
+            # verification requires; the data is kept otherwise.
+            if verification == VerificationLevel.DEEP.value:
+                result.status = "failed"
+                result.error = f"Verification failed: {type(e).__name__}: {e}"
+                result.verification = {"ok": False, "errors": [result.error]}
+            else:
+                logger.warning(
+                    f"Cannot check {ms} without python-casacore, skipping verification."
+                )
+        except (KeyError, OSError, RuntimeError) as e:
+            # casacore raises RuntimeError for tables it cannot read.
+            result.status = "failed"
+            result.error = f"Verification failed: {type(e).__name__}: {e}"
+            result.verification = {"ok": False, "errors": [result.error]}
+        finally:
+            result.timings["verify"] = (time.perf_counter() - start, 0)
+        if not result.ok:
+            logger.error(f"{ms} is not a valid MeasurementSet: {result.error}")
+            return result
+        if result.dysco and not keep_archive:
+            logger.info(f"{ms} is already dysco compressed. Deleting archive.")
+            _remove_if_exists(archive)
+    return result
+
+
+def record_timings(result: DownloadResult):
+    """Record the post-processing timings of a result, which may have been measured
+    in a worker process, in the metrics of this process."""
+    for stage, (seconds, nbytes) in result.timings.items():
+        metrics.record(stage, seconds, nbytes=nbytes, url=result.url)
+
+
+def _remove_if_exists(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -1,10 +1,23 @@
 #!/usr/bin/env python
 # pyright: reportOperatorIssue=none,reportAttributeAccessIssue=none
+import heapq
+import json
+import os
 import sys
-from datetime import timedelta
-from typing import Optional
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from functools import reduce, wraps
+from math import inf
+from operator import or_
+from threading import Lock, RLock
+from typing import Iterable, Optional
 
 import astropy.units as u
+import numpy as np
 import structlog
 from astropy.coordinates import SkyCoord
 from awlofar.database.Context import context
@@ -17,28 +30,727 @@ from awlofar.main.aweimports import (
 )
 from stager_access import stage
 
+from .cache import MetadataCache
+from .metrics import metrics
+from .plan import StagingPlan, ThroughputHistory
+
 logger = structlog.getLogger()
 
+# Calibrators are searched for in growing windows before and after the target.
+CALIBRATOR_WINDOWS = (timedelta(hours=6), timedelta(hours=24), timedelta(hours=168))
+
+
+@dataclass
+class ObservationSummary:
+    """The Observation metadata used by the searches, detached from the database."""
+
+    project: str
+    obsid: str
+    start_time: datetime
+    end_time: datetime
+    duration: float
+    process_identifier: str
+    sap_ids: list[str] = field(default_factory=list)
+
+    @classmethod
+    def from_observation(cls, obs) -> "ObservationSummary":
+        return cls(
+            project=obs.get_project(),
+            obsid=obs.observationId,
+            start_time=obs.startTime,
+            end_time=obs.endTime,
+            duration=obs.duration,
+            process_identifier=obs.processIdentifierName,
+            sap_ids=[sap.subArrayPointingIdentifier for sap in obs.subArrayPointings],
+        )
+
+    @classmethod
+    def from_dict(cls, summary: dict) -> "ObservationSummary":
+        summary = dict(summary)
+        summary["start_time"] = datetime.fromisoformat(summary["start_time"])
+        summary["end_time"] = datetime.fromisoformat(summary["end_time"])
+        return cls(**summary)
+
+    def to_dict(self) -> dict:
+        summary = asdict(self)
+        summary["start_time"] = self.start_time.isoformat()
+        summary["end_time"] = self.end_time.isoformat()
+        return summary
 
-def print_observation_details(obs, sapi: str = ""):
-    print(f"Project: {obs.get_project()}")
-    print(f"SAS ID: {obs.observationId}")
-    if len(obs.subArrayPointings) == 1:
-        print(f"SAPI: {obs.subArrayPointings[0].subArrayPointingIdentifier}")
+
+@dataclass
+class SearchMatch:
+    """An observation and SubArrayPointing found by a search, with its dataproducts."""
+
+    observation: ObservationSummary
+    sapid: str
+    separation: Optional[float] = None
+    # Dataproducts in the frequency range, as listed by
+    # `ObservationStager.dataproducts`, once resolved.
+    listing: list[list] = field(default_factory=list)
+
+    @property
+    def uris(self) -> set[str]:
+        """SURLs of the dataproducts that have a valid FileObject."""
+        return {entry[2] for entry in self.listing if entry[2] is not None}
+
+    def to_dict(self) -> dict:
+        return {
+            "observation": self.observation.to_dict(),
+            "sapid": self.sapid,
+            "separation": self.separation,
+            "listing": self.listing,
+        }
+
+
+def print_observation_details(obs: ObservationSummary, sapi: str = ""):
+    print(f"Project: {obs.project}")
+    print(f"SAS ID: {obs.obsid}")
+    if len(obs.sap_ids) == 1:
+        print(f"SAPI: {obs.sap_ids[0]}")
     elif sapi:
         print(f"SAPI: {sapi}")
-    print(f"Start time: {obs.startTime}")
-    print(f"End time: {obs.endTime}")
+    print(f"Start time: {obs.start_time}")
+    print(f"End time: {obs.end_time}")
     print(f"Duration: {obs.duration} s")
-    print(f"Process identifier: {obs.processIdentifierName}")
+    print(f"Process identifier: {obs.process_identifier}")
     print()
 
 
+def select_frequency(
+    listing: list, minfreq: Optional[float] = None, maxfreq: Optional[float] = None
+) -> list:
+    """Select the dataproducts of a listing that fall in a frequency range.
+
+    Args:
+        listing (list): dataproduct entries as returned by
+            `ObservationStager.dataproducts`, starting with the minimum and maximum
+            frequency.
+        minfreq (float): lower limit of the frequency range, if any.
+        maxfreq (float): upper limit of the frequency range, if any.
+
+    Returns:
+        listing (list): the selected entries.
+    """
+    return [
+        entry
+        for entry in listing
+        if (not minfreq or entry[0] >= minfreq) and (not maxfreq or entry[1] <= maxfreq)
+    ]
+
+
+class FrequencyIndex:
+    def __init__(self, listing: list):
+        """Initialise a FrequencyIndex object.
+
+        Holds the dataproducts of a SubArrayPointing sorted by minimum frequency,
+        with the frequencies in compact arrays, so that any frequency range is selected
+        by binary search instead of by scanning the listing or querying the
+        database. Frequency slices of the same observation reuse one index.
+
+        Args:
+            listing (list): dataproduct entries as returned by
+                `ObservationStager.dataproducts`, starting with the minimum and
+                maximum frequency.
+        """
+        # Dataproducts without frequencies sort last and never fall in a range.
+        self.entries = sorted(
+            listing, key=lambda entry: inf if entry[0] is None else entry[0]
+        )
+        self.minfreq = array(
+            "d", [inf if entry[0] is None else entry[0] for entry in self.entries]
+        )
+        self.maxfreq = array(
+            "d", [inf if entry[1] is None else entry[1] for entry in self.entries]
+        )
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def select(
+        self, minfreq: Optional[float] = None, maxfreq: Optional[float] = None
+    ) -> list:
+        """Select the dataproducts that fall in a frequency range.
+
+        Equivalent to `select_frequency`, with the entries in frequency order.
+
+        Args:
+            minfreq (float): lower limit of the frequency range, if any.
+            maxfreq (float): upper limit of the frequency range, if any.
+
+        Returns:
+            listing (list): the selected entries.
+        """
+        if not minfreq and not maxfreq:
+            return list(self.entries)
+        start = bisect_left(self.minfreq, minfreq) if minfreq else 0
+        if not maxfreq:
+            # Dataproducts without frequencies are only selected without limits.
+            return self.entries[start : bisect_left(self.minfreq, inf)]
+        # A dataproduct starting above the upper limit cannot end below it.
+        end = bisect_right(self.minfreq, maxfreq)
+        return [
+            self.entries[i] for i in range(start, end) if self.maxfreq[i] <= maxfreq
+        ]
+
+
+# awlofar runs all queries on one global database session, which must not be used
+# by several threads at the same time. Held around everything that queries the
+# database, including loading relations, but never while waiting for other threads.
+_session_lock = RLock()
+
+
+def _serialised(func):
+    """Hold the database session lock while `func` runs."""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with _session_lock:
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class SURLResolver:
+    def __init__(self, chunk_size: int = 200, executor: Optional[Executor] = None):
+        """Initialise a SURLResolver object.
+
+        Resolves the latest valid FileObject of many dataproducts with a few bulk
+        queries instead of one query per dataproduct.
+
+        Args:
+            chunk_size (int): maximum number of dataproducts per FileObject query.
+            executor (Executor): runs the queries for several chunks concurrently,
+                if given.
+        """
+        self.chunk_size = chunk_size
+        self.executor = executor
+        self.round_trips = 0
+        self.elapsed = 0.0
+
+    def resolve(self, dataproducts: Iterable) -> dict:
+        """Find the newest valid FileObject for each of the given dataproducts.
+
+        Args:
+            dataproducts (Iterable): CorrelatedDataProducts or a query selecting them.
+
+        Returns:
+            fileobjects (dict): the newest valid FileObject per dataproduct key, for
+                those dataproducts that have one.
+        """
+        start = time.perf_counter()
+        round_trips = 0
+        if not isinstance(dataproducts, (list, tuple)):
+            dataproducts = list(dataproducts)
+            round_trips += 1
+        chunks = [
+            dataproducts[i : i + self.chunk_size]
+            for i in range(0, len(dataproducts), self.chunk_size)
+        ]
+        round_trips += len(chunks)
+        if self.executor is not None and len(chunks) > 1:
+            found = self.executor.map(self._query_chunk, chunks)
+        else:
+            found = map(self._query_chunk, chunks)
+        newest = {}
+        for fileobjects, loads in found:
+            round_trips += loads
+            for key, fo in fileobjects:
+                if key not in newest or fo.creation_date > newest[key].creation_date:
+                    newest[key] = fo
+        elapsed = time.perf_counter() - start
+        self.round_trips += round_trips
+        self.elapsed += elapsed
+        metrics.record("surl_resolution", elapsed, round_trips=round_trips)
+        logger.info(
+            f"Resolved {len(newest)} FileObjects for {len(dataproducts)} dataproducts "
+            f"in {round_trips} queries ({elapsed:.2f} s)."
+        )
+        return newest
+
+    @staticmethod
+    @_serialised
+    def _query_chunk(chunk: list) -> tuple[list[tuple], int]:
+        """Valid FileObjects of a chunk of dataproducts, with their dataproduct key.
+
+        Returns:
+            fileobjects (list): (dataproduct key, FileObject) pairs.
+            loads (int): number of extra queries made to load dataproducts.
+        """
+        query = FileObject.isValid > 0
+        query &= reduce(or_, [FileObject.data_object == dp for dp in chunk])
+        fileobjects = []
+        loads = 0
+        for fo in query:
+            # The foreign key comes with the row, following the relation would load
+            # the dataproduct with a query of its own.
+            key = getattr(fo, "data_object_id", None)
+            if key is None:
+                key = _object_key(fo.data_object)
+                loads += 1
+            fileobjects.append((key, fo))
+        return fileobjects, loads
+
+    def resolve_uris(self, dataproducts: Iterable) -> set[str]:
+        """Find the SURLs of the newest valid FileObject for each dataproduct.
+
+        Args:
+            dataproducts (Iterable): CorrelatedDataProducts or a query selecting them.
+
+        Returns:
+            uris (set): SURLs of the resolved FileObjects.
+        """
+        return {fo.URI for fo in self.resolve(dataproducts).values()}
+
+    @_serialised
+    def sizes(self, uris: Iterable[str]) -> dict[str, int]:
+        """Look up the sizes of many FileObjects by SURL with a few bulk queries.
+
+        Args:
+            uris (Iterable): SURLs of the FileObjects.
+
+        Returns:
+            sizes (dict): size in bytes per SURL, for those that were found.
+        """
+        uris = list(uris)
+        sizes = {}
+        with metrics.stage("size_query") as record:
+            for i in range(0, len(uris), self.chunk_size):
+                query = FileObject.isValid > 0
+                query &= reduce(
+                    or_,
+                    [FileObject.URI == uri for uri in uris[i : i + self.chunk_size]],
+                )
+                record["round_trips"] += 1
+                for fo in query:
+                    sizes[fo.URI] = fo.filesize
+        logger.info(f"Looked up the sizes of {len(sizes)} of {len(uris)} files.")
+        return sizes
+
+
+def _object_key(obj) -> object:
+    """Key identifying a database object, independent of the Python instance.
+
+    Raises:
+        ValueError: if the object has no object_id.
+    """
+    key = getattr(obj, "object_id", None)
+    if key is None:
+        raise ValueError(f"{obj!r} has no object_id to identify it by.")
+    return key
+
+
+def _listing(dataproducts: list, fileobjects: dict) -> list[list]:
+    """Frequencies, SURL, size and checksums per dataproduct, given their FileObjects."""
+    listing = []
+    for dp in dataproducts:
+        fo = fileobjects.get(_object_key(dp))
+        listing.append(
+            [
+                dp.minimumFrequency,
+                dp.maximumFrequency,
+                fo.URI if fo is not None else None,
+                getattr(fo, "filesize", None),
+                getattr(fo, "hash_adler32", None),
+                getattr(fo, "hash_md5", None),
+            ]
+        )
+    return listing
+
+
+def listing_sizes(listing: list[list]) -> dict[str, Optional[int]]:
+    """Size per SURL of a dataproduct listing, None where it is not known."""
+    return {
+        entry[2]: entry[3] if len(entry) > 3 else None
+        for entry in listing
+        if entry[2] is not None
+    }
+
+
+def write_srm_list(fname: str, listing: list[list], echo: bool = False):
+    """Write the SURLs of a dataproduct listing to a text file.
+
+    Sizes and checksums go to a JSON file named like `fname`, with _checksums.json
+    instead of .txt, keyed by file name for `flocs-lta download --checksums`.
+
+    Args:
+        fname (str): text file to write the SURLs to.
+        listing (list): dataproduct listing as returned by
+            `ObservationStager.dataproducts`.
+        echo (bool): also print the SURLs.
+    """
+    entries = {}
+    for entry in listing:
+        if entry[2] is not None:
+            # Listings cached before checksums were recorded only have three fields.
+            entries[entry[2]] = (list(entry) + [None] * 3)[3:6]
+    checksums = {}
+    with open(fname, "w") as f:
+        for uri in sorted(entries):
+            if echo:
+                print(uri)
+            f.write(uri + "\n")
+            size, adler32, md5 = entries[uri]
+            checksums[uri.split("/")[-1]] = {
+                "size": size,
+                "adler32": adler32,
+                "md5": md5,
+            }
+    with open(os.path.splitext(fname)[0] + "_checksums.json", "w") as f:
+        json.dump(checksums, f, indent=2)
+
+
+def pointing_box(ra: float, dec: float, halfwidth: float):
+    """Query selecting SubArrayPointings in a box around a position.
+
+    The box is widened in right ascension by 1/cos(dec) so that it covers at least
+    `halfwidth` degrees on the sky, wraps around RA 0/360 and covers all right
+    ascensions when it reaches a celestial pole.
+
+    Args:
+        ra (float): right ascension of the centre in degrees.
+        dec (float): declination of the centre in degrees.
+        halfwidth (float): half the width of the box in degrees.
+
+    Returns:
+        query: a query on SubArrayPointing.
+    """
+    rightascension = SubArrayPointing.pointing.rightAscension
+    declination = SubArrayPointing.pointing.declination
+    query = (declination > dec - halfwidth) & (declination < dec + halfwidth)
+    if abs(dec) + halfwidth >= 90:
+        return query
+    ra_halfwidth = halfwidth / np.cos(np.radians(abs(dec) + halfwidth))
+    if ra_halfwidth >= 180:
+        return query
+    ra = ra % 360
+    low, high = ra - ra_halfwidth, ra + ra_halfwidth
+    if low < 0:
+        query &= (rightascension > low + 360) | (rightascension < high)
+    elif high > 360:
+        query &= (rightascension > low) | (rightascension < high - 360)
+    else:
+        query &= (rightascension > low) & (rightascension < high)
+    return query
+
+
+class CalibratorPool:
+    def __init__(self):
+        """Initialise a CalibratorPool object.
+
+        Holds calibrator candidates fetched for time windows, so that searches for
+        targets close in time can share a single query.
+        """
+        self.windows: list[tuple[str, datetime, datetime, list]] = []
+        self._lock = Lock()
+
+    def find(self, project: str, start: datetime, end: datetime) -> Optional[list]:
+        """Get the candidates in a time window, if a fetched window covers it.
+
+        Args:
+            project (str): project the candidates belong to.
+            start (datetime): start of the time window.
+            end (datetime): end of the time window.
+
+        Returns:
+            candidates (list): Observations starting within the window, or None if
+                no fetched window covers it.
+        """
+        with self._lock:
+            for pool_project, pool_start, pool_end, candidates in self.windows:
+                if pool_project == project and pool_start <= start and end <= pool_end:
+                    return [cal for cal in candidates if start < cal.startTime < end]
+        return None
+
+    def add(self, project: str, start: datetime, end: datetime, candidates: list):
+        with self._lock:
+            self.windows.append((project, start, end, candidates))
+
+
 class ObservationStager:
-    def __init__(self, get_surls: bool = False):
+    def __init__(
+        self,
+        get_surls: bool = False,
+        cache: Optional[MetadataCache] = None,
+        calibrator_pool: Optional[CalibratorPool] = None,
+        executor: Optional[Executor] = None,
+        max_workers: int = 4,
+    ):
+        """Initialise an ObservationStager object.
+
+        Args:
+            get_surls (bool): resolve SURLs and write them to srms_*.txt files.
+            cache (MetadataCache): cache for catalogue metadata. Defaults to a cache
+                that only lives as long as this object.
+            calibrator_pool (CalibratorPool): calibrator candidates shared with other
+                stagers.
+            executor (Executor): thread pool to run concurrent queries on, e.g.
+                shared with other stagers. Defaults to a pool of this stager, which
+                `close` shuts down.
+            max_workers (int): maximum number of concurrent queries when no
+                `executor` is given.
+        """
         self.get_surls = get_surls
         self.sapid = None
         self.srm_prefix = ""
+        self._owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers)
+        self.surl_resolver = SURLResolver(executor=self.executor)
+        self.cache = cache or MetadataCache(":memory:")
+        self.calibrator_pool = calibrator_pool or CalibratorPool()
+        self.frequency_indexes: dict[tuple[str, str], FrequencyIndex] = {}
+
+    def close(self):
+        """Shut down the thread pool of this stager, unless it was given one."""
+        if self._owns_executor:
+            self.executor.shutdown()
+
+    def __enter__(self) -> "ObservationStager":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @_serialised
+    def _set_project(self, project: str):
+        if self.cache.offline or context.get_current_project().name == project:
+            return
+        context.set_project(project)
+        if context.get_current_project().name != project:
+            raise ValueError(f"No permissions for project {project}")
+
+    def dataproducts(
+        self, project: str, sapid: str = "", obsid: str = ""
+    ) -> list[list]:
+        """List the dataproducts of a SubArrayPointing or Observation.
+
+        The listing is unfiltered, so that it can be cached and reused for any
+        frequency range.
+
+        Args:
+            project (str): project the observation belongs to.
+            sapid (str): SubArrayPointing identifier to list the dataproducts of.
+            obsid (str): Observation identifier, used when no `sapid` is given.
+
+        Returns:
+            listing (list): [minimum frequency, maximum frequency, SURL, size,
+                Adler-32, MD5] per dataproduct. The SURL is None if the dataproduct
+                has no valid FileObject.
+        """
+        if sapid:
+            return self.sap_dataproducts(project, [sapid])[sapid]
+        key = f"dataproducts/{project}/observation/{obsid}"
+        listing = self.cache.get(key)
+        if listing is None:
+            query = CorrelatedDataProduct.observation.observationId == obsid
+            with _session_lock, metrics.stage("dataproduct_query", round_trips=1):
+                dataproducts = list(query)
+            listing = _listing(dataproducts, self.surl_resolver.resolve(dataproducts))
+            self.cache.put(key, listing)
+        return listing
+
+    def sap_dataproducts(self, project: str, sapids: list[str]) -> dict[str, list]:
+        """List the dataproducts of several SubArrayPointings.
+
+        The FileObjects of all SubArrayPointings that are not cached yet are
+        resolved together.
+
+        Args:
+            project (str): project the observations belong to.
+            sapids (list): SubArrayPointing identifiers.
+
+        Returns:
+            listings (dict): listing as returned by `dataproducts` per identifier.
+        """
+        listings = {}
+        missing = []
+        for sapid in dict.fromkeys(sapids):
+            listing = self.cache.get(f"dataproducts/{project}/sap/{sapid}")
+            if listing is not None:
+                listings[sapid] = listing
+            else:
+                missing.append(sapid)
+        queried = dict(zip(missing, self.executor.map(self._sap_query, missing)))
+        if queried:
+            fileobjects = self.surl_resolver.resolve(
+                [dp for dataproducts in queried.values() for dp in dataproducts]
+            )
+            for sapid, dataproducts in queried.items():
+                # Stored in frequency order, so that indexing it needs no sorting.
+                listings[sapid] = FrequencyIndex(
+                    _listing(dataproducts, fileobjects)
+                ).entries
+                self.cache.put(f"dataproducts/{project}/sap/{sapid}", listings[sapid])
+        return listings
+
+    def frequency_index(
+        self, project: str, sapids: list[str]
+    ) -> dict[str, FrequencyIndex]:
+        """Get the frequency index of several SubArrayPointings.
+
+        Indexes are built once per stager from the listings of
+        `sap_dataproducts`, which only queries the database for listings that are
+        not cached.
+
+        Args:
+            project (str): project the observations belong to.
+            sapids (list): SubArrayPointing identifiers.
+
+        Returns:
+            indexes (dict): FrequencyIndex per identifier.
+        """
+        missing = [
+            sapid for sapid in sapids if (project, sapid) not in self.frequency_indexes
+        ]
+        if missing:
+            for sapid, listing in self.sap_dataproducts(project, missing).items():
+                self.frequency_indexes[project, sapid] = FrequencyIndex(listing)
+        return {sapid: self.frequency_indexes[project, sapid] for sapid in sapids}
+
+    @staticmethod
+    @_serialised
+    def _sap_query(sapid: str) -> list:
+        query = (
+            CorrelatedDataProduct.subArrayPointing.subArrayPointingIdentifier == sapid
+        )
+        query &= CorrelatedDataProduct.isValid == 1
+        with metrics.stage("dataproduct_query", round_trips=1):
+            return list(query)
+
+    def resolve_matches(
+        self,
+        matches: list[SearchMatch],
+        minfreq: Optional[float] = None,
+        maxfreq: Optional[float] = None,
+    ) -> list[SearchMatch]:
+        """Fill in the dataproducts of search matches.
+
+        The dataproducts of all SubArrayPointings of a project are queried
+        concurrently, and their FileObjects resolved together.
+
+        Args:
+            matches (list): matches to resolve the dataproducts of.
+            minfreq (float): lower limit of the frequency range, if any.
+            maxfreq (float): upper limit of the frequency range, if any.
+
+        Returns:
+            matches (list): the same matches, with their listings filled in.
+        """
+        projects: dict[str, list[str]] = {}
+        for match in matches:
+            projects.setdefault(match.observation.project, []).append(match.sapid)
+        indexes = {
+            (project, sapid): index
+            for project, sapids in projects.items()
+            for sapid, index in self.frequency_index(project, sapids).items()
+        }
+        for match in matches:
+            match.listing = indexes[match.observation.project, match.sapid].select(
+                minfreq, maxfreq
+            )
+        return matches
+
+    def search_position(
+        self,
+        project: str,
+        ra: float,
+        dec: float,
+        radius: float,
+        duration: float = 0.0,
+        minfreq: Optional[float] = None,
+        maxfreq: Optional[float] = None,
+        resolve: bool = True,
+    ) -> list[SearchMatch]:
+        """Find all target SubArrayPointings within a radius of a position.
+
+        Args:
+            project (str): LTA project to search in, or "ALL".
+            ra (float): right ascension in degrees.
+            dec (float): declination in degrees.
+            radius (float): maximum separation in degrees.
+            duration (float): minimum duration of the observation in hours.
+            minfreq (float): lower limit of the frequency range, if any.
+            maxfreq (float): upper limit of the frequency range, if any.
+            resolve (bool): also list the dataproducts and SURLs of every match.
+
+        Returns:
+            matches (list): a SearchMatch per SubArrayPointing, nearest first.
+        """
+        self._set_project(project)
+        key = f"position/{project}/{ra:.6f}/{dec:.6f}/{radius}/{duration}"
+        found = self.cache.get(key)
+        if found is None:
+            found = [
+                {
+                    "observation": obs.to_dict(),
+                    "sapid": sapid,
+                    "separation": separation,
+                }
+                for obs, sapid, separation in self._cone_search(
+                    project, ra, dec, radius, duration
+                )
+            ]
+            self.cache.put(key, found)
+        matches = sorted(
+            (
+                SearchMatch(
+                    ObservationSummary.from_dict(match["observation"]),
+                    match["sapid"],
+                    match["separation"],
+                )
+                for match in found
+            ),
+            key=lambda match: match.separation,
+        )
+        if resolve:
+            self.resolve_matches(matches, minfreq, maxfreq)
+        return matches
+
+    def search_sasid(
+        self,
+        project: str,
+        obsid: str,
+        sapid: Optional[str] = None,
+        minfreq: Optional[float] = None,
+        maxfreq: Optional[float] = None,
+        resolve: bool = True,
+    ) -> list[SearchMatch]:
+        """Find the target SubArrayPointings of a SAS ID.
+
+        The SAS ID may be that of an Observation, which matches all its
+        SubArrayPointings, or of an AveragingPipeline, which matches every
+        SubArrayPointing it was run on.
+
+        Args:
+            project (str): LTA project to search in, or "ALL".
+            obsid (str): SAS ID of the Observation or AveragingPipeline.
+            sapid (str): only match this SubArrayPointing identifier, if given.
+            minfreq (float): lower limit of the frequency range, if any.
+            maxfreq (float): upper limit of the frequency range, if any.
+            resolve (bool): also list the dataproducts and SURLs of every match.
+
+        Returns:
+            matches (list): a SearchMatch per SubArrayPointing, empty if the SAS ID
+                was not found.
+        """
+        self._set_project(project)
+        key = f"observations/{project}/{obsid}"
+        found = self.cache.get(key)
+        if found is None:
+            with metrics.stage("sasid_lookup") as record:
+                found, record["round_trips"] = self._lookup_sasid(project, obsid)
+            self.cache.put(key, found)
+        matches = []
+        for match in found:
+            observation = ObservationSummary.from_dict(match["observation"])
+            for match_sapid in (
+                [match["sapid"]] if match["sapid"] else observation.sap_ids
+            ):
+                if not sapid or match_sapid == sapid:
+                    matches.append(SearchMatch(observation, match_sapid))
+        if resolve:
+            self.resolve_matches(matches, minfreq, maxfreq)
+        return matches
 
     def find_observation_by_position(
         self,
@@ -50,9 +762,64 @@ class ObservationStager:
         minfreq: Optional[float] = None,
         maxfreq: Optional[float] = None,
     ):
-        context.set_project(project)
-        if context.get_current_project().name != project:
-            raise ValueError(f"No permissions for project {project}")
+        matches = self.search_position(
+            project, ra, dec, radius, duration, minfreq, maxfreq, resolve=self.get_surls
+        )
+        target = None
+        num_observations = 0
+        uris = set()
+        selected = []
+        for match in matches:
+            print("== Target observation found ==")
+            target = match.observation
+            print(f"Project: {target.project}")
+            print(f"Obsid: {target.obsid}")
+            print(f"Duration: {target.duration} s")
+            print(f"Start time: {target.start_time}")
+            print(f"SAPI: {match.sapid}")
+            print("Distance: ", match.separation * u.deg)
+
+            if not self.get_surls:
+                # Dataproducts are only listed when SURLs are wanted.
+                num_observations += 1
+                continue
+            logger.info(f"Found {len(match.listing)} CorrelatedDataProducts")
+            if len(match.listing):
+                num_observations += 1
+            if num_observations < 2:
+                uris |= match.uris
+                selected += match.listing
+                if not uris:
+                    logger.critical("No stageable data matching filter criteria found.")
+                else:
+                    write_srm_list(f"srms_{target.obsid}.txt", selected)
+
+        if num_observations == 0:
+            logger.critical(
+                "No observations containing the target within specified parameters found."
+            )
+        elif num_observations == 1:
+            self.obsid = target.obsid
+            self.project = target.project
+            self.target = target
+            self.target_uris = uris
+            self.target_sizes = listing_sizes(selected)
+        else:
+            logger.warning(
+                "Multiple observations found, please manually stage preferred one."
+            )
+            sys.exit(0)
+
+    @_serialised
+    def _cone_search(
+        self, project: str, ra: float, dec: float, radius: float, duration: float
+    ) -> list[tuple[ObservationSummary, str, float]]:
+        """Find the SubArrayPointings within a radius and their target observations.
+
+        Returns:
+            matches (list): the observation, SubArrayPointing identifier and
+                separation in degrees of each match.
+        """
         if project == "ALL":
             query = SubArrayPointing.select_all()
         else:
@@ -61,102 +828,71 @@ class ObservationStager:
             query
             # This eliminates the tile beam
             & (SubArrayPointing.numberOfCorrelatedDataProducts > 1)
-            & (
-                (SubArrayPointing.pointing.rightAscension > ra - 5)
-                & (SubArrayPointing.pointing.rightAscension < ra + 5)
-            )
-            & (
-                (SubArrayPointing.pointing.declination > dec - 5)
-                & (SubArrayPointing.pointing.declination < dec + 5)
-            )
+            & pointing_box(ra, dec, 5)
         )
-        logger.info(f"Found {len(query)} potential SubArrayPointings.")
-        target = None
-        if True:
-            num_observations = 0
-            uris = set()
-            pos_target = SkyCoord(ra, dec, unit="deg")
+        with metrics.stage("cone_search", round_trips=1):
+            saps = list(query)
+        logger.info(f"Found {len(saps)} potential SubArrayPointings.")
+        if not saps:
+            return []
+        pos_target = SkyCoord(ra, dec, unit="deg")
+        pos_pointings = SkyCoord(
+            np.array([sap.pointing.rightAscension for sap in saps]),
+            np.array([sap.pointing.declination for sap in saps]),
+            unit="deg",
+        )
+        separations = pos_pointings.separation(pos_target).deg
+        candidates = [
+            (sap, separation)
+            for sap, separation in zip(saps, separations)
+            if separation < radius
+        ]
+        observations = self._observations_for_saps(
+            [sap for sap, _ in candidates], duration
+        )
+        return [
+            (
+                ObservationSummary.from_observation(observations[_object_key(sap)]),
+                sap.subArrayPointingIdentifier,
+                float(separation),
+            )
+            for sap, separation in candidates
+            if _object_key(sap) in observations
+        ]
 
-            for obs in query:
-                pos_pointing = SkyCoord(
-                    obs.pointing.rightAscension, obs.pointing.declination, unit="deg"
-                )
-                if pos_pointing.separation(pos_target).to("deg") < radius * u.deg:
-                    target_obs = obs
-                    observations = Observation.subArrayPointings.contains(target_obs)
-                    observations &= Observation.isValid == 1
-                    observations &= Observation.nrStationsCore > 0
-                    observations &= Observation.nrStationsRemote > 0
-                    observations &= Observation.nrStationsInternational > 8
-                    observations &= Observation.duration > 3600 * duration
-                    observations &= (Observation.antennaSet == "HBA Dual Inner") | (
-                        Observation.antennaSet == "HBA Dual"
-                    )
-                    observations = list(observations)
-                    if observations:
-                        print("== Target observation found ==")
-                        target = observations[0]
-                        print(f"Project: {target.get_project()}")
-                        print(f"Obsid: {target.observationId}")
-                        print(f"Duration: {target.duration} s")
-                        print(f"Start time: {target.startTime}")
-                        print(f"SAPI: {target_obs.subArrayPointingIdentifier}")
-                        print(
-                            "Distance: ", pos_pointing.separation(pos_target).to("deg")
-                        )
-
-                        dataproducts = (
-                            CorrelatedDataProduct.subArrayPointing.subArrayPointingIdentifier
-                            == target_obs.subArrayPointingIdentifier
-                        )
-                        dataproducts &= CorrelatedDataProduct.isValid == 1
-                        if minfreq:
-                            dataproducts &= (
-                                CorrelatedDataProduct.minimumFrequency >= minfreq
-                            )
-                        if maxfreq:
-                            dataproducts &= (
-                                CorrelatedDataProduct.maximumFrequency <= maxfreq
-                            )
-                        logger.info(f"Found {len(dataproducts)} CorrelatedDataProducts")
-                        if len(dataproducts):
-                            num_observations += 1
-                        if self.get_surls:
-                            if num_observations < 2:
-                                for dp in dataproducts:
-                                    fo = (
-                                        (FileObject.data_object == dp)
-                                        & (FileObject.isValid > 0)
-                                    ).max("creation_date")
-                                    if fo is not None:
-                                        uris.add(fo.URI)
-                                if not uris:
-                                    logger.critical(
-                                        "No stageable data matching filter criteria found."
-                                    )
-                                else:
-                                    with open(
-                                        f"srms_{target.observationId}.txt", "w"
-                                    ) as f:
-                                        for uri in sorted(uris):
-                                            f.write(uri + "\n")
-                else:
-                    continue
+    @_serialised
+    def _observations_for_saps(self, saps: list, duration: float) -> dict:
+        """Find the observations passing the target criteria for many SubArrayPointings.
 
-            if num_observations == 0:
-                logger.critical(
-                    "No observations containing the target within specified parameters found."
-                )
-            elif num_observations == 1:
-                self.obsid = target.observationId
-                self.project = target.get_project()
-                self.target = target
-                self.target_uris = uris
-            else:
-                logger.warning(
-                    "Multiple observations found, please manually stage preferred one."
-                )
-                sys.exit(0)
+        Args:
+            saps (list): SubArrayPointings to find observations for.
+            duration (float): minimum duration of the observation in hours.
+
+        Returns:
+            observations (dict): matching Observation per SubArrayPointing key.
+        """
+        keys = {_object_key(sap) for sap in saps}
+        observations = {}
+        for i in range(0, len(saps), self.surl_resolver.chunk_size):
+            chunk = saps[i : i + self.surl_resolver.chunk_size]
+            query = reduce(
+                or_, [Observation.subArrayPointings.contains(sap) for sap in chunk]
+            )
+            query &= Observation.isValid == 1
+            query &= Observation.nrStationsCore > 0
+            query &= Observation.nrStationsRemote > 0
+            query &= Observation.nrStationsInternational > 8
+            query &= Observation.duration > 3600 * duration
+            query &= (Observation.antennaSet == "HBA Dual Inner") | (
+                Observation.antennaSet == "HBA Dual"
+            )
+            with metrics.stage("observation_lookup", round_trips=1):
+                for obs in query:
+                    for sap in obs.subArrayPointings:
+                        key = _object_key(sap)
+                        if key in keys:
+                            observations.setdefault(key, obs)
+        return observations
 
     def find_observation_by_sasid(
         self,
@@ -168,89 +904,204 @@ class ObservationStager:
     ):
         self.sapid = sapid
         self.srm_prefix = f"srms_{obsid}"
-        context.set_project(project)
-        if context.get_current_project().name != project:
-            raise ValueError(f"No permissions for project {project}")
+        matches = self.search_sasid(
+            project, obsid, sapid, minfreq, maxfreq, resolve=self.get_surls
+        )
+        if not matches:
+            logger.critical(f"No valid Observation or AveragingPipeline {obsid} found.")
+            sys.exit(0)
+
+        observations = {match.observation.obsid for match in matches}
+        logger.info(f"== {len(observations)} target observation(s) found ==")
+        self.target = matches[0].observation
+        # All SubArrayPointings of the first observation, unless one was selected.
+        matches = [
+            match for match in matches if match.observation.obsid == self.target.obsid
+        ]
+        self.obsid = self.target.obsid
+        self.project = self.target.project
+        print_observation_details(
+            self.target, sapi=matches[0].sapid if len(matches) == 1 else ""
+        )
+
+        if self.get_surls:
+            logger.info("Obtaining SURLs for dataproducts")
+            dataproducts = [entry for match in matches for entry in match.listing]
+            self.target_uris = set().union(*(match.uris for match in matches))
+            self.target_sizes = listing_sizes(dataproducts)
+            logger.info(f"Found {len(self.target_uris)} CorrelatedDataProducts")
+            if not self.target_uris:
+                logger.critical("No valid URIs found for dataproducts.")
+                sys.exit(0)
+            write_srm_list(f"{self.srm_prefix}.txt", dataproducts, echo=True)
+
+    @_serialised
+    def _lookup_sasid(self, project: str, obsid: str) -> tuple[list[dict], int]:
+        """Find the target Observations for a SAS ID, via its AveragingPipelines if needed.
+
+        Returns:
+            found (list): the observation summary and, if it came from an
+                AveragingPipeline, the SubArrayPointing identifier per match.
+            round_trips (int): number of database queries made.
+        """
         if project == "ALL":
             query = Observation.select_all()
         else:
             query = Observation.select_all().project_only(project)
-
         query &= Observation.isValid == 1
         query &= Observation.observationId == obsid
-        if not len(query):
-            logger.warning(
-                f"No Observation with identifier {obsid} found, trying AveragingPipeline"
-            )
-            if project == "ALL":
-                query = AveragingPipeline.select_all()
-            else:
-                query = AveragingPipeline.select_all().project_only(project)
-            query &= AveragingPipeline.isValid == 1
-            query &= AveragingPipeline.observationId == obsid
-            if not len(query):
-                logger.critical("No valid AveragingPipeline products found either.")
-                sys.exit(0)
         observations = list(query)
+        round_trips = 1
+        if observations:
+            return [
+                {
+                    "observation": ObservationSummary.from_observation(obs).to_dict(),
+                    "sapid": "",
+                }
+                for obs in observations
+            ], round_trips
 
-        logger.info(f"== {len(observations)} target observation(s) found ==")
-        self.target = observations[0]
-        sapid = ""
-        if type(self.target) is AveragingPipeline:
-            sapid = self.target.sourceData[0].subArrayPointingIdentifier
-            self.target = self.target.sourceData[0].observations[0]
-        self.obsid = self.target.observationId
-        self.project = self.target.get_project()
-        print_observation_details(self.target, sapi=sapid)
+        logger.warning(
+            f"No Observation with identifier {obsid} found, trying AveragingPipeline"
+        )
+        if project == "ALL":
+            query = AveragingPipeline.select_all()
+        else:
+            query = AveragingPipeline.select_all().project_only(project)
+        query &= AveragingPipeline.isValid == 1
+        query &= AveragingPipeline.observationId == obsid
+        pipelines = list(query)
+        round_trips += 1
+        found = {}
+        for pipeline in pipelines:
+            for source in pipeline.sourceData:
+                for obs in source.observations:
+                    key = (obs.observationId, source.subArrayPointingIdentifier)
+                    if key not in found:
+                        found[key] = {
+                            "observation": ObservationSummary.from_observation(
+                                obs
+                            ).to_dict(),
+                            "sapid": source.subArrayPointingIdentifier,
+                        }
+        if not found:
+            logger.warning("No valid AveragingPipeline products found either.")
+        return list(found.values()), round_trips
 
-        uris = set()
-        self.obsid = self.target.observationId
-        self.project = self.target.get_project()
+    def plan_staging(
+        self,
+        sizes: dict[str, Optional[int]],
+        history: Optional[ThroughputHistory] = None,
+        max_request_size: Optional[int] = None,
+        max_volume: Optional[int] = None,
+    ) -> StagingPlan:
+        """Plan staging files, looking up the sizes that are not known in bulk.
 
-        if self.get_surls:
-            logger.info("Obtaining SURLs for dataproducts")
-            dataproducts = CorrelatedDataProduct.isValid == 1
-            if sapid:
-                dataproducts &= (
-                    CorrelatedDataProduct.subArrayPointing.subArrayPointingIdentifier
-                    == sapid
-                )
-            # SubArrayPointing identifier will already uniquely identify the beam.
-            if self.obsid and not sapid:
-                dataproducts = (
-                    CorrelatedDataProduct.observation.observationId == self.obsid
-                )
-            if minfreq:
-                dataproducts &= CorrelatedDataProduct.minimumFrequency >= minfreq
-            if maxfreq:
-                dataproducts &= CorrelatedDataProduct.maximumFrequency <= maxfreq
-            for dp in dataproducts:
-                fo = ((FileObject.data_object == dp) & (FileObject.isValid > 0)).max(
-                    "creation_date"
-                )
-                if fo is not None:
-                    uris.add(fo.URI)
-            logger.info(f"Found {len(uris)} CorrelatedDataProducts")
-            self.target_uris = uris
-            if not self.target_uris:
-                logger.critical("No valid URIs found for dataproducts.")
-                sys.exit(0)
-            with open(f"{self.srm_prefix}.txt", "w") as f:
-                for uri in sorted(uris):
-                    print(uri)
-                    f.write(uri + "\n")
-
-    def stage_calibrators(self) -> int:
-        logger.info("Staging calibrator data")
-        id = stage(list(self.calibrator_uris))
-        logger.info(f"Staging request submitted with staging ID {id}")
-        return id
-
-    def stage_target(self) -> int:
-        logger.info("Staging target data")
-        id = stage(list(self.target_uris))
-        logger.info(f"Staging request submitted with staging ID {id}")
-        return id
+        Args:
+            sizes (dict): size in bytes per SURL, None where it is not known.
+            history (ThroughputHistory): throughput measured on earlier runs.
+                Defaults to the one in the cache directory.
+            max_request_size (int): maximum number of bytes per StageIt request.
+            max_volume (int): maximum number of bytes to stage in total.
+
+        Returns:
+            plan (StagingPlan): the files per site and per StageIt request, with the
+                estimated volume and transfer time.
+        """
+        missing = [uri for uri, size in sizes.items() if size is None]
+        if missing and not self.cache.offline:
+            sizes = {**sizes, **self.surl_resolver.sizes(missing)}
+        return StagingPlan(
+            sizes,
+            history=history or ThroughputHistory(),
+            max_request_size=max_request_size,
+            max_volume=max_volume,
+        )
+
+    def _stage(
+        self,
+        sizes: dict[str, Optional[int]],
+        fname: str,
+        max_request_size: Optional[int] = None,
+        max_volume: Optional[int] = None,
+        dry_run: bool = False,
+    ) -> list[int]:
+        plan = self.plan_staging(
+            sizes, max_request_size=max_request_size, max_volume=max_volume
+        )
+        plan.log()
+        plan.write(fname)
+        logger.info(f"Staging plan written to {fname}")
+        if dry_run:
+            return []
+        ids = []
+        for uris in plan.requests:
+            id = stage(uris)
+            logger.info(
+                f"Staging request submitted with staging ID {id} for {len(uris)} files"
+            )
+            ids.append(id)
+        return ids
+
+    def stage_calibrators(
+        self,
+        max_request_size: Optional[int] = None,
+        max_volume: Optional[int] = None,
+        dry_run: bool = False,
+    ) -> list[int]:
+        """Stage the calibrator data, split into StageIt requests of bounded size.
+
+        The staging plan is written to srms_<obsid>_calibrators_plan.json.
+
+        Args:
+            max_request_size (int): maximum number of bytes per StageIt request.
+            max_volume (int): maximum number of bytes to stage in total. Files
+                beyond it are listed as deferred in the plan.
+            dry_run (bool): only plan, without submitting staging requests.
+
+        Returns:
+            ids (list): staging IDs of the submitted requests.
+        """
+        logger.info(
+            "Planning calibrator staging" if dry_run else "Staging calibrator data"
+        )
+        prefix = self.srm_prefix or f"srms_{self.target.obsid}"
+        return self._stage(
+            self.calibrator_sizes,
+            f"{prefix}_calibrators_plan.json",
+            max_request_size,
+            max_volume,
+            dry_run,
+        )
+
+    def stage_target(
+        self,
+        max_request_size: Optional[int] = None,
+        max_volume: Optional[int] = None,
+        dry_run: bool = False,
+    ) -> list[int]:
+        """Stage the target data, split into StageIt requests of bounded size.
+
+        The staging plan is written to srms_<obsid>_plan.json.
+
+        Args:
+            max_request_size (int): maximum number of bytes per StageIt request.
+            max_volume (int): maximum number of bytes to stage in total. Files
+                beyond it are listed as deferred in the plan.
+            dry_run (bool): only plan, without submitting staging requests.
+
+        Returns:
+            ids (list): staging IDs of the submitted requests.
+        """
+        logger.info("Planning target staging" if dry_run else "Staging target data")
+        prefix = self.srm_prefix or f"srms_{self.target.obsid}"
+        return self._stage(
+            self.target_sizes,
+            f"{prefix}_plan.json",
+            max_request_size,
+            max_volume,
+            dry_run,
+        )
 
     def find_nearest_calibrators(
         self,
@@ -259,47 +1110,117 @@ class ObservationStager:
         maxfreq: Optional[float] = None,
     ):
         logger.info("Searching for nearest calibrators.")
-        dt_obs = timedelta(seconds=self.target.duration)
-        dt = timedelta(hours=168)
-
-        obs_queries = Observation.select_all().project_only(self.project)
-        obs_queries &= (Observation.startTime > self.target.startTime - dt) & (
-            Observation.startTime < self.target.startTime + dt_obs + dt
-        )
-        obs_queries &= Observation.duration < 3600
-        obs_queries &= Observation.observationId != self.target.observationId
-
-        logger.info(f"Identified {len(obs_queries)} potential calibrators.")
-        calibrators = list(obs_queries)
-        closest_calibrators = sorted(
-            calibrators, key=lambda cal: abs(cal.startTime - self.target.startTime)
-        )[:n_calibrators]
+        key = self._calibrator_key(n_calibrators)
+        closest_calibrators = self.cache.get(key)
+        if closest_calibrators is None:
+            closest_calibrators = [
+                cal.to_dict() for cal in self._nearest_calibrators(n_calibrators)
+            ]
+            self.cache.put(key, closest_calibrators)
+        closest_calibrators = [
+            ObservationSummary.from_dict(cal) for cal in closest_calibrators
+        ]
         for i, cal in enumerate(closest_calibrators, start=1):
             logger.info(f"== Closest calibrator #{i} ==")
             print_observation_details(cal)
         if self.get_surls:
-            for cal in closest_calibrators:
-                saps = (
-                    CorrelatedDataProduct.subArrayPointing.subArrayPointingIdentifier
-                    == list(cal.subArrayPointings)[0].subArrayPointingIdentifier
+            uris = set()
+            selected = []
+            indexes = self.frequency_index(
+                self.project, [cal.sap_ids[0] for cal in closest_calibrators]
+            )
+            for index in indexes.values():
+                dataproducts = index.select(minfreq, maxfreq)
+                uris |= {entry[2] for entry in dataproducts if entry[2] is not None}
+                selected += dataproducts
+            self.calibrator_uris = uris
+            self.calibrator_sizes = listing_sizes(selected)
+            if self.srm_prefix:
+                fname = self.srm_prefix + "_calibrators.txt"
+            else:
+                fname = f"srms_{self.target.obsid}_calibrators.txt"
+            write_srm_list(fname, selected)
+            logger.info(
+                f"SURL resolution took {self.surl_resolver.round_trips} FileObject "
+                f"queries ({self.surl_resolver.elapsed:.2f} s) in total."
+            )
+
+    def _calibrator_key(self, n_calibrators: int) -> str:
+        return f"calibrators/{self.project}/{self.target.obsid}/{n_calibrators}"
+
+    def needs_calibrator_query(self, n_calibrators: int) -> bool:
+        """Whether finding the nearest calibrators has to query the database."""
+        if self.cache.offline:
+            return False
+        return self.cache.get(self._calibrator_key(n_calibrators)) is None
+
+    def calibrator_window(
+        self, window: timedelta = CALIBRATOR_WINDOWS[-1]
+    ) -> tuple[datetime, datetime]:
+        """Time window in which to search for calibrators of the target.
+
+        Args:
+            window (timedelta): how far before the start and after the end of the
+                target to search.
+        """
+        return (
+            self.target.start_time - window,
+            self.target.start_time + timedelta(seconds=self.target.duration) + window,
+        )
+
+    @_serialised
+    def calibrator_candidates(
+        self, project: str, start: datetime, end: datetime
+    ) -> list:
+        """Find calibrator candidates starting within a time window.
+
+        Args:
+            project (str): project to search in.
+            start (datetime): start of the time window.
+            end (datetime): end of the time window.
+
+        Returns:
+            candidates (list): Observation of every candidate.
+        """
+        candidates = self.calibrator_pool.find(project, start, end)
+        if candidates is not None:
+            return candidates
+        obs_queries = Observation.select_all().project_only(project)
+        obs_queries &= (Observation.startTime > start) & (Observation.startTime < end)
+        obs_queries &= Observation.duration < 3600
+        with metrics.stage("calibrator_query", round_trips=1):
+            candidates = list(obs_queries)
+        self.calibrator_pool.add(project, start, end, candidates)
+        return candidates
+
+    @_serialised
+    def _nearest_calibrators(self, n_calibrators: int) -> list[ObservationSummary]:
+        """Find the calibrators starting closest in time to the target.
+
+        The search window grows through CALIBRATOR_WINDOWS until it holds enough
+        candidates that are guaranteed to be nearer than anything outside it.
+        """
+        for window in CALIBRATOR_WINDOWS:
+            calibrators = [
+                cal
+                for cal in self.calibrator_candidates(
+                    self.project, *self.calibrator_window(window)
                 )
-                saps &= CorrelatedDataProduct.isValid == 1
-                if minfreq:
-                    saps &= CorrelatedDataProduct.minimumFrequency >= minfreq
-                if maxfreq:
-                    saps &= CorrelatedDataProduct.maximumFrequency <= maxfreq
-                uris = set()
-                for dp in saps:
-                    fo = (
-                        (FileObject.data_object == dp) & (FileObject.isValid > 0)
-                    ).max("creation_date")
-                    if fo is not None:
-                        uris.add(fo.URI)
-                self.calibrator_uris = uris
-                if self.srm_prefix:
-                    fname = self.srm_prefix + "_calibrators.txt"
-                else:
-                    fname = f"srms_{self.target.observationId}_calibrators.txt"
-                with open(fname, "w") as f:
-                    for uri in sorted(uris):
-                        f.write(uri + "\n")
+                if cal.observationId != self.target.obsid
+            ]
+            closest_calibrators = heapq.nsmallest(
+                n_calibrators,
+                calibrators,
+                key=lambda cal: abs(cal.startTime - self.target.start_time),
+            )
+            # Anything outside the window starts more than `window` from the target.
+            if len(closest_calibrators) == n_calibrators and (
+                not closest_calibrators
+                or abs(closest_calibrators[-1].startTime - self.target.start_time)
+                <= window
+            ):
+                break
+        logger.info(
+            f"Identified {len(calibrators)} potential calibrators within {window}."
+        )
+        return [ObservationSummary.from_observation(cal) for cal in closest_calibrators]
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import structlog
+
+logger = structlog.getLogger()
+
+
+class Metrics:
+    def __init__(self):
+        """Initialise a Metrics object.
+
+        A thread-safe collection of the time, bytes and database round trips spent
+        per pipeline stage, e.g. "surl_resolution", "download" or "extract", and per
+        LTA site for stages that transfer data.
+        """
+        self.started = time.time()
+        self.stages: dict[tuple[str, str], dict] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(
+        self,
+        name: str,
+        site: Optional[str] = None,
+        round_trips: int = 0,
+        **fields,
+    ) -> Iterator[dict]:
+        """Time a stage and record it when it finishes.
+
+        Args:
+            name (str): name of the stage.
+            site (str): LTA site the stage transfers data from, if any.
+            round_trips (int): number of database queries the stage makes, if known
+                in advance.
+            **fields: additional fields for the log event.
+
+        Yields:
+            record (dict): update "nbytes" and "round_trips" in it to record those.
+        """
+        record = {"nbytes": 0, "round_trips": round_trips}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.record(
+                name,
+                time.perf_counter() - start,
+                nbytes=record["nbytes"],
+                round_trips=record["round_trips"],
+                site=site,
+                **fields,
+            )
+
+    def record(
+        self,
+        name: str,
+        seconds: float,
+        nbytes: int = 0,
+        round_trips: int = 0,
+        site: Optional[str] = None,
+        **fields,
+    ):
+        """Record one run of a stage and emit it as a structured log event.
+
+        Args:
+            name (str): name of the stage.
+            seconds (float): time the stage took.
+            nbytes (int): number of bytes the stage transferred or wrote.
+            round_trips (int): number of database queries the stage made.
+            site (str): LTA site the stage transferred data from, if any.
+            **fields: additional fields for the log event, e.g. the URL.
+        """
+        with self._lock:
+            totals = self.stages.setdefault(
+                (name, site or ""),
+                {"count": 0, "seconds": 0.0, "nbytes": 0, "round_trips": 0},
+            )
+            totals["count"] += 1
+            totals["seconds"] += seconds
+            totals["nbytes"] += nbytes
+            totals["round_trips"] += round_trips
+        logger.debug(
+            f"{name} took {seconds:.3f} s",
+            stage=name,
+            seconds=seconds,
+            nbytes=nbytes,
+            round_trips=round_trips,
+            site=site,
+            **fields,
+        )
+
+    def summary(self) -> dict:
+        """Totals per stage and site, with throughput in MB/s for data stages."""
+        with self._lock:
+            stages = [
+                {"stage": name, "site": site or None, **totals}
+                for (name, site), totals in sorted(self.stages.items())
+            ]
+        for stage in stages:
+            if stage["nbytes"] and stage["seconds"]:
+                stage["throughput_mb_s"] = stage["nbytes"] / stage["seconds"] / 1e6
+        return {"wall_time": time.time() - self.started, "stages": stages}
+
+    def log_summary(self):
+        """Log the time spent per stage, largest first."""
+        summary = self.summary()
+        for stage in sorted(summary["stages"], key=lambda s: -s["seconds"]):
+            site = f" ({stage['site']})" if stage["site"] else ""
+            rate = (
+                f", {stage['throughput_mb_s']:.1f} MB/s"
+                if "throughput_mb_s" in stage
+                else ""
+            )
+            logger.info(
+                f"{stage['stage']}{site}: {stage['count']}x, {stage['seconds']:.2f} s, "
+                f"{stage['nbytes'] / 1e9:.2f} GB, {stage['round_trips']} queries{rate}."
+            )
+        logger.info(f"Total wall time {summary['wall_time']:.2f} s.")
+
+    def write_summary(self, path: str):
+        """Write the summary as JSON."""
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, path: str):
+        """Write the totals in the Prometheus text format, e.g. for the node exporter.
+
+        The file is replaced atomically, so a collector never reads a partial file.
+        """
+        metrics = {
+            "seconds": "Time spent in the stage.",
+            "nbytes": "Bytes transferred or written by the stage.",
+            "round_trips": "Database queries made by the stage.",
+            "count": "Number of times the stage ran.",
+        }
+        lines = []
+        with self._lock:
+            stages = sorted(self.stages.items())
+        for field, description in metrics.items():
+            name = f"flocs_lta_stage_{field}_total"
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} counter")
+            for (stage, site), totals in stages:
+                labels = f'stage="{stage}"' + (f',site="{site}"' if site else "")
+                lines.append(f"{name}{{{labels}}} {totals[field]}")
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+
+# Metrics of the current run, shared by all modules.
+metrics = Metrics()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+import errno
+import fcntl
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Optional
+
+import structlog
+
+from .cache import least_recently_used
+from .checksum import compare
+
+logger = structlog.getLogger()
+
+# ioctl that makes a file share the extents of another, on btrfs, XFS and others.
+FICLONE = 0x40049409
+# Errors meaning a hardlink cannot be made between this pair of paths.
+_NO_LINK = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP}
+
+
+def link_file(src: str, dst: str) -> str:
+    """Make `dst` a copy of `src` that takes no extra space where possible.
+
+    Tries a hardlink, then a reflink, and copies the file if neither is supported.
+
+    Args:
+        src (str): existing file.
+        dst (str): path to create.
+
+    Returns:
+        method (str): "hardlink", "reflink" or "copy".
+    """
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError as e:
+        if e.errno not in _NO_LINK:
+            raise
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return "reflink"
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+class Mirror:
+    def __init__(self, path: str, max_size: int = 2 << 40):
+        """Initialise a Mirror object.
+
+        A local store of LTA tarballs shared between download runs and output
+        directories, so that files several targets need, such as their calibrator
+        observations, are only transferred once. Output directories get hardlinks or
+        reflinks to the stored tarballs where the filesystem allows.
+
+        Tarballs are stored by file name, which identifies the data product and
+        ends in a hash of its content. An index in SQLite keeps their size,
+        checksums and when they were last used, to evict the least recently used
+        ones beyond `max_size`. Several processes may share a mirror.
+
+        Args:
+            path (str): directory to keep the tarballs and the index in, ideally on
+                the same filesystem as the output directories.
+            max_size (int): size in bytes above which least recently used tarballs
+                are evicted.
+        """
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        os.makedirs(os.path.join(self.path, "incoming"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(self.path, "index.sqlite"), timeout=60, check_same_thread=False
+        )
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "name TEXT PRIMARY KEY, size INTEGER, checksums TEXT, added REAL, used REAL)"
+            )
+        self.trim()
+
+    def object_path(self, name: str) -> str:
+        """Path of a stored tarball, in a directory per SAS ID."""
+        return os.path.join(self.path, "objects", name.split("_")[0], name)
+
+    def incoming_path(self, name: str) -> str:
+        """Unique path inside the mirror to write a tarball to before adding it."""
+        return os.path.join(self.path, "incoming", f"{name}.{uuid.uuid4().hex}")
+
+    def lookup(self, name: str, checksums: Optional[dict] = None) -> Optional[str]:
+        """Find a stored tarball and mark it as used.
+
+        Args:
+            name (str): file name of the tarball.
+            checksums (dict): checksums the tarball should have, e.g. from the LTA
+                catalogue. A stored tarball with different checksums is dropped.
+
+        Returns:
+            path (str): path of the stored tarball, or None if it is not stored.
+        """
+        path = self.object_path(name)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, checksums FROM files WHERE name = ?", (name,)
+            ).fetchone()
+        if row is None:
+            return None
+        size, stored = row
+        stored = json.loads(stored)
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            logger.warning(f"{name} is missing or incomplete in the mirror.")
+            self.remove(name)
+            return None
+        if checksums and compare(checksums, stored) is False:
+            logger.warning(f"Checksum of {name} in the mirror does not match.")
+            self.remove(name)
+            return None
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE files SET used = ? WHERE name = ?", (time.time(), name)
+            )
+        return path
+
+    def add(
+        self, name: str, src: str, checksums: Optional[dict] = None, move: bool = False
+    ):
+        """Store a tarball, evicting least recently used ones if the mirror is full.
+
+        Args:
+            name (str): file name of the tarball.
+            src (str): the complete tarball.
+            checksums (dict): checksums computed while transferring it, if any.
+            move (bool): move `src` into the mirror, e.g. a file written to
+                `incoming_path`, instead of linking or copying it.
+        """
+        path = self.object_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = os.path.getsize(src)
+        if move:
+            os.replace(src, path)
+        else:
+            tmp = self.incoming_path(name)
+            link_file(src, tmp)
+            os.replace(tmp, path)
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (name, size, json.dumps(checksums or {}), now, now),
+            )
+        self.trim()
+
+    def remove(self, name: str):
+        """Drop a tarball from the mirror."""
+        try:
+            os.remove(self.object_path(name))
+        except FileNotFoundError:
+            pass
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM files WHERE name = ?", (name,))
+
+    def size(self) -> int:
+        """Bytes stored in the mirror."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM files"
+            ).fetchone()[0]
+
+    def trim(self):
+        """Evict least recently used tarballs until the mirror fits in `max_size`."""
+        with self._lock:
+            evicted = least_recently_used(
+                self._db, "files", "name", "used", self.max_size
+            )
+        if not evicted:
+            return
+        for name in evicted:
+            # Hardlinks in output directories keep their data.
+            self.remove(name)
+        logger.info(
+            f"Evicted {len(evicted)} tarballs from the mirror in {self.path}, "
+            f"{self.size() / 1e12:.3f} TB left."
+        )
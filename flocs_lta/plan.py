@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+import structlog
+
+from .cache import default_cache_dir
+from .lta_download import group_by_site
+
+logger = structlog.getLogger()
+
+
+class ThroughputHistory:
+    def __init__(self, path: Optional[str] = None, weight: float = 0.3):
+        """Initialise a ThroughputHistory object.
+
+        Keeps the download throughput measured per LTA site on earlier runs, as an
+        exponentially weighted moving average, in a JSON file.
+
+        Args:
+            path (str): JSON file to keep the history in. Defaults to throughput.json
+                in the cache directory.
+            weight (float): weight of the newest run in the moving average.
+        """
+        if path is None:
+            os.makedirs(default_cache_dir(), exist_ok=True)
+            path = os.path.join(default_cache_dir(), "throughput.json")
+        self.path = path
+        self.weight = weight
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def rate(self, site: str) -> Optional[float]:
+        """Throughput in bytes per second of all downloads from a site together.
+
+        Args:
+            site (str): name of the LTA site, as in LTASite.
+
+        Returns:
+            rate (float): the average measured throughput, or None if none was.
+        """
+        return self._load().get(site, {}).get("rate")
+
+    def update(self, site: str, nbytes: int, seconds: float):
+        """Add the throughput of a run to the history.
+
+        Args:
+            site (str): name of the LTA site, as in LTASite.
+            nbytes (int): bytes downloaded from the site in the run.
+            seconds (float): wall time of the run.
+        """
+        if nbytes <= 0 or seconds <= 0:
+            return
+        measured = nbytes / seconds
+        with self._lock:
+            history = self._load()
+            entry = history.setdefault(site, {"rate": measured, "runs": 0})
+            entry["rate"] = self.weight * measured + (1 - self.weight) * entry["rate"]
+            entry["runs"] += 1
+            entry["updated"] = time.time()
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(history, f, indent=2)
+            os.replace(self.path + ".tmp", self.path)
+        logger.debug(f"Measured {measured / 1e6:.1f} MB/s from {site}.")
+
+    def record_run(self, results: list, seconds: float):
+        """Add the throughput per site of a download run to the history.
+
+        Args:
+            results (list): DownloadResults of the run.
+            seconds (float): wall time of the run.
+        """
+        downloaded = {
+            result.url: result.nbytes
+            for result in results
+            if result.status == "downloaded" and not result.mirrored
+        }
+        for site, urls in group_by_site(downloaded).items():
+            if site is not None:
+                self.update(site.value, sum(downloaded[url] for url in urls), seconds)
+
+
+class StagingPlan:
+    def __init__(
+        self,
+        sizes: dict[str, Optional[int]],
+        history: Optional[ThroughputHistory] = None,
+        max_request_size: Optional[int] = None,
+        max_volume: Optional[int] = None,
+    ):
+        """Initialise a StagingPlan object.
+
+        Groups the files to stage by LTA site, estimates the volume and transfer
+        time, and splits them into StageIt requests of bounded size. Files are kept
+        in SURL order, so that the subbands of an observation stay together.
+
+        Args:
+            sizes (dict): size in bytes per SURL, None where it is unknown. Unknown
+                sizes are estimated as the mean of the known ones.
+            history (ThroughputHistory): throughput measured on earlier runs, to
+                estimate the transfer time with.
+            max_request_size (int): maximum number of bytes per StageIt request.
+            max_volume (int): maximum number of bytes to stage in total. Files
+                beyond it are deferred.
+        """
+        known = [size for size in sizes.values() if size is not None]
+        self.mean_size = sum(known) / len(known) if known else 0
+        self.unknown_sizes = len(sizes) - len(known)
+        self.sizes = {
+            uri: size if size is not None else int(self.mean_size)
+            for uri, size in sorted(sizes.items())
+        }
+        self.max_request_size = max_request_size
+        self.max_volume = max_volume
+
+        self.staged: list[str] = []
+        self.deferred: list[str] = []
+        volume = 0
+        for uri, size in self.sizes.items():
+            if self.deferred or (max_volume and volume + size > max_volume):
+                self.deferred.append(uri)
+                continue
+            self.staged.append(uri)
+            volume += size
+
+        self.requests: list[list[str]] = []
+        request_size = 0
+        for uri in self.staged:
+            size = self.sizes[uri]
+            if not self.requests or (
+                max_request_size and request_size + size > max_request_size
+            ):
+                self.requests.append([])
+                request_size = 0
+            self.requests[-1].append(uri)
+            request_size += size
+
+        self.sites = {}
+        for site, uris in group_by_site(self.staged).items():
+            name = site.value if site is not None else "unknown"
+            nbytes = sum(self.sizes[uri] for uri in uris)
+            rate = history.rate(name) if history and site is not None else None
+            self.sites[name] = {
+                "files": len(uris),
+                "nbytes": nbytes,
+                "rate": rate,
+                "seconds": nbytes / rate if rate else None,
+            }
+
+    @property
+    def volume(self) -> int:
+        """Number of bytes to stage."""
+        return sum(self.sizes[uri] for uri in self.staged)
+
+    @property
+    def seconds(self) -> Optional[float]:
+        """Expected transfer time, downloading from all sites at the same time.
+
+        None if no throughput was measured for one of the sites.
+        """
+        seconds = [site["seconds"] for site in self.sites.values()]
+        if not seconds or None in seconds:
+            return None
+        return max(seconds)
+
+    def summary(self) -> dict:
+        return {
+            "files": len(self.staged),
+            "volume": self.volume,
+            "unknown_sizes": self.unknown_sizes,
+            "seconds": self.seconds,
+            "sites": self.sites,
+            "requests": self.requests,
+            "deferred": self.deferred,
+        }
+
+    def write(self, fname: str):
+        """Write the plan as JSON."""
+        with open(fname, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def log(self):
+        """Log the volume per site, the expected transfer time and the requests."""
+        for name, site in self.sites.items():
+            estimate = (
+                f", about {site['seconds'] / 3600:.1f} h at {site['rate'] / 1e6:.1f} MB/s"
+                if site["seconds"] is not None
+                else ", no throughput measured yet"
+            )
+            logger.info(
+                f"{name}: {site['files']} files to recall from tape, "
+                f"{site['nbytes'] / 1e12:.3f} TB{estimate}."
+            )
+        if self.unknown_sizes:
+            logger.warning(
+                f"Sizes of {self.unknown_sizes} files are unknown and estimated as "
+                f"{self.mean_size / 1e9:.2f} GB each."
+            )
+        total = (
+            f"{self.volume / 1e12:.3f} TB in {len(self.requests)} staging request(s)"
+        )
+        if self.seconds is not None:
+            total += f", transferred in about {self.seconds / 3600:.1f} h"
+        logger.info(f"Total: {total}.")
+        if self.deferred:
+            logger.warning(
+                f"{len(self.deferred)} files exceed the staging volume of "
+                f"{self.max_volume / 1e12:.3f} TB and are not staged."
+            )
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+import asyncio
+import time
+from typing import AsyncIterator, Optional
+
+import structlog
+
+from .lta_download import Downloader, merge_macaroons, site_from_url
+
+logger = structlog.getLogger()
+
+# StageIt statuses after which no more files will come online.
+FINAL_STATUSES = ("success", "partial success", "failed", "aborted")
+
+
+def _name(url: str) -> str:
+    """File name of a SURL or WebDAV URL, which identifies a file across both."""
+    return url.rstrip("/").split("/")[-1]
+
+
+def _site(url: str) -> Optional[str]:
+    try:
+        return site_from_url(url).value
+    except RuntimeError:
+        return None
+
+
+class StagingPoller:
+    def __init__(
+        self,
+        stage_id: int,
+        downloader: Downloader,
+        min_interval: float = 30.0,
+        max_interval: float = 600.0,
+        backoff: float = 2.0,
+        timeout: Optional[float] = None,
+    ):
+        """Initialise a StagingPoller object.
+
+        Polls a StageIt request and yields the WebDAV URLs of its files as soon as
+        their tape recall completes, so that they can be downloaded while the rest
+        of the request is still being staged. Polling speeds up to `min_interval`
+        while files keep coming online and backs off to `max_interval` while
+        nothing changes.
+
+        Macaroons are fetched again when files from a site without one come online,
+        and added to the macaroons of the downloader.
+
+        Args:
+            stage_id (int): StageIt staging ID.
+            downloader (Downloader): downloader that gets the macaroons.
+            min_interval (float): shortest time in seconds between polls.
+            max_interval (float): longest time in seconds between polls.
+            backoff (float): factor to lengthen the interval by after a poll in
+                which nothing came online, and to shorten it by after one in which
+                something did.
+            timeout (float): time in seconds after which to stop polling, if any.
+        """
+        self.stage_id = stage_id
+        self.downloader = downloader
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self.requested: dict[str, str] = {}
+        self.yielded: set[str] = set()
+        self.status: Optional[str] = None
+
+    def _poll(self) -> list[str]:
+        """Query StageIt once, returning the WebDAV URLs that are newly online."""
+        import stager_access
+
+        self.status = str(stager_access.get_status(self.stage_id)).lower()
+        online = {_name(surl) for surl in stager_access.get_surls_online(self.stage_id)}
+        if not self.requested or online - self.requested.keys():
+            self.requested = {
+                _name(url): url
+                for url in stager_access.get_webdav_urls_requested(self.stage_id)
+            }
+        ready = [
+            self.requested[name]
+            for name in sorted(online & self.requested.keys())
+            if name not in self.yielded
+        ]
+        # URLs of unknown sites are passed on, to be reported as failed downloads.
+        waiting = [
+            url
+            for url in ready
+            if _site(url) is not None and _site(url) not in self.downloader.macaroons
+        ]
+        if waiting:
+            macaroons = merge_macaroons(
+                stager_access.get_macaroons(self.stage_id) or {}
+            )
+            for site, macaroon in macaroons.items():
+                # Sessions already created keep using the macaroon they have.
+                self.downloader.macaroons.setdefault(site, macaroon)
+        return [
+            url
+            for url in ready
+            if url not in waiting or _site(url) in self.downloader.macaroons
+        ]
+
+    async def online_urls(self) -> AsyncIterator[str]:
+        """Yield WebDAV URLs as their files come online, until staging has finished.
+
+        Yields:
+            url (str): WebDAV URL of a file that is online.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        interval = self.min_interval
+        while True:
+            ready = await loop.run_in_executor(None, self._poll)
+            for url in ready:
+                self.yielded.add(_name(url))
+                yield url
+            finished = self.requested and self.yielded >= self.requested.keys()
+            if finished or self.status in FINAL_STATUSES:
+                break
+            if self.timeout is not None and time.monotonic() - start > self.timeout:
+                logger.warning(
+                    f"Stopped polling staging request {self.stage_id} after "
+                    f"{self.timeout:.0f} s."
+                )
+                break
+            if ready:
+                logger.info(
+                    f"{len(self.yielded)} of {len(self.requested)} files of staging "
+                    f"request {self.stage_id} online."
+                )
+                interval = max(self.min_interval, interval / self.backoff)
+            else:
+                interval = min(self.max_interval, interval * self.backoff)
+            await asyncio.sleep(interval)
+        missing = self.requested.keys() - self.yielded
+        if missing:
+            logger.error(
+                f"Staging request {self.stage_id} ended with status {self.status}; "
+                f"{len(missing)} files did not come online."
+            )
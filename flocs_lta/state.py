@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+import os
+import sqlite3
+import threading
+import time
+from enum import Enum
+from typing import Optional
+
+import structlog
+
+logger = structlog.getLogger()
+
+
+class DownloadStage(Enum):
+    QUEUED = "queued"
+    DOWNLOADING = "downloading"
+    DOWNLOADED = "downloaded"
+    EXTRACTED = "extracted"
+    COMPRESSED = "compressed"
+    VERIFIED = "verified"
+
+    def reached(self, other: "DownloadStage") -> bool:
+        """Whether this stage is `other` or a later one."""
+        stages = list(DownloadStage)
+        return stages.index(self) >= stages.index(other)
+
+
+class DownloadState:
+    def __init__(self, outdir: str, name: str = "download_state.sqlite"):
+        """Initialise a DownloadState object.
+
+        Records how far every URL got through the download pipeline, in an SQLite
+        database in the output directory, so that an interrupted run can continue
+        where it stopped.
+
+        Args:
+            outdir (str): output directory of the downloads.
+            name (str): file name of the database in `outdir`.
+        """
+        os.makedirs(outdir, exist_ok=True)
+        self.path = os.path.join(outdir, name)
+        self._lock = threading.Lock()
+        # Workers on the same node share the database, see Ledger.
+        self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS downloads ("
+                "url TEXT PRIMARY KEY, stage TEXT, path TEXT, offset INTEGER, "
+                "nbytes INTEGER, error TEXT, created REAL, updated REAL)"
+            )
+
+    def queue(self, urls: list[str]):
+        """Add URLs that are not tracked yet as queued."""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO downloads VALUES (?, ?, NULL, 0, 0, NULL, ?, ?)",
+                [(url, DownloadStage.QUEUED.value, now, now) for url in urls],
+            )
+
+    def stage(self, url: str) -> Optional[DownloadStage]:
+        """Stage a URL has completed, or None if it is not tracked."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT stage FROM downloads WHERE url = ?", (url,)
+            ).fetchone()
+        return DownloadStage(row[0]) if row else None
+
+    def update(
+        self,
+        url: str,
+        stage: DownloadStage,
+        path: Optional[str] = None,
+        offset: Optional[int] = None,
+        nbytes: Optional[int] = None,
+        error: Optional[str] = None,
+    ):
+        """Record that a URL reached a stage.
+
+        Args:
+            url (str): URL of the file.
+            stage (DownloadStage): stage the file reached.
+            path (str): local path of the file, if known.
+            offset (int): number of bytes already on disk when the transfer started.
+            nbytes (int): number of bytes transferred.
+            error (str): error that stopped the file from reaching the next stage.
+        """
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO downloads VALUES (?, ?, NULL, 0, 0, NULL, ?, ?)",
+                (url, stage.value, now, now),
+            )
+            self._db.execute(
+                "UPDATE downloads SET stage = ?, path = COALESCE(?, path), "
+                "offset = COALESCE(?, offset), nbytes = COALESCE(?, nbytes), "
+                "error = ?, updated = ? WHERE url = ?",
+                (stage.value, path, offset, nbytes, error, now, url),
+            )
+
+    def fail(self, url: str, error: str):
+        """Record an error for a URL without changing its stage."""
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE downloads SET error = ?, updated = ? WHERE url = ?",
+                (error, time.time(), url),
+            )
+
+    def summary(self) -> dict[str, int]:
+        """Number of tracked URLs per stage."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT stage, COUNT(*) FROM downloads GROUP BY stage"
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Iterator
+
+import structlog
+
+logger = structlog.getLogger()
+
+# Subtables a MeasurementSet cannot be calibrated without; they must have rows.
+REQUIRED_SUBTABLES = (
+    "ANTENNA",
+    "DATA_DESCRIPTION",
+    "FIELD",
+    "OBSERVATION",
+    "POLARIZATION",
+    "SPECTRAL_WINDOW",
+)
+SAMPLED_COLUMNS = ("DATA", "FLAG", "UVW")
+
+
+@dataclass
+class VerificationReport:
+    """Outcome of the deep verification of a MeasurementSet."""
+
+    ms: str
+    rows: int = 0
+    # Rows per subtable that could be opened.
+    subtables: dict = field(default_factory=dict)
+    missing_subtables: list = field(default_factory=list)
+    # Rows read and NaN or flag fraction per sampled column.
+    columns: dict = field(default_factory=dict)
+    errors: list = field(default_factory=list)
+    seconds: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors and not self.missing_subtables
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), "ok": self.ok}
+
+
+def block_order(nblocks: int) -> Iterator[int]:
+    """Indices of blocks spread over a table, from coarse to fine.
+
+    The first and last block come first, so that a truncated table shows up even
+    when there is time for little else. Every following pass halves the stride, so
+    that the blocks read when time runs out are spread evenly over the table.
+
+    Args:
+        nblocks (int): number of blocks in the table.
+
+    Yields:
+        index (int): index of the next block to read.
+    """
+    seen = set()
+    stride = 1
+    while stride < nblocks:
+        stride *= 2
+    for index in (0, nblocks - 1):
+        if index >= 0 and index not in seen:
+            seen.add(index)
+            yield index
+    while stride > 1:
+        stride //= 2
+        for index in range(0, nblocks, stride):
+            if index not in seen:
+                seen.add(index)
+                yield index
+
+
+def sample_column(ms: str, column: str, deadline: float, block_rows: int) -> dict:
+    """Read blocks of a column of a MeasurementSet until the deadline.
+
+    Runs in a worker process, which opens the table itself.
+
+    Args:
+        ms (str): path to the MeasurementSet.
+        column (str): column to read.
+        deadline (float): time.time() after which no more blocks are read, though
+            the first and last block always are.
+        block_rows (int): number of consecutive rows per read.
+
+    Returns:
+        stats (dict): rows read, and the fraction of values that are flagged for
+            FLAG, or that are NaN or infinite for other columns.
+    """
+    import casacore.tables as ct
+    import numpy as np
+
+    with ct.table(ms, ack=False) as tab:
+        nrows = tab.nrows()
+        nblocks = -(-nrows // block_rows)
+        rows = values = count = 0
+        for read, index in enumerate(block_order(nblocks)):
+            if read >= 2 and time.time() > deadline:
+                break
+            startrow = index * block_rows
+            nrow = min(block_rows, nrows - startrow)
+            data = tab.getcol(column, startrow=startrow, nrow=nrow)
+            rows += nrow
+            values += data.size
+            count += int(data.sum() if column == "FLAG" else (~np.isfinite(data)).sum())
+    fraction = count / values if values else 0.0
+    key = "flag_fraction" if column == "FLAG" else "nan_fraction"
+    return {"rows_read": rows, "rows": nrows, key: fraction}
+
+
+def count_rows(table: str) -> int:
+    """Number of rows of a (sub)table. Runs in a worker process."""
+    import casacore.tables as ct
+
+    with ct.table(table, ack=False) as tab:
+        return tab.nrows()
+
+
+def verify_ms(
+    ms: str, budget: float = 10.0, workers: int = 4, block_rows: int = 4096
+) -> VerificationReport:
+    """Check that a MeasurementSet is complete and its data readable.
+
+    The main table and its subtables are opened and read in parallel worker
+    processes. DATA, FLAG and UVW are read in blocks spread evenly over the table
+    until `budget` runs out, so that the check takes about the same time for every
+    MeasurementSet, however large.
+
+    Args:
+        ms (str): path to the MeasurementSet.
+        budget (float): seconds to spend on reading columns.
+        workers (int): number of worker processes.
+        block_rows (int): number of consecutive rows per read.
+
+    Returns:
+        report (VerificationReport): row counts, NaN and flag fractions, missing
+            subtables and errors found.
+    """
+    import casacore.tables as ct
+
+    start = time.time()
+    report = VerificationReport(ms)
+    try:
+        with ct.table(ms, ack=False) as tab:
+            report.rows = tab.nrows()
+            columns = tab.colnames()
+            keywords = tab.getkeywords()
+    except RuntimeError as e:
+        report.errors.append(f"Cannot open main table: {e}")
+        report.seconds = time.time() - start
+        return report
+    subtables = sorted(
+        name
+        for name, value in keywords.items()
+        if isinstance(value, str) and value.startswith("Table:")
+    )
+    report.missing_subtables = [
+        name
+        for name in REQUIRED_SUBTABLES
+        if name not in subtables or not os.path.isdir(os.path.join(ms, name))
+    ]
+    for column in SAMPLED_COLUMNS:
+        if column not in columns:
+            report.errors.append(f"Column {column} is missing.")
+    if report.rows == 0:
+        report.errors.append("Main table has no rows.")
+
+    deadline = start + budget
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        column_futures = {
+            column: pool.submit(sample_column, ms, column, deadline, block_rows)
+            for column in SAMPLED_COLUMNS
+            if column in columns and report.rows
+        }
+        subtable_futures = {
+            name: pool.submit(count_rows, os.path.join(ms, name))
+            for name in subtables
+            if name not in report.missing_subtables
+        }
+        for column, future in column_futures.items():
+            try:
+                report.columns[column] = future.result()
+            except (OSError, RuntimeError) as e:
+                report.errors.append(f"Cannot read column {column}: {e}")
+        for name, future in subtable_futures.items():
+            try:
+                report.subtables[name] = future.result()
+            except (OSError, RuntimeError) as e:
+                report.errors.append(f"Cannot open subtable {name}: {e}")
+    for name in REQUIRED_SUBTABLES:
+        if report.subtables.get(name) == 0:
+            report.errors.append(f"Subtable {name} has no rows.")
+    report.seconds = time.time() - start
+    return report
@@ -0,0 +1,532 @@
+#!/usr/bin/env python
+import http.client
+import json
+import os
+import queue
+import ssl
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterator, Optional
+from urllib.parse import urlencode, urljoin, urlsplit
+
+import structlog
+
+from .checksum import Checksum, adler32_combine, parse_digest
+
+logger = structlog.getLogger()
+
+# Same statuses wget was told to retry on, plus transient gateway errors.
+RETRY_STATUSES = {401, 500, 502, 503, 504}
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+# RFC 3230 checksums the LTA dCache WebDAV doors can report.
+WANT_DIGEST = "adler32, md5"
+
+
+class HTTPError(RuntimeError):
+    def __init__(self, status: int, reason: str):
+        super().__init__(f"HTTP {status} {reason}")
+        self.status = status
+        self.reason = reason
+
+
+class RateLimiter:
+    def __init__(self, rate: float, burst: float = 1.0):
+        """Initialise a RateLimiter object.
+
+        A thread-safe limit on the combined rate at which data is transferred.
+
+        Args:
+            rate (float): maximum rate in bytes per second.
+            burst (float): number of seconds of unused capacity that may be caught up.
+        """
+        self.rate = rate
+        self.burst = burst
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes: int):
+        """Account for transferred bytes, sleeping as long as needed to stay under the rate."""
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now - self.burst) + nbytes / self.rate
+            delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+@dataclass
+class DownloadResult:
+    """Outcome of downloading a single URL."""
+
+    url: str
+    path: str
+    status: str
+    http_status: Optional[int] = None
+    nbytes: int = 0
+    elapsed: float = 0.0
+    error: Optional[str] = None
+    dysco: Optional[bool] = None
+    checksums: dict = field(default_factory=dict)
+    remote_checksums: dict = field(default_factory=dict)
+    # Seconds and bytes per post-processing stage, measured where it ran.
+    timings: dict = field(default_factory=dict)
+    # Report of the verification of the MeasurementSet, see verify.VerificationReport.
+    verification: dict = field(default_factory=dict)
+    # Whether the tarball came from the local mirror instead of the LTA.
+    mirrored: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.status in ("downloaded", "skipped")
+
+
+class WebDAVSession:
+    def __init__(
+        self,
+        macaroon: str,
+        max_connections: int = 16,
+        retries: int = 5,
+        backoff: float = 2.0,
+        timeout: float = 300.0,
+        verify_tls: bool = False,
+        bufsize: int = 8 << 20,
+        min_segment_size: int = 256 << 20,
+        rate_limiter: Optional[RateLimiter] = None,
+    ):
+        """Initialise a WebDAVSession object.
+
+        Keeps a pool of keep-alive connections per host, so that consecutive
+        downloads from the same LTA site reuse connections and TLS sessions.
+
+        Args:
+            macaroon (str): macaroon authorising access to the site.
+            max_connections (int): maximum number of idle connections kept per host.
+            retries (int): number of times to retry a request on a retryable error.
+            backoff (float): base of the exponential backoff between retries, in seconds.
+            timeout (float): socket timeout in seconds.
+            verify_tls (bool): verify server certificates.
+            bufsize (int): size of the read buffer used when writing to disk.
+            min_segment_size (int): smallest byte range a file is split into when
+                downloading it in segments.
+            rate_limiter (RateLimiter): limits the rate at which data is read, can be
+                shared between sessions.
+        """
+        self.macaroon = macaroon
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.bufsize = bufsize
+        self.min_segment_size = min_segment_size
+        self.rate_limiter = rate_limiter
+        self.checkpoint_interval = 64 << 20
+        self.verify_tls = verify_tls
+        self.ssl_context = self._ssl_context()
+        self._pools: dict[tuple[str, str], queue.LifoQueue] = {}
+
+    def __getstate__(self) -> dict:
+        # Connections and SSL contexts cannot be pickled; workers build their own.
+        state = self.__dict__.copy()
+        state["_pools"] = {}
+        del state["ssl_context"]
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.ssl_context = self._ssl_context()
+
+    def _ssl_context(self) -> ssl.SSLContext:
+        context = ssl.create_default_context()
+        if not self.verify_tls:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def _pool(self, scheme: str, netloc: str) -> queue.LifoQueue:
+        return self._pools.setdefault((scheme, netloc), queue.LifoQueue())
+
+    def _acquire(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        try:
+            conn = self._pool(scheme, netloc).get_nowait()
+            conn.reused = True
+            return conn
+        except queue.Empty:
+            pass
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(
+                netloc, timeout=self.timeout, context=self.ssl_context
+            )
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        conn.pool_key = (scheme, netloc)
+        conn.reused = False
+        return conn
+
+    def _release(
+        self,
+        conn: http.client.HTTPConnection,
+        response: Optional[http.client.HTTPResponse] = None,
+    ):
+        """Return a connection to its pool if it can be reused, close it otherwise."""
+        reusable = (
+            response is not None and response.isclosed() and not response.will_close
+        )
+        pool = self._pool(*conn.pool_key)
+        if reusable and pool.qsize() < self.max_connections:
+            pool.put(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        for pool in self._pools.values():
+            while not pool.empty():
+                pool.get_nowait().close()
+        self._pools.clear()
+
+    def authorise(self, url: str) -> str:
+        """Append the macaroon to a URL."""
+        separator = "&" if urlsplit(url).query else "?"
+        return url + separator + urlencode({"authz": self.macaroon})
+
+    @contextmanager
+    def open(
+        self, url: str, headers: Optional[dict] = None
+    ) -> Iterator[http.client.HTTPResponse]:
+        """Send a GET request, following redirects and retrying on transient errors.
+
+        Args:
+            url (str): URL to request, without authorisation.
+            headers (dict): additional request headers.
+
+        Yields:
+            response (HTTPResponse): the successful response.
+
+        Raises:
+            HTTPError: when the server keeps returning an error status.
+        """
+        conn, response = self._request(url, headers or {})
+        try:
+            yield response
+        finally:
+            self._release(conn, response)
+
+    def _request(
+        self, url: str, headers: dict
+    ) -> tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        target = self.authorise(url)
+        attempt = 0
+        redirects = 0
+        while True:
+            attempt += 1
+            parts = urlsplit(target)
+            conn = self._acquire(parts.scheme, parts.netloc)
+            path = parts.path + ("?" + parts.query if parts.query else "")
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                if conn.reused:
+                    # The server closed an idle keep-alive connection; not an error.
+                    attempt -= 1
+                    continue
+                if attempt > self.retries:
+                    raise
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if response.status in REDIRECT_STATUSES and redirects < 10:
+                    location = response.getheader("Location")
+                    response.read()
+                    self._release(conn, response)
+                    target = urljoin(target, location)
+                    redirects += 1
+                    attempt -= 1
+                    continue
+                if response.status < 400:
+                    return conn, response
+                response.read()
+                self._release(conn, response)
+                if response.status not in RETRY_STATUSES or attempt > self.retries:
+                    raise HTTPError(response.status, response.reason)
+                error = f"HTTP {response.status} {response.reason}"
+            delay = self.backoff**attempt
+            logger.warning(
+                f"Request for {url} failed ({error}), retrying in {delay:.0f} s."
+            )
+            time.sleep(delay)
+
+    def download(
+        self, url: str, path: str, segments: int = 1, checksum: bool = False
+    ) -> DownloadResult:
+        """Download a URL to a file.
+
+        Data is first written to `path` + ".part" and moved into place once
+        complete, so an existing `path` is always a complete download. An existing
+        ".part" file is resumed with an HTTP Range request instead of starting over.
+
+        Args:
+            url (str): URL to download.
+            path (str): file to write to.
+            segments (int): split large files in up to this many byte ranges that
+                are downloaded concurrently.
+            checksum (bool): compute the checksums of the file while it arrives, and
+                ask the server for its checksums. Segmented downloads only get an
+                Adler-32 checksum, as MD5 cannot be combined from separate ranges.
+
+        Returns:
+            result (DownloadResult): outcome of the download.
+        """
+        if os.path.exists(path):
+            return DownloadResult(url, path, "skipped")
+        start = time.perf_counter()
+        partial = path + ".part"
+        digests = {}
+        remote = {} if checksum else None
+        try:
+            total = self.content_length(url, remote) if segments > 1 else None
+            if total and total >= 2 * self.min_segment_size:
+                segments = min(segments, total // self.min_segment_size)
+                nbytes, adler32 = self._download_ranges(url, partial, total, segments)
+                if checksum:
+                    digests = {"adler32": f"{adler32:08x}"}
+            else:
+                hasher = Checksum() if checksum else None
+                nbytes = self._download_stream(url, partial, hasher, remote)
+                if hasher is not None:
+                    digests = hasher.hexdigests()
+            os.replace(partial, path)
+        except HTTPError as e:
+            return DownloadResult(
+                url,
+                path,
+                "failed",
+                http_status=e.status,
+                elapsed=time.perf_counter() - start,
+                error=str(e),
+            )
+        except (OSError, http.client.HTTPException) as e:
+            return DownloadResult(
+                url,
+                path,
+                "failed",
+                elapsed=time.perf_counter() - start,
+                error=f"{type(e).__name__}: {e}",
+            )
+        return DownloadResult(
+            url,
+            path,
+            "downloaded",
+            http_status=200,
+            nbytes=nbytes,
+            elapsed=time.perf_counter() - start,
+            checksums=digests,
+            remote_checksums=remote or {},
+        )
+
+    def content_length(self, url: str, remote: Optional[dict] = None) -> Optional[int]:
+        """Get the size of a file, if the server supports Range requests for it.
+
+        Args:
+            url (str): URL to query.
+            remote (dict): if given, ask for the checksums of the file and add those
+                the server reports in a Digest header.
+
+        Returns:
+            size (int): size of the file in bytes, or None if ranges are not supported.
+        """
+        headers = {"Range": "bytes=0-0"}
+        if remote is not None:
+            headers["Want-Digest"] = WANT_DIGEST
+        with self.open(url, headers) as response:
+            if remote is not None:
+                remote.update(parse_digest(response.getheader("Digest")))
+            content_range = response.getheader("Content-Range", "")
+            if response.status != 206 or "/" not in content_range:
+                # Leaving the body unread makes the pool drop the connection.
+                return None
+            response.read()
+        total = content_range.rsplit("/", 1)[1]
+        return int(total) if total.isdigit() else None
+
+    def _download_stream(
+        self,
+        url: str,
+        partial: str,
+        checksum: Optional[Checksum] = None,
+        remote: Optional[dict] = None,
+    ) -> int:
+        """Download a URL in one stream, resuming a partial file if there is one.
+
+        When resuming, `checksum` is first fed the part of the file already on disk.
+        """
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        if remote is not None:
+            headers["Want-Digest"] = WANT_DIGEST
+        try:
+            with self.open(url, headers) as response:
+                if remote is not None:
+                    remote.update(parse_digest(response.getheader("Digest")))
+                if response.status != 206:
+                    offset = 0
+                if offset:
+                    logger.info(f"Resuming {url} from byte {offset}.")
+                with open(partial, "r+b" if offset else "wb") as f:
+                    if checksum is not None and offset:
+                        f.seek(0)
+                        while f.tell() < offset:
+                            checksum.update(
+                                f.read(min(self.bufsize, offset - f.tell()))
+                            )
+                    f.seek(offset)
+                    return self._copy(response, f, checksum)
+        except HTTPError as e:
+            if e.status != 416:
+                raise
+            # The partial file does not match the remote file; start over.
+            os.remove(partial)
+            if checksum is not None:
+                checksum.reset()
+            return self._download_stream(url, partial, checksum, remote)
+
+    def _download_ranges(
+        self, url: str, partial: str, total: int, segments: int
+    ) -> tuple[int, int]:
+        """Download a URL as concurrent byte ranges into a preallocated file.
+
+        Progress is recorded in a ".ranges" file next to the partial file, so an
+        interrupted download resumes each range where it stopped. Every range keeps
+        the Adler-32 checksum of its bytes so far, and those are combined at the end.
+
+        Returns:
+            received (int): number of bytes transferred.
+            adler32 (int): Adler-32 checksum of the whole file.
+        """
+        ranges_file = partial + ".ranges"
+        ranges = None
+        if os.path.exists(partial) and os.path.exists(ranges_file):
+            with open(ranges_file) as f:
+                state = json.load(f)
+            if state["total"] == total:
+                ranges = state["ranges"]
+                logger.info(f"Resuming {url} from {ranges_file}.")
+        if ranges is None:
+            step = -(-total // segments)
+            ranges = [
+                [first, min(first + step, total) - 1, 0, 1]
+                for first in range(0, total, step)
+            ]
+        fd = os.open(partial, os.O_RDWR | os.O_CREAT, 0o644)
+        lock = threading.Lock()
+
+        def checkpoint():
+            with lock, open(ranges_file + ".tmp", "w") as f:
+                json.dump({"total": total, "ranges": ranges}, f)
+            os.replace(ranges_file + ".tmp", ranges_file)
+
+        try:
+            try:
+                os.posix_fallocate(fd, 0, total)
+            except (AttributeError, OSError):
+                os.ftruncate(fd, total)
+            for segment in ranges:
+                if len(segment) < 4:
+                    # Checkpoint written without checksums; hash what is on disk.
+                    segment.append(self._adler32(fd, segment[0], segment[2]))
+            todo = [
+                segment for segment in ranges if segment[0] + segment[2] <= segment[1]
+            ]
+            received = 0
+            with ThreadPoolExecutor(max_workers=len(todo) or 1) as tex:
+                futures = [
+                    tex.submit(self._fetch_range, url, fd, segment, checkpoint)
+                    for segment in todo
+                ]
+                for future in futures:
+                    received += future.result()
+        finally:
+            os.close(fd)
+            checkpoint()
+        os.remove(ranges_file)
+        adler32 = 1
+        for first, last, _, segment_adler32 in ranges:
+            adler32 = adler32_combine(adler32, segment_adler32, last + 1 - first)
+        return received, adler32
+
+    def _adler32(self, fd: int, offset: int, length: int) -> int:
+        """Adler-32 checksum of a part of a file, read with pread."""
+        checksum = Checksum(md5=False)
+        end = offset + length
+        while offset < end:
+            data = os.pread(fd, min(self.bufsize, end - offset), offset)
+            if not data:
+                break
+            checksum.update(data)
+            offset += len(data)
+        return checksum.adler32
+
+    def _fetch_range(self, url: str, fd: int, segment: list, checkpoint) -> int:
+        """Download one byte range and write it at its offset with pwrite.
+
+        The segment is [first byte, last byte, bytes done, Adler-32 of bytes done].
+        """
+        first, last, done, _ = segment
+        headers = {"Range": f"bytes={first + done}-{last}"}
+        buf = bytearray(min(self.bufsize, 1 << 20))
+        view = memoryview(buf)
+        received = 0
+        since_checkpoint = 0
+        with self.open(url, headers) as response:
+            if response.status != 206:
+                raise HTTPError(response.status, "Range request not honoured")
+            while True:
+                n = response.readinto(buf)
+                if not n:
+                    break
+                if self.rate_limiter is not None:
+                    self.rate_limiter.consume(n)
+                os.pwrite(fd, view[:n], first + segment[2])
+                # One assignment, so a checkpoint never pairs a length with the
+                # checksum of a different length.
+                segment[2:4] = [segment[2] + n, zlib.adler32(view[:n], segment[3])]
+                received += n
+                since_checkpoint += n
+                if since_checkpoint >= self.checkpoint_interval:
+                    checkpoint()
+                    since_checkpoint = 0
+        if first + segment[2] != last + 1:
+            raise http.client.IncompleteRead(b"", last + 1 - first - segment[2])
+        return received
+
+    def _copy(
+        self,
+        response: http.client.HTTPResponse,
+        f,
+        checksum: Optional[Checksum] = None,
+    ) -> int:
+        """Copy a response body to a file through one reusable buffer.
+
+        If given, `checksum` is updated with every block as it is written.
+        """
+        buf = bytearray(self.bufsize)
+        view = memoryview(buf)
+        nbytes = 0
+        while True:
+            n = response.readinto(buf)
+            if not n:
+                break
+            if self.rate_limiter is not None:
+                self.rate_limiter.consume(n)
+            f.write(view[:n])
+            if checksum is not None:
+                checksum.update(view[:n])
+            nbytes += n
+        expected = response.getheader("Content-Length")
+        if expected is not None and nbytes != int(expected):
+            raise http.client.IncompleteRead(b"", int(expected) - nbytes)
+        return nbytes
@@ -0,0 +1,79 @@
+import os
+import stat
+
+import pytest
+
+from flocs_lta.compress import DyscoCompressor
+from flocs_lta.lta_download import Downloader
+
+# Copies msin to msout like DP3, or leaves a partial msout and fails.
+_DP3 = """#!/bin/sh
+for arg in "$@"; do
+    case "$arg" in
+        msin=*) msin="${arg#msin=}" ;;
+        msout=*) msout="${arg#msout=}" ;;
+    esac
+done
+if [ -n "$DP3_FAIL" ]; then
+    mkdir "$msout"
+    echo "DP3 crashed" >&2
+    exit 1
+fi
+cp -r "$msin" "$msout"
+touch "$msout/dysco"
+"""
+
+
+@pytest.fixture
+def dp3(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "DP3"
+    script.write_text(_DP3)
+    script.chmod(script.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.delenv("CWL_SINGULARITY_CACHE", raising=False)
+    monkeypatch.delenv("DP3_FAIL", raising=False)
+    return script
+
+
+@pytest.fixture
+def ms(tmp_path):
+    ms = tmp_path / "L123456_SB000_uv.MS"
+    ms.mkdir()
+    (ms / "table.dat").write_bytes(b"data")
+    archive = tmp_path / "L123456_SB000_uv.MS_abc.tar"
+    archive.write_bytes(b"tarball")
+    return ms, archive
+
+
+def test_compress_replaces_ms_and_removes_archive(dp3, ms):
+    ms, archive = ms
+    compressor = DyscoCompressor()
+    assert compressor.available
+    compressor.compress(str(ms), str(archive))
+    assert (ms / "dysco").exists()
+    assert (ms / "table.dat").read_bytes() == b"data"
+    assert not os.path.exists(f"{ms}.nodysco")
+    assert not archive.exists()
+
+
+def test_failing_dp3_restores_original(dp3, ms, monkeypatch):
+    ms, archive = ms
+    monkeypatch.setenv("DP3_FAIL", "1")
+    with pytest.raises(RuntimeError, match="DP3 crashed"):
+        DyscoCompressor().compress(str(ms), str(archive))
+    assert sorted(os.listdir(ms)) == ["table.dat"]
+    assert not os.path.exists(f"{ms}.nodysco")
+    assert archive.exists()
+
+
+def test_zero_compress_workers_is_clamped(tmp_path):
+    results = Downloader([], {}).download_all(
+        1,
+        extract=False,
+        outdir=str(tmp_path),
+        min_free_space=None,
+        compress_workers=0,
+    )
+    assert results == []
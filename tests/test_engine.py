@@ -0,0 +1,40 @@
+import pytest
+
+from flocs_lta.engine import DownloadEngine
+from flocs_lta.lta_download import Downloader
+
+URL = "https://webdav.grid.surfsara.nl/lofar/L123456_SB000_uv.MS_abc.tar"
+
+
+def _download(outdir) -> list:
+    return Downloader([URL], {"SURF": "macaroon"}).download_all(
+        1, extract=True, outdir=str(outdir), min_free_space=None
+    )
+
+
+def test_existing_ms_is_left_alone_across_runs(tmp_path):
+    ms = tmp_path / "L123456" / "L123456_SB000_uv.MS"
+    ms.mkdir(parents=True)
+    (ms / "table.dat").write_bytes(b"data")
+    for _ in range(2):
+        (result,) = _download(tmp_path)
+        assert result.status == "skipped"
+        assert (ms / "table.dat").read_bytes() == b"data"
+
+
+class RecordingCompressor:
+    def compress(self, ms: str, archive):
+        self.calls = [(ms, archive)]
+
+
+@pytest.mark.parametrize("keep_archive", [False, True])
+def test_compression_removes_archive_only_when_not_kept(keep_archive):
+    compressor = RecordingCompressor()
+    engine = DownloadEngine(Downloader([], {}), compressor=compressor)
+    engine._compress(URL, "/data/L123456_SB000_uv.MS_abc.tar", keep_archive)
+    assert compressor.calls == [
+        (
+            "/data/L123456_SB000_uv.MS",
+            None if keep_archive else "/data/L123456_SB000_uv.MS_abc.tar",
+        )
+    ]
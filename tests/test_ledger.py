@@ -0,0 +1,109 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+
+from benchmarks.server import TarballServer
+from flocs_lta.ledger import Ledger
+from flocs_lta.lta_download import Downloader, ms_path
+
+_WORKER = """
+import json, sys
+from flocs_lta.ledger import Ledger
+from flocs_lta.lta_download import Downloader
+args = json.loads(sys.argv[1])
+results = Downloader(args["urls"], {"SURF": "macaroon"}).download_all(
+    1,
+    extract=False,
+    outdir=args["outdir"],
+    min_free_space=None,
+    ledger=Ledger(args["outdir"], lease=30.0, poll=0.2),
+)
+print(json.dumps([result.url for result in results if result.ok]))
+"""
+
+
+def test_workers_share_downloads_and_give_up_on_failures(tmp_path):
+    root = tmp_path / "lta"
+    root.mkdir()
+    names = [f"L123456_SB{sb:03d}_uv.MS_abc.tar" for sb in range(6)]
+    for name in names:
+        (root / name).write_bytes(os.urandom(64 << 10))
+    outdir = tmp_path / "out"
+    with TarballServer(str(root)) as server:
+        missing = server.url("L123456_SB999_uv.MS_abc.tar")
+        urls = [server.url(name) for name in names] + [missing]
+        args = json.dumps({"urls": urls, "outdir": str(outdir)})
+        processes = [
+            subprocess.Popen(
+                [sys.executable, "-c", _WORKER, args],
+                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                stdout=subprocess.PIPE,
+                text=True,
+            )
+            for _ in range(3)
+        ]
+        try:
+            outputs = [process.communicate(timeout=120)[0] for process in processes]
+        finally:
+            for process in processes:
+                process.kill()
+
+    assert [process.returncode for process in processes] == [0, 0, 0]
+    downloaded = [
+        url for output in outputs for url in json.loads(output.splitlines()[-1])
+    ]
+    # Every file is downloaded by exactly one worker.
+    assert sorted(downloaded) == sorted(urls[:-1])
+    ledger = outdir / ".ledger"
+    assert not os.listdir(ledger / "todo")
+    assert not os.listdir(ledger / "claimed")
+    assert len(os.listdir(ledger / "done")) == len(names)
+    (failed,) = os.listdir(ledger / "failed")
+    entry = json.loads((ledger / "failed" / failed).read_text())
+    assert entry["url"] == missing
+    assert entry["attempts"] == 3
+    # The download state is kept per node, not in outdir.
+    assert len(list(ledger.glob("state.*.sqlite"))) == 1
+    assert not (outdir / "download_state.sqlite").exists()
+
+
+def test_worker_discards_output_of_a_crashed_worker(tmp_path):
+    root = tmp_path / "lta"
+    root.mkdir()
+    names = [f"L123456_SB{sb:03d}_uv.MS_abc.tar" for sb in range(2)]
+    for name in names:
+        (root / name).write_bytes(os.urandom(64 << 10))
+    outdir = tmp_path / "out"
+    with TarballServer(str(root)) as server:
+        urls = [server.url(name) for name in names]
+        crashed = Ledger(str(outdir))
+        crashed.seed(urls)
+        url = crashed.claim()
+        # The crashed worker left a partial MS and tarball, and its lease expired.
+        archive = Downloader.output_path(url, str(outdir))
+        os.makedirs(ms_path(archive))
+        with open(archive + ".part", "wb") as f:
+            f.write(b"partial")
+        os.utime(crashed.claims[url], (0, 0))
+
+        results = Downloader(urls, {"SURF": "macaroon"}).download_all(
+            1,
+            extract=False,
+            outdir=str(outdir),
+            min_free_space=None,
+            ledger=Ledger(str(outdir), lease=30.0, poll=0.2),
+        )
+
+    assert sorted((result.url, result.status) for result in results) == [
+        (url, "downloaded") for url in sorted(urls)
+    ]
+    assert not os.path.exists(ms_path(archive))
+    assert os.path.getsize(archive) == 64 << 10
+    ledger = outdir / ".ledger"
+    assert len(os.listdir(ledger / "done")) == len(names)
+    # Workers on one node share their download state.
+    assert [path.name for path in ledger.glob("state.*.sqlite")] == [
+        f"state.{socket.gethostname()}.sqlite"
+    ]
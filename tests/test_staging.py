@@ -0,0 +1,96 @@
+import asyncio
+import os
+
+import pytest
+
+from benchmarks.fake_awlofar import FakeStager, install_stager
+from benchmarks.server import TarballServer
+from flocs_lta.lta_download import Downloader
+from flocs_lta.staging import StagingPoller
+
+RECALL_TIME = 0.2
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / "lta"
+    root.mkdir()
+    names = []
+    for sb in range(3):
+        name = f"L123456_SB{sb:03d}_uv.MS_abc.tar"
+        (root / name).write_bytes(os.urandom(64 << 10))
+        names.append(name)
+    with TarballServer(str(root)) as server:
+        server.names = names
+        yield server
+
+
+@pytest.fixture
+def stager(server):
+    stager = FakeStager(
+        webdav_url=lambda surl: server.url(surl.split("/")[-1]),
+        recall_time=RECALL_TIME,
+    )
+    install_stager(stager)
+    return stager
+
+
+def _stage(stager: FakeStager, server: TarballServer) -> int:
+    return stager.stage(
+        [
+            f"srm://srm.grid.sara.nl:8443/pnfs/grid.sara.nl/{name}"
+            for name in server.names
+        ]
+    )
+
+
+def _poller(stage_id: int, downloader: Downloader) -> StagingPoller:
+    return StagingPoller(
+        stage_id, downloader, min_interval=RECALL_TIME / 10, max_interval=RECALL_TIME
+    )
+
+
+def test_online_urls_yields_files_while_staging(stager, server):
+    stage_id = _stage(stager, server)
+    poller = _poller(stage_id, Downloader([], {}))
+
+    async def collect():
+        return [
+            (url, stager.get_status(stage_id)) async for url in poller.online_urls()
+        ]
+
+    yielded = asyncio.run(collect())
+    assert [url for url, _ in yielded] == [server.url(name) for name in server.names]
+    # The first file comes before the rest of the request has been recalled.
+    assert yielded[0][1] == "in progress"
+    assert poller.status == "success"
+
+
+def test_online_urls_fetches_macaroons(stager, server):
+    downloader = Downloader([], {})
+    poller = _poller(_stage(stager, server), downloader)
+
+    async def drain():
+        return [url async for url in poller.online_urls()]
+
+    asyncio.run(drain())
+    assert downloader.macaroons == {"SURF": "macaroon"}
+
+
+def test_stage_and_fetch_downloads_every_file(stager, server, tmp_path):
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    downloader = Downloader([], {})
+    results = downloader.download_all(
+        2,
+        extract=False,
+        outdir=str(outdir),
+        min_free_space=None,
+        online=_poller(_stage(stager, server), downloader).online_urls(),
+    )
+    assert sorted(result.url for result in results) == sorted(
+        server.url(name) for name in server.names
+    )
+    assert all(result.ok for result in results)
+    for name in server.names:
+        assert (outdir / "L123456" / name).stat().st_size == 64 << 10
@@ -0,0 +1,27 @@
+import json
+import os
+import subprocess
+import sys
+
+from benchmarks.startup import HEAVY_MODULES
+
+_HELP = """
+import contextlib, io, json, sys
+from flocs_lta.flocs_lta import app
+with contextlib.redirect_stdout(io.StringIO()) as out, contextlib.suppress(SystemExit):
+    app(["download", "--help"])
+assert "--verification" in out.getvalue()
+print(json.dumps(sorted({name.split(".")[0] for name in sys.modules})))
+"""
+
+
+def test_download_help_does_not_import_heavy_modules():
+    output = subprocess.run(
+        [sys.executable, "-c", _HELP],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    loaded = set(json.loads(output.splitlines()[-1]))
+    assert not loaded & set(HEAVY_MODULES)
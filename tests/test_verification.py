@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+from benchmarks.server import make_ms_tarball
+from flocs_lta.lta_download import Downloader, process_download
+from flocs_lta.webdav import DownloadResult
+
+
+@pytest.fixture
+def downloaded(tmp_path, monkeypatch):
+    # Make `import casacore.tables` fail, as when python-casacore is not installed.
+    monkeypatch.setitem(sys.modules, "casacore", None)
+    archive = make_ms_tarball(str(tmp_path), "L123456_SB000_uv.MS", 1 << 20)
+    return DownloadResult(
+        "https://lta/L123456_SB000_uv.MS_abc.tar", archive, "downloaded"
+    )
+
+
+@pytest.mark.parametrize("verification", ["basic", "checksum"])
+def test_missing_casacore_skips_verification(downloaded, verification):
+    result = process_download(downloaded, verification=verification)
+    assert result.ok
+    assert result.dysco is None
+    assert os.path.isfile(result.path)
+    assert os.path.isdir(
+        os.path.join(os.path.dirname(result.path), "L123456_SB000_uv.MS")
+    )
+
+
+def test_missing_casacore_fails_deep_verification(downloaded):
+    result = process_download(downloaded, verification="deep")
+    assert result.status == "failed"
+    assert "casacore" in result.error
+    assert result.verification["ok"] is False
+
+
+@pytest.mark.parametrize("keep_archive", [False, True])
+def test_dysco_ms_keeps_archive_only_when_asked(tmp_path, monkeypatch, keep_archive):
+    monkeypatch.setattr("flocs_lta.lta_download.has_dysco", lambda ms: True)
+    archive = make_ms_tarball(str(tmp_path), "L123456_SB000_uv.MS", 1 << 20)
+    result = process_download(
+        DownloadResult(
+            "https://lta/L123456_SB000_uv.MS_abc.tar", archive, "downloaded"
+        ),
+        keep_archive=keep_archive,
+    )
+    assert result.ok
+    assert os.path.isfile(archive) == keep_archive
+
+
+def test_unknown_verification_level_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match="verification level"):
+        Downloader([], {}).download_all(
+            1, verification="full", outdir=str(tmp_path), min_free_space=None
+        )
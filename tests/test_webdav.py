@@ -0,0 +1,246 @@
+import base64
+import hashlib
+import http.server
+import json
+import os
+import zlib
+
+import pytest
+
+from benchmarks import server as benchmark_server
+from flocs_lta.checksum import Checksum
+from flocs_lta.webdav import WebDAVSession
+
+NAME = "L123456_SB000_uv.MS_abc.tar"
+SIZE = 1 << 20
+
+
+class _Handler(benchmark_server._Handler):
+    """Serves files like the benchmark server, and records requests.
+
+    Responds with the statuses queued in `errors` for a file name, or for a file
+    name and Range header, before serving it. Paths under /redirect/ are redirected
+    to /surf/, and a Digest header is sent when one is asked for.
+    """
+
+    requests: list
+    errors: dict
+
+    def do_GET(self):
+        name = os.path.basename(self.path.split("?")[0])
+        byte_range = self.headers.get("Range")
+        self.requests.append((self.path, byte_range, self.client_address[1]))
+        path = os.path.join(self.root, name)
+        total = os.path.getsize(path) if os.path.isfile(path) else 0
+        first = int(byte_range[6:].partition("-")[0]) if byte_range else 0
+        queued = self.errors.get((name, byte_range)) or self.errors.get(name)
+        if queued:
+            self._empty(queued.pop(0))
+        elif self.path.startswith("/redirect/"):
+            self._empty(302, Location=self.path.replace("/redirect/", "/surf/", 1))
+        elif total and first >= total:
+            self._empty(416, **{"Content-Range": f"bytes */{total}"})
+        else:
+            self.digest = None
+            if "Want-Digest" in self.headers:
+                with open(path, "rb") as f:
+                    data = f.read()
+                md5 = base64.b64encode(hashlib.md5(data).digest()).decode()
+                self.digest = f"adler32={zlib.adler32(data):08x},md5={md5}"
+            super().do_GET()
+
+    def end_headers(self):
+        if getattr(self, "digest", None):
+            self.send_header("Digest", self.digest)
+            self.digest = None
+        super().end_headers()
+
+    def _empty(self, status: int, **headers):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class ScriptedServer(benchmark_server.TarballServer):
+    def __init__(self, root: str):
+        self.requests = []
+        self.errors = {}
+        handler = type(
+            "Handler",
+            (_Handler,),
+            {"root": root, "requests": self.requests, "errors": self.errors},
+        )
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+
+
+@pytest.fixture
+def data(tmp_path):
+    root = tmp_path / "lta"
+    root.mkdir()
+    data = os.urandom(SIZE)
+    (root / NAME).write_bytes(data)
+    (root / "L123456_SB001_uv.MS_abc.tar").write_bytes(data[: SIZE // 2])
+    return data
+
+
+@pytest.fixture
+def server(tmp_path, data):
+    with ScriptedServer(str(tmp_path / "lta")) as server:
+        yield server
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr("flocs_lta.webdav.time.sleep", delays.append)
+    return delays
+
+
+@pytest.fixture
+def session():
+    session = WebDAVSession("macaroon", min_segment_size=64 << 10)
+    yield session
+    session.close()
+
+
+def test_connections_are_reused(server, session, tmp_path):
+    for name in [NAME, "L123456_SB001_uv.MS_abc.tar"]:
+        assert session.download(server.url(name), str(tmp_path / name)).ok
+    ports = {port for _, _, port in server.requests}
+    assert len(server.requests) == 2
+    assert len(ports) == 1
+    assert all("authz=macaroon" in path for path, _, _ in server.requests)
+
+
+def test_retries_with_backoff(server, session, sleeps, tmp_path, data):
+    server.errors[NAME] = [401, 503]
+    path = tmp_path / NAME
+    result = session.download(server.url(NAME), str(path))
+    assert result.status == "downloaded"
+    assert path.read_bytes() == data
+    assert len(server.requests) == 3
+    assert sleeps == [session.backoff, session.backoff**2]
+
+
+def test_gives_up_after_retries(server, sleeps, tmp_path):
+    server.errors[NAME] = [500, 502, 504]
+    session = WebDAVSession("macaroon", retries=2)
+    result = session.download(server.url(NAME), str(tmp_path / NAME))
+    assert result.status == "failed"
+    assert result.http_status == 504
+    assert len(sleeps) == 2
+    assert not (tmp_path / NAME).exists()
+
+
+def test_does_not_retry_client_errors(server, session, sleeps, tmp_path):
+    result = session.download(
+        server.url("L123456_SB999_uv.MS_abc.tar"), str(tmp_path / NAME)
+    )
+    assert result.status == "failed"
+    assert result.http_status == 404
+    assert sleeps == []
+
+
+def test_follows_redirects(server, session, tmp_path, data):
+    url = server.url(NAME).replace("/surf/", "/redirect/")
+    path = tmp_path / NAME
+    assert session.download(url, str(path)).status == "downloaded"
+    assert path.read_bytes() == data
+    (redirected, _, _), (served, _, _) = server.requests
+    assert redirected.startswith("/redirect/")
+    assert served.startswith(f"/surf/{NAME}?authz=macaroon")
+
+
+def test_resumes_partial_file(server, session, tmp_path, data):
+    path = tmp_path / NAME
+    (tmp_path / f"{NAME}.part").write_bytes(data[:1000])
+    result = session.download(server.url(NAME), str(path), checksum=True)
+    assert result.status == "downloaded"
+    assert result.nbytes == SIZE - 1000
+    assert path.read_bytes() == data
+    assert [byte_range for _, byte_range, _ in server.requests] == ["bytes=1000-"]
+    # The checksum covers the part that was already on disk.
+    expected = Checksum()
+    expected.update(data)
+    assert result.checksums == expected.hexdigests()
+    assert result.remote_checksums == expected.hexdigests()
+
+
+def test_restarts_partial_file_after_416(server, session, tmp_path, data):
+    path = tmp_path / NAME
+    (tmp_path / f"{NAME}.part").write_bytes(os.urandom(SIZE + 1))
+    result = session.download(server.url(NAME), str(path))
+    assert result.status == "downloaded"
+    assert path.read_bytes() == data
+    assert [byte_range for _, byte_range, _ in server.requests] == [
+        f"bytes={SIZE + 1}-",
+        None,
+    ]
+
+
+def test_segmented_download_with_checksum(server, session, tmp_path, data):
+    path = tmp_path / NAME
+    result = session.download(server.url(NAME), str(path), segments=4, checksum=True)
+    assert result.status == "downloaded"
+    assert path.read_bytes() == data
+    assert result.checksums == {"adler32": f"{zlib.adler32(data):08x}"}
+    assert result.remote_checksums["adler32"] == result.checksums["adler32"]
+    step = SIZE // 4
+    assert sorted(byte_range for _, byte_range, _ in server.requests) == sorted(
+        ["bytes=0-0"]
+        + [f"bytes={first}-{first + step - 1}" for first in range(0, SIZE, step)]
+    )
+    assert not os.path.exists(f"{path}.part.ranges")
+
+
+def test_segmented_download_resumes_from_checkpoint(server, session, tmp_path, data):
+    path = tmp_path / NAME
+    step = SIZE // 4
+    failing = f"bytes={2 * step}-{3 * step - 1}"
+    server.errors[(NAME, failing)] = [404]
+    result = session.download(server.url(NAME), str(path), segments=4, checksum=True)
+    assert result.status == "failed"
+    assert result.http_status == 404
+
+    with open(f"{path}.part.ranges") as f:
+        checkpoint = json.load(f)
+    assert checkpoint["total"] == SIZE
+    assert [done for _, _, done, _ in checkpoint["ranges"]] == [step, step, 0, step]
+
+    server.requests.clear()
+    result = session.download(server.url(NAME), str(path), segments=4, checksum=True)
+    assert result.status == "downloaded"
+    assert result.nbytes == step
+    assert path.read_bytes() == data
+    assert result.checksums == {"adler32": f"{zlib.adler32(data):08x}"}
+    assert [byte_range for _, byte_range, _ in server.requests] == [
+        "bytes=0-0",
+        failing,
+    ]
+    assert not os.path.exists(f"{path}.part")
+    assert not os.path.exists(f"{path}.part.ranges")
+
+
+def test_segmented_download_resumes_checkpoint_without_checksums(
+    server, session, tmp_path, data
+):
+    path = tmp_path / NAME
+    half = SIZE // 2
+    (tmp_path / f"{NAME}.part").write_bytes(data[:1000] + bytes(SIZE - 1000))
+    (tmp_path / f"{NAME}.part.ranges").write_text(
+        json.dumps(
+            {"total": SIZE, "ranges": [[0, half - 1, 1000], [half, SIZE - 1, 0]]}
+        )
+    )
+    result = session.download(server.url(NAME), str(path), segments=2, checksum=True)
+    assert result.status == "downloaded"
+    assert path.read_bytes() == data
+    assert result.checksums == {"adler32": f"{zlib.adler32(data):08x}"}
+    assert sorted(byte_range for _, byte_range, _ in server.requests) == [
+        "bytes=0-0",
+        f"bytes=1000-{half - 1}",
+        f"bytes={half}-{SIZE - 1}",
+    ]